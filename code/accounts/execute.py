@@ -1,9 +1,15 @@
+import asyncio
 import datetime
+import json
 import logging
-from typing import List, Literal
+from typing import Dict, List, Literal, Optional
+from urllib.parse import urlencode
 import aiohttp
+import socketio
 from accounts.mail import SRETradesMailer
+from database.columns import widen_sreorders_status
 from database.models import Instrument, Ltp, SREAccount, SREOrders, Trade, TradeSide
+from dataaggregator.ratelimit import TokenBucket
 from dataaggregator.sre.datasaver import SREMarketData
 from tortoise.expressions import Subquery
 import settings
@@ -11,12 +17,22 @@ import settings
 
 class SREExecute:
 
+    order_rate = 10
+    order_burst = 10
+    order_concurrency = 5
+    order_retries = 3
+    order_retry_delay = 0.5
+    order_flush_interval = 1
+    terminal_statuses = ('Filled', 'Rejected', 'Cancelled')
+
     def __init__(self, sre_account: SREAccount) -> None:
         self._access_token = None
+        self._user_id = None
         self._api_root = "https://xts.sre.co.in"
         self._client_id = "*****"
         self.market_api = SREMarketData()
         self.sre_account = sre_account
+        self.sio = socketio.AsyncClient()
         ##
         #  In case of multiple accounts with SRE we will need a user id stored in db 
         # or store different secrets according to accounts.
@@ -39,6 +55,7 @@ class SREExecute:
                     raise ValueError("Login failed")
                 data = await res.json()
                 self._access_token = data['result']['token']
+                self._user_id = data['result'].get('userID')
         await self.market_api.login()
         await self.market_api.get_instrument_master()
 
@@ -50,43 +67,82 @@ class SREExecute:
             }) as res:
                 return res.ok
 
-    async def get_limit_price(self, instrument: Instrument, side: TradeSide):
-        ltp = await Ltp.filter(instrument=instrument).get()
+    @staticmethod
+    def _limit_price(price: float, side: TradeSide) -> float:
         tick_size = 0.05
         if side == TradeSide.BUY:
-            limit_price = ltp.price * (1 + 0.5 / 100)
+            limit_price = price * (1 + 0.5 / 100)
         else:
-            limit_price = ltp.price * (1 - 0.5 / 100)
+            limit_price = price * (1 - 0.5 / 100)
         limit_price = (limit_price // tick_size) * tick_size
         return limit_price
-            
-    async def place_order(self, trade: Trade) -> dict:
+
+    async def get_limit_price(self, instrument: Instrument, side: TradeSide):
+        ltp = await Ltp.filter(instrument=instrument).get()
+        return self._limit_price(ltp.price, side)
+
+    @staticmethod
+    def _order_identifier(sre_order: SREOrders) -> str:
+        return f"sre{sre_order.id}"
+
+    def _order_payload(self, trade: Trade, inst_id: int, limit_price: float, identifier: Optional[str] = None) -> dict:
+        payload = {
+            'exchangeSegment': "NSECM" if trade.instrument.stock_id else "NSEFO",
+            'exchangeInstrumentID': int(inst_id),
+            'productType': 'NRML',
+            'orderType': 'LIMIT',
+            'orderSide': trade.side.name,
+            'timeInForce': 'DAY',
+            'disclosedQuantity': 0,
+            'orderQuantity': int(trade.qty),
+            'limitPrice': float(limit_price),
+            'stopPrice': 0,
+            'clientID': '*****'
+        }
+        if identifier:
+            payload['orderUniqueIdentifier'] = identifier
+        return payload
+
+    async def _post_order(self, session: aiohttp.ClientSession, payload: dict) -> dict:
+        async with session.post(f"{self._api_root}/interactive/orders", headers={
+            'authorization': self.access_token
+        }, json=payload) as res:
+            if res.status >= 500:
+                res.raise_for_status()
+            data = await res.json()
+            logging.info(f"Place trade response: {data}")
+            if not res.ok:
+                raise Exception("SRE place trades failed")
+            return data
+
+    async def place_order(self, trade: Trade, identifier: Optional[str] = None) -> dict:
         await trade.fetch_related('instrument')
         inst_id = await self.market_api._get_exchange_instrument_id(trade.instrument)
         limit_price = await self.get_limit_price(trade.instrument, trade.side)
         trade.price = limit_price
         await trade.save()
         async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self._api_root}/interactive/orders", headers={
-                'authorization': self.access_token
-            }, json={
-                'exchangeSegment': "NSECM" if trade.instrument.stock else "NSEFO",
-                'exchangeInstrumentID': int(inst_id),
-                'productType': 'NRML',
-                'orderType': 'LIMIT',
-                'orderSide': trade.side.name,
-                'timeInForce': 'DAY',
-                'disclosedQuantity': 0,
-                'orderQuantity': int(trade.qty),
-                'limitPrice': float(limit_price),
-                'stopPrice': 0,
-                'clientID': '*****'
-            }) as res:
-                data = await res.json()
-                logging.info(f"Place trade response: {data}")
-                if not res.ok:
-                    raise Exception("SRE place trades failed")
-                return data
+            return await self._post_order(session, self._order_payload(trade, inst_id, limit_price, identifier))
+
+    async def _place_with_retry(self, session: aiohttp.ClientSession, limiter: TokenBucket, payload: dict) -> dict:
+        ##
+        # A request that failed in transit may still have reached XTS, so the
+        # order book is checked for the identifier before sending it again.
+        ##
+        identifier = payload['orderUniqueIdentifier']
+        for attempt in range(self.order_retries):
+            if attempt:
+                await asyncio.sleep(self.order_retry_delay * 2 ** (attempt - 1))
+                app_order_id = (await self.get_placed_order_ids()).get(identifier)
+                if app_order_id:
+                    return {'result': {'AppOrderID': app_order_id}}
+            await limiter.acquire()
+            try:
+                return await self._post_order(session, payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if attempt == self.order_retries - 1:
+                    raise
+                logging.error(f"Placing order {identifier} failed, retrying", exc_info=ex)
 
     async def modify_limit_order_price(self, sre_order: SREOrders):
         await sre_order.fetch_related('trade')
@@ -129,34 +185,141 @@ class SREExecute:
                 data = await res.json()
                 return data
 
+    async def get_placed_order_ids(self) -> Dict[str, int]:
+        response = await self.get_order_details()
+        return {
+            order['OrderUniqueIdentifier']: order['AppOrderID']
+            for order in response.get('result', [])
+            if order.get('OrderUniqueIdentifier')
+        }
+
     async def place_pending_trades(self):
         sre_orders = await SREOrders.filter(
             sre_account=self.sre_account,
             app_order_id__isnull=True
-        ).select_related('trade')
+        ).select_related('trade__instrument')
+        if not sre_orders:
+            return
+        ##
+        # Every order is sent with its SREOrders id as orderUniqueIdentifier.
+        # Identifiers already in the order book were placed by an earlier run
+        # that died before saving, so they are recorded instead of placed again.
+        ##
+        placed_ids = await self.get_placed_order_ids()
+        prices = dict(await Ltp.filter(
+            instrument_id__in=list({sre_order.trade.instrument_id for sre_order in sre_orders})
+        ).values_list('instrument_id', 'price'))
+        pending = []
+        for sre_order in sre_orders:
+            trade: Trade = sre_order.trade
+            app_order_id = placed_ids.get(self._order_identifier(sre_order))
+            if app_order_id:
+                sre_order.app_order_id = app_order_id
+            elif trade.instrument_id not in prices:
+                logging.error(f"No ltp for trade {trade.id}, order not placed")
+            else:
+                trade.price = self._limit_price(prices[trade.instrument_id], trade.side)
+                pending.append(sre_order)
+        if pending:
+            await Trade.bulk_update([sre_order.trade for sre_order in pending], fields=['price'])
+
+        limiter = TokenBucket(self.order_rate, self.order_burst)
+        semaphore = asyncio.Semaphore(self.order_concurrency)
+        async with aiohttp.ClientSession() as session:
+
+            async def place(sre_order: SREOrders):
+                trade: Trade = sre_order.trade
+                async with semaphore:
+                    try:
+                        inst_id = await self.market_api._get_exchange_instrument_id(trade.instrument)
+                        payload = self._order_payload(trade, inst_id, trade.price, self._order_identifier(sre_order))
+                        response = await self._place_with_retry(session, limiter, payload)
+                        sre_order.app_order_id = response.get('result', {}).get('AppOrderID')
+                    except Exception as ex:
+                        logging.error(f"Placing order failed for trade {trade.id}", exc_info=ex)
+
+            await asyncio.gather(*[place(sre_order) for sre_order in pending])
+        placed = [sre_order for sre_order in sre_orders if sre_order.app_order_id]
+        if placed:
+            await SREOrders.bulk_update(placed, fields=['app_order_id'])
+
+    async def apply_order_updates(self, orders: List[dict]) -> List[SREOrders]:
+        statuses = {order['AppOrderID']: order['OrderStatus'] for order in orders}
+        if not statuses:
+            return []
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        sre_orders = await SREOrders.filter(app_order_id__in=list(statuses), timestamp__gte=today)
+        changed = []
         for sre_order in sre_orders:
-            response = await self.place_order(sre_order.trade)
-            sre_order.app_order_id = response.get('result', {}).get('AppOrderID')
-            await sre_order.save()
+            status = statuses[sre_order.app_order_id]
+            if sre_order.status in self.terminal_statuses and status not in self.terminal_statuses:
+                continue
+            if sre_order.status != status:
+                sre_order.status = status
+                changed.append(sre_order)
+        if changed:
+            await SREOrders.bulk_update(changed, fields=['status'])
+        return sre_orders
 
     async def check_placed_orders(self) -> List[SREOrders]:
         response = await self.get_order_details()
-        orders = response.get('result', [])
-        today = datetime.date.today()
-        sre_orders = []
-        for order in orders:
-            sre_order = await SREOrders.filter(app_order_id=order['AppOrderID'], timestamp__gte=today).get_or_none()
-            if sre_order:
-                if sre_order.status != order['OrderStatus']:
-                    sre_order.status = order['OrderStatus']
-                    await sre_order.save()
-                # if order['OrderStatus'] == 'Open' or order['OrderStatus'] == 'New':
-                #     try:
-                #         await self.modify_limit_order_price(sre_order)
-                #     except Exception as ex:
-                #         logging.error(f"Modify order failed for {sre_order.app_order_id}", exc_info=ex)
-                sre_orders.append(sre_order)
-        return sre_orders
+        return await self.apply_order_updates(response.get('result', []))
+
+    async def track_order_updates(self, timeout: float = 120) -> List[SREOrders]:
+        ##
+        # Order events from the interactive stream are buffered by AppOrderID
+        # and written every order_flush_interval seconds until today's orders
+        # of this account are all terminal. The order book is reconciled before
+        # and after listening to cover events sent while not connected.
+        ##
+        pending = set(await SREOrders.filter(
+            sre_account=self.sre_account,
+            timestamp__gte=datetime.datetime.combine(datetime.date.today(), datetime.time()),
+            app_order_id__isnull=False
+        ).values_list('app_order_id', flat=True))
+        tracked: Dict[int, SREOrders] = {}
+        buffer: Dict[int, dict] = {}
+        received = asyncio.Event()
+
+        def track(sre_orders: List[SREOrders]):
+            for sre_order in sre_orders:
+                tracked[sre_order.id] = sre_order
+                if sre_order.status in self.terminal_statuses:
+                    pending.discard(sre_order.app_order_id)
+
+        async def on_order(data):
+            order = json.loads(data) if isinstance(data, str) else data
+            buffer[order['AppOrderID']] = order
+            received.set()
+
+        track(await self.check_placed_orders())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.sio.on('order', on_order)
+        try:
+            params = urlencode({
+                'token': self.access_token,
+                'userID': self._user_id,
+                'apiType': 'INTERACTIVE'
+            })
+            await self.sio.connect(f"{self._api_root}/?{params}", socketio_path="/interactive/socket.io")
+            while pending and loop.time() < deadline:
+                try:
+                    await asyncio.wait_for(received.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                await asyncio.sleep(self.order_flush_interval)
+                received.clear()
+                orders = list(buffer.values())
+                buffer.clear()
+                track(await self.apply_order_updates(orders))
+        except Exception as ex:
+            logging.error("Order update stream failed, falling back to the order book", exc_info=ex)
+        finally:
+            if self.sio.connected:
+                await self.sio.disconnect()
+        track(await self.check_placed_orders())
+        return list(tracked.values())
 
 
 class SRETradeExecutor:
@@ -181,7 +344,34 @@ class SRETradeExecutor:
             await sre_executor.login()
             await sre_executor.place_pending_trades()
 
+    async def place_and_track_trades(self, timeout: float = 120):
+        ##
+        # Accounts are placed and tracked side by side against one deadline,
+        # so the whole run takes about `timeout` however many accounts there
+        # are. One account failing does not stop the others or the mail.
+        ##
+        await widen_sreorders_status()
+        sre_accounts = await SREAccount.all()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        async def place_and_track(sre_account: SREAccount) -> List[SREOrders]:
+            try:
+                sre_executor = SREExecute(sre_account)
+                await sre_executor.login()
+                await sre_executor.place_pending_trades()
+                return await sre_executor.track_order_updates(max(deadline - loop.time(), 0))
+            except Exception as ex:
+                logging.error(f"Placing and tracking trades failed for sre account {sre_account.id}", exc_info=ex)
+                return []
+
+        sre_orders = []
+        for account_orders in await asyncio.gather(*[place_and_track(sre_account) for sre_account in sre_accounts]):
+            sre_orders += account_orders
+        await SRETradesMailer(sre_orders).run()
+
     async def check_trades(self):
+        await widen_sreorders_status()
         sre_accounts = await SREAccount.all()
         sre_orders = []
         for sre_account in sre_accounts:
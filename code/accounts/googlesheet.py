@@ -5,6 +5,7 @@ import pandas as pd
 import pytz
 from accounts.pnl import PnlSave
 from algos.componentanalysis import ShadowPositionCompAnalysis
+from algos.shadowstore import load_shadow_state, save_shadow_state
 from database.models import Account, Instrument, Ltp, Subscription, SubscriptionData, TradeSide
 from tortoise.expressions import Subquery
 import settings
@@ -142,6 +143,7 @@ class GoogleSheetEdit:
         ).select_related('subscription__account')
         mtms = {}
         for sub_data in sub_datas:
+            await load_shadow_state(sub_data)
             try:
                 long_mtm = sub_data.data['long_mtm_tracking'][-1]
                 short_mtm = sub_data.data['short_mtm_tracking'][-1]
@@ -212,8 +214,9 @@ class GoogleSheetEdit:
                     if row.mtm:
                         values['mtm'] = float(row.mtm)
                     stored_positions.append(values)
+                await load_shadow_state(sub_data)
                 sub_data.data['positions'] = stored_positions
-                await sub_data.save()
+                await save_shadow_state(sub_data)
 
     async def update_trade_counter_ratios(self):
         subs_q = Subscription.filter(active=True, is_hedge=False).values('id')
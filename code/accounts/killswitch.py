@@ -4,6 +4,7 @@ from typing import Optional
 from accounts.mail import TradesMailer
 from algos.basealgo import BaseAlgo, BaseAlgoPnlRMS
 from algos.shadowanalysis import ShadowAnalysis
+from algos.shadowstore import load_shadow_state, save_shadow_state
 from database.models import Account, Algo, Instrument, Ltp, Position, Subscription, SubscriptionData, Trade, TradeExit, TradeSide
 from tortoise.expressions import Subquery
 
@@ -81,6 +82,7 @@ async def send_trades_from_shadow(account: Account, side: Optional[TradeSide] =
         algo_strat: BaseAlgoPnlRMS = algo_strat_class()
         await algo_strat.init()
         sub_data = await SubscriptionData.filter(subscription=sub).get()
+        await load_shadow_state(sub_data)
         stored_positions = sub_data.data.get('positions', [])
         active_insts = await Position.filter(
             active=True,
@@ -107,7 +109,7 @@ async def send_trades_from_shadow(account: Account, side: Optional[TradeSide] =
         elif not side:
             sub_data.data['long_kill_switch'] = False
             sub_data.data['short_kill_switch'] = False
-        await sub_data.save()
+        await save_shadow_state(sub_data)
         mailer = TradesMailer(algo_strat, send_no_trades=False)
         await mailer.run()
 
@@ -118,11 +120,12 @@ async def reverse_trades(account: Account, side: Optional[TradeSide]):
     algo_strat_class = getattr(module, sub.algo.name)
     assert issubclass(algo_strat_class, ShadowAnalysis)
     sub_data = await SubscriptionData.filter(subscription=sub).get()
+    await load_shadow_state(sub_data)
     algo_strat: ShadowAnalysis = algo_strat_class()
     await algo_strat.init()
     await algo_strat.enter_reverse_from_shadow(sub_data, side)
     sub_data.data['shadow_long_status'] = "REVERSED"
-    await sub_data.save()
+    await save_shadow_state(sub_data)
     mailer = TradesMailer(algo_strat, send_no_trades=False, reverse=True)
     await mailer.run()
 
@@ -133,6 +136,7 @@ async def reverse_trade_exit(account: Account, side: Optional[TradeSide]):
     algo_strat_class = getattr(module, sub.algo.name)
     assert issubclass(algo_strat_class, ShadowAnalysis)
     sub_data = await SubscriptionData.filter(subscription=sub).get()
+    await load_shadow_state(sub_data)
     algo_strat: ShadowAnalysis = algo_strat_class()
     await algo_strat.init()
     await algo_strat.exit_reversed(sub_data, side)
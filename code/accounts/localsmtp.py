@@ -0,0 +1,88 @@
+import asyncio
+from typing import List, Optional, Set
+
+
+class LocalSMTPServer:
+    ##
+    # Just enough SMTP to accept what aiosmtplib sends, for tests and offline
+    # benchmarks. `latency` is added to every greeting and every message, and
+    # connections are dropped after `max_messages` like a relay would.
+    ##
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, max_messages: Optional[int] = None) -> None:
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.max_messages = max_messages
+        self.messages: List[bytes] = []
+        self.connections = 0
+        self.logins = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: Set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self) -> "LocalSMTPServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def _reply(self, writer: asyncio.StreamWriter, *lines: str):
+        writer.write("".join(f"{line}\r\n" for line in lines).encode())
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        sent = 0
+        try:
+            await asyncio.sleep(self.latency)
+            await self._reply(writer, "220 localhost ESMTP")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                verb = line.decode().strip().split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    await self._reply(writer, "250-localhost", "250-AUTH PLAIN", "250 SIZE 52428800")
+                elif verb == "HELO":
+                    await self._reply(writer, "250 localhost")
+                elif verb == "AUTH":
+                    self.logins += 1
+                    await self._reply(writer, "235 Authentication successful")
+                elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                    await self._reply(writer, "250 OK")
+                elif verb == "DATA":
+                    await self._reply(writer, "354 End data with <CR><LF>.<CR><LF>")
+                    data = []
+                    while True:
+                        line = await reader.readline()
+                        if not line or line == b".\r\n":
+                            break
+                        data.append(line[1:] if line.startswith(b".") else line)
+                    await asyncio.sleep(self.latency)
+                    self.messages.append(b"".join(data))
+                    sent += 1
+                    await self._reply(writer, "250 OK")
+                    if self.max_messages and sent >= self.max_messages:
+                        break
+                elif verb == "QUIT":
+                    await self._reply(writer, "221 Bye")
+                    break
+                else:
+                    await self._reply(writer, "502 Command not implemented")
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
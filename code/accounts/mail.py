@@ -1,15 +1,18 @@
+import asyncio
 import datetime
 import importlib
-from io import BytesIO
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 from email.message import EmailMessage
 from email.utils import make_msgid
 from pathlib import Path
-from aiosmtplib import SMTP
-from accounts.pnl import PnlSave
+from accounts.mailtransport import get_mail_transport
+from accounts.pnl import PNL_REPORT_WORKERS, PnlSave, build_pnl_excels
+from accounts.symbols import get_instrument_cache
 from algos.basealgo import BaseAlgo
 from algos.shadowanalysis import ShadowAnalysis, ShadowPosition
+from algos.shadowstore import load_shadow_state
 from database.models import Account, AccountEmail, Algo, ClientExcelAccount, ClientExcelType, Instrument, Ltp, PnL, Position, SREOrders, Subscription, SubscriptionData, Trade, TradeExit, TradeSide, TradesMail, User
+from database.utils import assign_ids
 from tortoise.expressions import Subquery, Q
 import settings
 import jinja2
@@ -23,25 +26,26 @@ class BaseMailer:
         self.mails: List[TradesMail] = []
 
     async def get_symbol(self, instrument: Instrument) -> str:
-        await instrument.fetch_related('stock', 'future__stock', 'option__stock')
-        if instrument.stock:
-            return instrument.stock.ticker
-        elif instrument.future:
-            return f"{instrument.future.stock.ticker} {instrument.future.expiry.strftime('%b')} FUT"
-        else:
-            return f"{instrument.option.stock.ticker} {instrument.option.strike} {instrument.option.expiry} {instrument.option.option_type.value}"
+        return (await get_instrument_cache().get_symbols([instrument.id]))[instrument.id]
+
+    async def save_mails(self, mails: List[TradesMail]):
+        await assign_ids(mails)
+        await TradesMail.bulk_create(mails)
+        self.mails.extend(mails)
 
     async def send_mails(self):
-        smtp = SMTP("smtp-relay.gmail.com", 587)
-        await smtp.connect()
-        await smtp.ehlo()
-        await smtp.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+        msgs = []
+        if self.mails:
+            await TradesMail.fetch_for_list(self.mails, 'account__user')
+        account_emails: Dict[int, List[str]] = {}
+        for account_id, email in await AccountEmail.filter(
+            account_id__in={trades_mail.account_id for trades_mail in self.mails}
+        ).values_list('account_id', 'email'):
+            account_emails.setdefault(account_id, []).append(email)
         for trades_mail in self.mails:
-            await trades_mail.fetch_related('account__user')
-            emails = await AccountEmail.filter(account=trades_mail.account).values_list('email', flat=True)
             msg = EmailMessage()
             msg['To'] = trades_mail.account.user.email
-            msg['CC'] = ",".join(emails)
+            msg['CC'] = ",".join(account_emails.get(trades_mail.account_id, []))
             msg['From'] = settings.FROM_EMAIL
             msg['Subject'] = trades_mail.subject
             msg.set_content(trades_mail.body)
@@ -50,8 +54,8 @@ class BaseMailer:
                 msg.add_attachment(trades_mail.attachment.decode(), filename="BasketTrades.csv")
                 msg.add_attachment(trades_mail.attachment.decode(), filename="BasketTrades.txt")
             msg['Message-ID'] = make_msgid(domain="algonauts.in")
-            await smtp.send_message(msg)
-        smtp.close()
+            msgs.append(msg)
+        await get_mail_transport().send_messages(msgs)
 
     def run(self):
         raise NotImplementedError
@@ -76,80 +80,95 @@ class TradesMailer(BaseMailer):
         self.reverse = reverse
         self.partial = partial
 
+    def get_subject(self) -> str:
+        subject = f"Trades for {datetime.date.today()}"
+        if self.rollover:
+            subject = "Rollover " + subject
+        elif self.reverse:
+            subject = "Reversal " + subject
+        elif self.partial:
+            subject = "Partial " + subject
+        return subject
+
+    async def render_trades_mail(self, account: Account, trades: List[Trade], entry_trade_ids: Set[int], exit_trade_ids: Set[int], symbols: Dict[int, str], cl_ex_account: Optional[ClientExcelAccount]) -> TradesMail:
+
+        def rows(trade_ids: Set[int], side: TradeSide):
+            return [(trd.side.value, trd.qty, symbols[trd.instrument_id], trd.price) for trd in trades if trd.id in trade_ids and trd.side == side]
+
+        long_entrys = rows(entry_trade_ids, TradeSide.BUY)
+        short_entrys = rows(entry_trade_ids, TradeSide.SELL)
+        long_exits = rows(exit_trade_ids, TradeSide.SELL)
+        short_exits = rows(exit_trade_ids, TradeSide.BUY)
+        if cl_ex_account:
+            csv = await self.trades_csv_templates[cl_ex_account.template_type].render_async(
+                account=account,
+                trades=trades,
+                client_account_id=cl_ex_account.client_account_id
+            )
+            attachment = csv.encode()
+        else:
+            attachment = None
+        txt = await self.txt_template.render_async(
+            account=account,
+            long_entrys=long_entrys,
+            short_entrys=short_entrys,
+            long_exits=long_exits,
+            short_exits=short_exits
+        )
+        html = await self.html_template.render_async(
+            account=account,
+            long_entrys=long_entrys,
+            short_entrys=short_entrys,
+            long_exits=long_exits,
+            short_exits=short_exits
+        )
+        return TradesMail(account=account, subject=self.get_subject(), body=txt, html=html, attachment=attachment)
+
+    async def render_no_trades_mail(self, account: Account) -> TradesMail:
+        txt = await self.no_trades_txt_template.render_async(account=account)
+        html = await self.no_trades_html_template.render_async(account=account)
+        return TradesMail(account=account, subject=f"Trades for {datetime.date.today()}", body=txt, html=html)
+
     async def run(self):
-        trades = Trade.filter(id__in=[td.id for td in self.trades])
-        account_ids = await trades.values_list('subscription__account__id', flat=True)
+        ##
+        # One read of the trades, their exits and instruments for the whole
+        # batch, grouped by account in memory. Accounts are then rendered
+        # concurrently and their mails written in one insert.
+        ##
         algo = await Algo.get(name=self.algo.__class__.__name__)
         subscribed_account_ids = await Subscription.filter(algo=algo, active=True).values_list('account_id', flat=True)
-        accounts = await Account.filter(Q(id__in=account_ids) & Q(id__in=subscribed_account_ids)).distinct()
-        for account in accounts:
-            account_trade_ids = await Trade.filter(
-                subscription__account=account, id__in=Subquery(trades.values('id'))
-            ).values_list('id', flat=True)
-            entry_trade_ids = await TradeExit.filter(entry_trade_id__in=account_trade_ids).values_list('entry_trade_id', flat=True)
-            exit_trade_ids = await TradeExit.filter(exit_trade_id__in=account_trade_ids).values_list('exit_trade_id', flat=True)
-            long_entrys = await Trade.filter(id__in=entry_trade_ids, side=TradeSide.BUY).select_related('instrument')
-            short_entrys = await Trade.filter(id__in=entry_trade_ids, side=TradeSide.SELL).select_related('instrument')
-            long_exits = await Trade.filter(id__in=exit_trade_ids, side=TradeSide.SELL).select_related('instrument')
-            short_exits = await Trade.filter(id__in=exit_trade_ids, side=TradeSide.BUY).select_related('instrument')
-            long_entrys = [(trd.side.value, trd.qty, await self.get_symbol(trd.instrument), trd.price) for trd in long_entrys]
-            short_entrys = [(trd.side.value, trd.qty, await self.get_symbol(trd.instrument), trd.price) for trd in short_entrys]
-            long_exits = [(trd.side.value, trd.qty, await self.get_symbol(trd.instrument), trd.price) for trd in long_exits]
-            short_exits = [(trd.side.value, trd.qty, await self.get_symbol(trd.instrument), trd.price) for trd in short_exits]
-            cl_ex_account = await ClientExcelAccount.filter(account=account).get_or_none()
-            if cl_ex_account:
-                trades_for_acc = await trades.filter(subscription__account=account)
-                csv = await self.trades_csv_templates[cl_ex_account.template_type].render_async(
-                    account=account,
-                    trades=trades_for_acc,
-                    client_account_id=cl_ex_account.client_account_id
-                )
-                attachment = csv.encode()
-            else:
-                attachment = None
-            await account.fetch_related('user')
-            txt = await self.txt_template.render_async(
-                account=account,
-                long_entrys=long_entrys,
-                short_entrys=short_entrys,
-                long_exits=long_exits,
-                short_exits=short_exits
-            )
-            html = await self.html_template.render_async(
-                account=account,
-                long_entrys=long_entrys,
-                short_entrys=short_entrys,
-                long_exits=long_exits,
-                short_exits=short_exits
-            )
-            subject = f"Trades for {datetime.date.today()}"
-            if self.rollover:
-                subject = "Rollover " + subject
-            elif self.reverse:
-                subject = "Reversal " + subject
-            elif self.partial:
-                subject = "Partial " + subject
-            trades_mail = await TradesMail.create(
-                account=account,
-                subject=subject,
-                body=txt,
-                html=html,
-                attachment=attachment
-            )
-            self.mails.append(trades_mail)
+        trades = await Trade.filter(id__in=[td.id for td in self.trades]).order_by('id').select_related('subscription')
+        trade_ids = [trade.id for trade in trades]
+        trade_exits = await TradeExit.filter(
+            Q(entry_trade_id__in=trade_ids) | Q(exit_trade_id__in=trade_ids)
+        ).values_list('entry_trade_id', 'exit_trade_id')
+        entry_trade_ids = {entry_trade_id for entry_trade_id, _ in trade_exits}
+        exit_trade_ids = {exit_trade_id for _, exit_trade_id in trade_exits if exit_trade_id}
+        instrument_cache = get_instrument_cache()
+        instruments = await instrument_cache.get_instruments(trade.instrument_id for trade in trades)
+        symbols = await instrument_cache.get_symbols(instruments)
+        account_trades: Dict[int, List[Trade]] = {}
+        for trade in trades:
+            trade.instrument = instruments[trade.instrument_id]
+            account_trades.setdefault(trade.subscription.account_id, []).append(trade)
+        accounts = await Account.filter(
+            id__in=[account_id for account_id in account_trades if account_id in subscribed_account_ids]
+        ).select_related('user')
+        cl_ex_accounts = {
+            cl_ex_account.account_id: cl_ex_account
+            for cl_ex_account in await ClientExcelAccount.filter(account_id__in=[account.id for account in accounts])
+        }
+        mails = list(await asyncio.gather(*[
+            self.render_trades_mail(
+                account, account_trades[account.id], entry_trade_ids, exit_trade_ids, symbols, cl_ex_accounts.get(account.id)
+            ) for account in accounts
+        ]))
         if self.send_no_trades:
-            no_trades_accounts = await Account.filter(id__in=subscribed_account_ids).exclude(id__in=account_ids)
-            for account in no_trades_accounts:
-                await account.fetch_related('user')
-                txt = await self.no_trades_txt_template.render_async(account=account)
-                html = await self.no_trades_html_template.render_async(account=account)
-                trades_mail = await TradesMail.create(
-                    account=account,
-                    subject=f"Trades for {datetime.date.today()}",
-                    body=txt,
-                    html=html
-                )
-                self.mails.append(trades_mail)
+            no_trades_accounts = await Account.filter(
+                id__in=subscribed_account_ids
+            ).exclude(id__in=list(account_trades)).select_related('user')
+            mails += await asyncio.gather(*[self.render_no_trades_mail(account) for account in no_trades_accounts])
+        await self.save_mails(mails)
         await self.send_mails()
 
 
@@ -160,11 +179,9 @@ class PositionsMailer(BaseMailer):
         self.txt_template = self.jinja_env.get_template("positions.txt")
         self.html_template = self.jinja_env.get_template("positions.html")
 
-    async def run_for_account(self, account: Account):
-        long_positions = await Position.filter(subscription__account=account, active=True, side=TradeSide.BUY).select_related('instrument')
-        short_positions = await Position.filter(subscription__account=account, active=True, side=TradeSide.SELL).select_related('instrument')
-        long_positions = [(await self.get_symbol(pos.instrument), pos) for pos in long_positions]
-        short_positions = [(await self.get_symbol(pos.instrument), pos) for pos in short_positions]
+    async def render_positions_mail(self, account: Account, positions: List[Position], symbols: Dict[int, str]) -> TradesMail:
+        long_positions = [(symbols[pos.instrument_id], pos) for pos in positions if pos.side == TradeSide.BUY]
+        short_positions = [(symbols[pos.instrument_id], pos) for pos in positions if pos.side == TradeSide.SELL]
         today = datetime.date.today()
         txt = await self.txt_template.render_async(
             long_positions=long_positions,
@@ -178,57 +195,58 @@ class PositionsMailer(BaseMailer):
             account=account,
             date=today
         )
-        trades_mail = await TradesMail.create(
-            account=account,
-            subject=f"Positions for {today}",
-            body=txt,
-            html=html
-        )
-        self.mails.append(trades_mail)
+        return TradesMail(account=account, subject=f"Positions for {today}", body=txt, html=html)
+
+    async def run_for_account(self, account: Account):
+        positions = await Position.filter(subscription__account=account, active=True).order_by('id')
+        symbols = await get_instrument_cache().get_symbols(pos.instrument_id for pos in positions)
+        await self.save_mails([await self.render_positions_mail(account, positions, symbols)])
 
     async def run(self):
         account_ids = await Subscription.filter(active=True).values_list('account_id', flat=True)
         accounts = await Account.filter(id__in=account_ids).select_related('user')
-        for account in accounts:
-            await self.run_for_account(account)
+        positions = await Position.filter(
+            subscription__account_id__in=[account.id for account in accounts], active=True
+        ).order_by('id').select_related('subscription')
+        symbols = await get_instrument_cache().get_symbols(pos.instrument_id for pos in positions)
+        account_positions: Dict[int, List[Position]] = {}
+        for pos in positions:
+            account_positions.setdefault(pos.subscription.account_id, []).append(pos)
+        mails = await asyncio.gather(*[
+            self.render_positions_mail(account, account_positions.get(account.id, []), symbols) for account in accounts
+        ])
+        await self.save_mails(list(mails))
         await self.send_mails()
 
 
 class PnlMailer(BaseMailer):
 
-    def __init__(self) -> None:
+    def __init__(self, workers: int = PNL_REPORT_WORKERS) -> None:
         super().__init__()
-        self.attachments: List[Tuple[Account, BytesIO]] = []
+        self.workers = workers
 
     async def run(self):
         account_ids = await Subscription.filter(active=True).values_list('account_id', flat=True)
-        accounts = await Account.filter(id__in=account_ids)
-        for account in accounts:
-            fp = await PnlSave.generate_pnl_excel(account)
-            self.attachments.append((account, fp))
-        await self.send_mails()
+        accounts = {account.id: account for account in await Account.filter(id__in=account_ids)}
+        reports = [await PnlSave.get_pnl_report(account) for account in accounts.values()]
+        mail_transport = get_mail_transport()
+        async for report, excel in build_pnl_excels(reports, self.workers):
+            await mail_transport.send_message(self.get_message(accounts[report['account_id']], excel))
 
-    async def send_mails(self):
-        smtp = SMTP("smtp-relay.gmail.com", 587)
-        await smtp.connect()
-        await smtp.ehlo()
-        await smtp.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+    def get_message(self, account: Account, excel: bytes) -> EmailMessage:
         today = datetime.date.today()
-        for account, fp in self.attachments:
-            await account.fetch_related('user')
-            msg = EmailMessage()
-            # emails = await AccountEmail.filter(account=account).values_list('email', flat=True)
-            # msg['To'] = account.user.email
-            # msg['CC'] = ",".join(emails)
-            msg['To'] = settings.FROM_EMAIL
-            msg['CC'] = ",".join(settings.DEFAULT_RECEIVERS)
-            msg['From'] = settings.FROM_EMAIL
-            msg['Subject'] = f"PnL for {today}"
-            msg.set_content(f"PFA PnL for {account.name}")
-            msg.add_attachment(fp.read(), maintype="application", subtype="xlsx", filename=f"PnL_{account.name}_{today}.xlsx")
-            msg['Message-ID'] = make_msgid(domain="algonauts.in")
-            await smtp.send_message(msg)
-        smtp.close()
+        msg = EmailMessage()
+        # emails = await AccountEmail.filter(account=account).values_list('email', flat=True)
+        # msg['To'] = account.user.email
+        # msg['CC'] = ",".join(emails)
+        msg['To'] = settings.FROM_EMAIL
+        msg['CC'] = ",".join(settings.DEFAULT_RECEIVERS)
+        msg['From'] = settings.FROM_EMAIL
+        msg['Subject'] = f"PnL for {today}"
+        msg.set_content(f"PFA PnL for {account.name}")
+        msg.add_attachment(excel, maintype="application", subtype="xlsx", filename=f"PnL_{account.name}_{today}.xlsx")
+        msg['Message-ID'] = make_msgid(domain="algonauts.in")
+        return msg
 
 
 class ShadowPositionsMailer(BaseMailer):
@@ -243,10 +261,6 @@ class ShadowPositionsMailer(BaseMailer):
         await self.send_mails()
 
     async def send_mails(self):
-        smtp = SMTP("smtp-relay.gmail.com", 587)
-        await smtp.connect()
-        await smtp.ehlo()
-        await smtp.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
         today = datetime.date.today()
         msg = EmailMessage()
         msg['To'] = settings.FROM_EMAIL
@@ -256,8 +270,7 @@ class ShadowPositionsMailer(BaseMailer):
         msg.set_content(f"PFA Shadow Positions")
         msg.add_attachment(self.attachment.read(), maintype="application", subtype="xlsx", filename="PnL.xlsx")
         msg['Message-ID'] = make_msgid(domain="algonauts.in")
-        await smtp.send_message(msg)
-        smtp.close()
+        await get_mail_transport().send_message(msg)
 
 
 class SRETradesMailer(BaseMailer):
@@ -283,10 +296,6 @@ class SRETradesMailer(BaseMailer):
         await self.send_mails()
 
     async def send_mails(self):
-        smtp = SMTP("smtp-relay.gmail.com", 587)
-        await smtp.connect()
-        await smtp.ehlo()
-        await smtp.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
         today = datetime.date.today()
         msg = EmailMessage()
         msg['To'] = settings.FROM_EMAIL
@@ -297,8 +306,7 @@ class SRETradesMailer(BaseMailer):
         txt, html = self.mails
         msg.set_content(txt)
         msg.set_content(html, subtype='html')
-        await smtp.send_message(msg)
-        smtp.close()
+        await get_mail_transport().send_message(msg)
 
 
 class ShadowTradeBasketMailer(BaseMailer):
@@ -331,18 +339,23 @@ class ShadowTradeBasketMailer(BaseMailer):
         subdatas = await SubscriptionData.filter(
             subscription_id__in=Subquery(subs_q)
         ).select_related('subscription__account', 'subscription__algo')
+        instrument_cache = get_instrument_cache()
         for sub_data in subdatas:
             account: Account = sub_data.subscription.account
             module = importlib.import_module(f'algos.{sub_data.subscription.algo.name.lower()}')
             algo_strat_class = getattr(module, sub_data.subscription.algo.name)
             algo_strat: ShadowAnalysis = algo_strat_class()
             await algo_strat.init()
+            await load_shadow_state(sub_data)
             shadow_positions: List[ShadowPosition] = sub_data.data['positions']
             longs, shorts, longs_reverse, shorts_reverse, longs_partial, shorts_partial, longs_partial_reverse, shorts_partial_reverse, ongoing_entry, ongoing_exit = [], [], [], [], [], [], [], [], [], []
+            instruments = await instrument_cache.get_instruments(
+                int(shadow_position['inst_id']) for shadow_position in shadow_positions if not shadow_position.get('exit_time')
+            )
             for shadow_position in shadow_positions:
                 if shadow_position.get('exit_time'):
                     continue
-                instrument = await Instrument.filter(id=shadow_position['inst_id']).get()
+                instrument = instruments[int(shadow_position['inst_id'])]
                 side = TradeSide(shadow_position['side'])
                 opposite_side = TradeSide.SELL if side == TradeSide.BUY else TradeSide.BUY
                 qty = await algo_strat.get_qty(instrument, account)
@@ -395,12 +408,13 @@ class ShadowTradeBasketMailer(BaseMailer):
                 active=True
             ).exclude(
                 instrument_id__in=(shadow_position['inst_id'] for shadow_position in shadow_positions)
-            ).select_related('instrument')
+            )
+            instruments = await instrument_cache.get_instruments(position.instrument_id for position in positions)
             for position in positions:
                 opposite_side = TradeSide.SELL if side == TradeSide.BUY else TradeSide.BUY
                 trade = Trade(
                     subscription=sub_data.subscription,
-                    instrument=position.instrument,
+                    instrument=instruments[position.instrument_id],
                     side=opposite_side,
                     qty=position.qty
                 )
@@ -440,13 +454,7 @@ class ShadowTradeBasketMailer(BaseMailer):
         await self.send_mails()
             
     async def send_mails(self):
-        smtp = SMTP("smtp-relay.gmail.com", 587)
-        await smtp.connect()
-        await smtp.ehlo()
-        await smtp.login(settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
-        for msg in self.mails:
-            await smtp.send_message(msg)
-        smtp.close()
+        await get_mail_transport().send_messages(self.mails)
 
 
 class TradeSplitMailer(ShadowTradeBasketMailer):
@@ -479,7 +487,10 @@ class TradeSplitMailer(ShadowTradeBasketMailer):
         today = datetime.date.today()
         trades = await Trade.filter(
             id__in=[td.id for td in trades]
-        ).select_related('instrument__future', 'subscription__account')
+        ).select_related('subscription__account')
+        instruments = await get_instrument_cache().get_instruments(td.instrument_id for td in trades)
+        for td in trades:
+            td.instrument = instruments[td.instrument_id]
         accounts = set(td.subscription.account for td in trades)
         for account in accounts:
             emails = await AccountEmail.filter(account=account).values_list('email', flat=True)
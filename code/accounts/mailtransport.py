@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from email.message import EmailMessage
+from typing import List, Optional
+from aiosmtplib import SMTP, SMTPConnectError, SMTPServerDisconnected, SMTPTimeoutError
+import settings
+
+
+SMTP_HOSTNAME = getattr(settings, 'SMTP_HOSTNAME', "smtp-relay.gmail.com")
+SMTP_PORT = getattr(settings, 'SMTP_PORT', 587)
+SMTP_POOL_SIZE = getattr(settings, 'SMTP_POOL_SIZE', 2)
+SMTP_RETRIES = 2
+
+
+class MailTransport:
+
+    def __init__(self, hostname: str, port: int, username: Optional[str] = None, password: Optional[str] = None, size: int = SMTP_POOL_SIZE, retries: int = SMTP_RETRIES) -> None:
+        self.hostname = hostname
+        self.port = port
+        self.username = username or None
+        self.password = password or None
+        self.size = size
+        self.retries = retries
+        self._idle: List[SMTP] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _bind(self):
+        ##
+        # Connections and the semaphore belong to the loop they were made on,
+        # a new loop starts with an empty pool.
+        ##
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._idle = []
+            self._slots = asyncio.Semaphore(self.size)
+
+    async def _acquire(self) -> SMTP:
+        while self._idle:
+            smtp = self._idle.pop()
+            if smtp.is_connected:
+                return smtp
+        smtp = SMTP(hostname=self.hostname, port=self.port, username=self.username, password=self.password)
+        await smtp.connect()
+        return smtp
+
+    async def send_message(self, msg: EmailMessage):
+        ##
+        # Idle connections may have been dropped by the relay since their last
+        # use, so a failed connect or disconnect is retried on a fresh
+        # connection. A connection only goes back to the pool after a send
+        # succeeded, any other error closes it.
+        ##
+        self._bind()
+        async with self._slots:
+            for attempt in range(self.retries + 1):
+                smtp = None
+                response = None
+                try:
+                    smtp = await self._acquire()
+                    response = await smtp.send_message(msg)
+                except (SMTPServerDisconnected, SMTPConnectError, SMTPTimeoutError, ConnectionError):
+                    if attempt == self.retries:
+                        raise
+                    continue
+                finally:
+                    if smtp is not None:
+                        if response is None:
+                            smtp.close()
+                        else:
+                            self._idle.append(smtp)
+                return response
+
+    async def send_messages(self, msgs: List[EmailMessage]):
+        results = await asyncio.gather(*[self.send_message(msg) for msg in msgs], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for msg, result in zip(msgs, results):
+            if isinstance(result, Exception):
+                logging.error(f"Error in sending mail {msg['Subject']} to {msg['To']}", exc_info=result)
+        if errors:
+            raise errors[0]
+        return results
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for smtp in idle:
+            try:
+                await smtp.quit()
+            except Exception:
+                smtp.close()
+
+
+_mail_transport: Optional[MailTransport] = None
+
+
+def get_mail_transport() -> MailTransport:
+    global _mail_transport
+    if _mail_transport is None:
+        _mail_transport = MailTransport(SMTP_HOSTNAME, SMTP_PORT, settings.SMTP_USERNAME, settings.SMTP_PASSWORD)
+    return _mail_transport
+
+
+def set_mail_transport(mail_transport: Optional[MailTransport]):
+    global _mail_transport
+    _mail_transport = mail_transport
@@ -1,49 +1,229 @@
+import asyncio
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from decimal import Decimal
 from io import BytesIO
 from itertools import repeat
 import logging
+import multiprocessing
+import os
+from typing import AsyncIterator, Dict, List, Tuple
 import numpy as np
 from xlsxwriter import Workbook, worksheet
 import pandas as pd
+from accounts.pnlrollup import ensure_pnl_rollup, get_daily_totals, get_monthly_totals, rollup_pnl
 from algos.basealgo import BaseAlgo
-from database.models import Account, Instrument, Investment, Ltp, PnL, Position, Subscription, SubscriptionData, TradeExit, TradeSide
+from algos.shadowstore import load_shadow_state
+from database.models import Account, Instrument, Investment, Ltp, PnL, PnlRollup, Position, Subscription, SubscriptionData, TradeExit, TradeSide
 from tortoise.functions import Sum
-from tortoise.expressions import F, Subquery, Q
-from pypika.functions import Extract
+from tortoise.expressions import Subquery, Q
+from tortoise.transactions import in_transaction
+import settings
 
 
+PNL_REPORT_WORKERS = getattr(settings, 'PNL_REPORT_WORKERS', 1)
+
+
+def build_pnl_excel(report: Dict) -> bytes:
+    ##
+    # Only pandas and xlsxwriter work on the data read by get_pnl_report, so
+    # reports can be built in worker processes.
+    ##
+    def create_df(data):
+        df = pd.DataFrame(data)
+        if df.empty:
+            return df
+        df['entry_time'] = df['entry_time'].dt.tz_convert('Asia/Kolkata').dt.tz_localize(None).dt.round(freq='s')
+        if 'exit_time' in df.columns:
+            df['exit_time'] = df['exit_time'].dt.tz_convert('Asia/Kolkata').dt.tz_localize(None).dt.round(freq='s')
+        df['side'] = df['side'].apply(lambda side: "LONG" if side == TradeSide.BUY else "SHORT")
+        df['stock_name'] = df['future_stock_name'].fillna(df['option_stock_name'])
+        df['expiry'] = df['future_expiry'].fillna(df['option_expiry'])
+        df['expiry'] = pd.to_datetime(df['expiry'])
+        if 'exit_time' in df.columns:
+            df = df[['stock_name', 'strike', 'expiry', 'qty', 'buy_price', 'sell_price', 'side', 'charges', 'pnl', 'entry_time', 'exit_time']]
+        else:
+            df = df[['stock_name', 'strike', 'expiry', 'qty', 'buy_price', 'sell_price', 'side', 'charges', 'cmp', 'mtm', 'entry_time']]
+        return df
+
+    today: datetime.date = report['today']
+    df_open = create_df(report['open'])
+    df_closed = create_df(report['closed'])
+    try:
+        expiry_mask = df_closed['expiry'].dropna().dt.year.round().astype('str') + '-' + df_closed['expiry'].dt.strftime("%b")
+    except KeyError:
+        expiry_mask = pd.Series()
+    sheet_names = expiry_mask.unique()
+    sheet_names = sorted(sheet_names, key= lambda month_year: datetime.datetime.strptime(month_year[-3:], "%b").month, reverse=True)
+    sheet_names.insert(0, "Summary")
+    if not df_open.empty:
+        sheet_names.insert(1, "OpenPositions")
+    fp = BytesIO()
+    try:
+        with pd.ExcelWriter(fp, engine='xlsxwriter', engine_kwargs={'options': {'strings_to_numbers': True}}) as excel:
+            summary = {
+                expiry_month.strftime("%Y-%b"): returns
+                for expiry_month, returns in sorted(report['monthly_totals'].items(), reverse=True)
+            }
+            last_row_idxs = {}
+            for sheet_name in sheet_names:
+                excel.book.add_worksheet(sheet_name)
+            if not df_open.empty:
+                last_row = ["TOTAL", '-', '-', '-', '-', '-', '-', df_open['charges'].sum(), '-', df_open['mtm'].sum(), '-']
+                df_open.loc[df_open.shape[0]] = last_row
+                sheet_name = "OpenPositions"
+                df_open.to_excel(excel, sheet_name=sheet_name, index=False)
+                last_row_idxs[sheet_name] = df_open.shape[0]
+                sheet_names = sheet_names[2:]
+            else:
+                sheet_names = sheet_names[1:]
+            for expiry in sheet_names:
+                df: pd.DataFrame = df_closed[expiry == expiry_mask].reset_index(drop=True)
+                charges = df['charges'].sum()
+                pnl = df['pnl'].sum()
+                last_row = ["TOTAL", '-', '-', '-', '-', '-', '-', charges, pnl, '-', '-']
+                df.loc[df.shape[0]] = last_row
+                last_row_idxs[expiry] = df.shape[0]
+                df.to_excel(excel, sheet_name=expiry, index=False)
+            wb: Workbook = excel.book
+            num_format = wb.add_format({'num_format': "#,##0.00"})
+            bold_format = wb.add_format()
+            bold_format.set_bold()
+            sheets = wb.sheetnames
+            for sheet_name, ws in sheets.items():
+                if sheet_name == "OpenPositions":
+                    cols = "BCDFGH"
+                elif sheet_name == "Summary":
+                    continue
+                else:
+                    cols = "BCDFG"
+                for letter in cols:
+                    ws.set_column(f"{letter}:{letter}", None, num_format)
+                last_row: int = last_row_idxs[sheet_name]
+                ws.set_row(last_row, None, bold_format)
+            day_wise_data = report['day_wise']
+            days = len(day_wise_data)
+            cols = days + 1
+            this_month = today.strftime("%Y-%b")
+            blank_row = np.repeat("", cols)
+            days_row = [f"{data['day']}-{today.strftime('%b-%y')}" for data in day_wise_data]
+            investment: float = report['investment']
+            pnl_rows = np.array([
+                np.array(["Gross PnL", *days_row]),
+                *[np.hstack(((expiry), np.repeat(returns['pnl'], days))) for expiry, returns in summary.items() if expiry != this_month],
+                np.array([this_month, *np.array([data['sum_pnl'] for data in day_wise_data]).cumsum()])
+            ])
+            total_pnl_rows = pnl_rows[1:,1:].astype(np.int64).sum(axis=0)
+            cost_rows = np.array([
+                np.array(["Costs", *days_row]),
+                *[np.hstack(((expiry), np.repeat(returns['cost'], days))) for expiry, returns in summary.items() if expiry != this_month],
+                np.array([this_month, *np.array([data['sum_charges'] for data in day_wise_data]).cumsum()])
+            ])
+            total_cost_rows = cost_rows[1:,1:].astype(np.int64).sum(axis=0)
+            roi_rows = np.array([
+                np.array(["", *days_row]),
+                np.array(["Investment", *np.repeat(investment, days)]),
+                np.array(["Net Profit", *(total_pnl_rows - total_cost_rows)]),
+                np.array(["ROI", *((total_pnl_rows - total_cost_rows) * 100 / investment)]),
+            ])
+            rows = np.array([
+                blank_row,
+                *pnl_rows,
+                np.array(["Total", *total_pnl_rows]),
+                blank_row,
+                blank_row,
+                *cost_rows,
+                np.array(["Total", *total_cost_rows]),
+                blank_row,
+                blank_row,
+                *roi_rows
+            ])
+            ws: worksheet.Worksheet = wb.sheetnames["Summary"]
+            for i, row in enumerate(rows):
+                ws.write_row(i, 0, row)
+    except Exception as ex:
+        logging.error(f"Error in pnl generation for {report['account_id']}-{report['account_name']}", exc_info=ex)
+    return fp.getvalue()
+
+
+
+async def build_pnl_excels(reports: List[Dict], workers: int = PNL_REPORT_WORKERS) -> AsyncIterator[Tuple[Dict, bytes]]:
+    ##
+    # Yields the reports in the order they finish, so the caller can send one
+    # while the rest are still being built. Workers are spawned rather than
+    # forked, a fork would copy the running loop and its open db sockets.
+    # Lambda has no /dev/shm for a process pool, threads at least keep the
+    # event loop free there.
+    ##
+    if workers <= 1 or len(reports) <= 1:
+        for report in reports:
+            yield report, build_pnl_excel(report)
+        return
+    loop = asyncio.get_running_loop()
+    workers = min(workers, len(reports))
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    except OSError as ex:
+        logging.error("Process pool unavailable for pnl reports, using threads", exc_info=ex)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def build(report: Dict) -> Tuple[Dict, bytes]:
+        try:
+            excel = await loop.run_in_executor(executor, build_pnl_excel, report)
+        except BrokenProcessPool as ex:
+            logging.error(f"Process pool broke on pnl report for {report['account_id']}", exc_info=ex)
+            excel = await loop.run_in_executor(None, build_pnl_excel, report)
+        return report, excel
+
+    with executor:
+        for built in asyncio.as_completed([build(report) for report in reports]):
+            yield await built
+
 class PnlSave:
 
     async def save_eod_price(self):
-        positions = await Position.filter(active=True).select_related('instrument')
-        for position in positions:
-            ltp = await Ltp.filter(instrument=position.instrument).get()
-            position.eod_price = Decimal(ltp.price)
-            if position.buy_price:
-                position.charges = (
-                    BaseAlgo.charges_calculate(position.qty, position.buy_price, TradeSide.BUY)
-                    + BaseAlgo.charges_calculate(position.qty, position.eod_price, TradeSide.SELL)
-                )
-            else:
-                position.charges = (
-                    BaseAlgo.charges_calculate(position.qty, position.sell_price, TradeSide.SELL)
-                    + BaseAlgo.charges_calculate(position.qty, position.eod_price, TradeSide.BUY)
-                )
+        ##
+        # Two reads and one batched write for the whole book. Charges are
+        # computed for all positions at once, pnl stays in Decimal so both
+        # round exactly as the per position save used to.
+        ##
+        positions = await Position.filter(active=True)
+        ltps = dict(await Ltp.filter(
+            instrument_id__in=Subquery(Position.filter(active=True).values('instrument_id'))
+        ).values_list('instrument_id', 'price'))
+        missing = [position for position in positions if position.instrument_id not in ltps]
+        for position in missing:
+            logging.error(f"Ltp not found for position {position.id}, instrument {position.instrument_id}")
+        positions = [position for position in positions if position.instrument_id in ltps]
+        if not positions:
+            return
+        qty = np.array([position.qty for position in positions])
+        bought = np.array([bool(position.buy_price) for position in positions])
+        entry_price = np.array([float(position.buy_price if position.buy_price else position.sell_price) for position in positions])
+        eod_price = np.array([ltps[position.instrument_id] for position in positions], dtype=float)
+        entry_charges = BaseAlgo.charges_calculate_array(qty, entry_price, ~bought).tolist()
+        exit_charges = BaseAlgo.charges_calculate_array(qty, eod_price, bought).tolist()
+        for position, price, entry_charge, exit_charge in zip(positions, eod_price.tolist(), entry_charges, exit_charges):
+            position.eod_price = Decimal(price)
+            position.charges = Decimal(entry_charge) + Decimal(exit_charge)
             if position.side == TradeSide.BUY:
                 position.pnl = (position.eod_price - position.buy_price) * position.qty
             else:
                 position.pnl = (position.sell_price - position.eod_price) * position.qty
-            await position.save()
+        async with in_transaction():
+            await Position.bulk_update(positions, ['eod_price', 'charges', 'pnl'], batch_size=1000)
 
     async def save_pnl(self, account: Account):
         investment = (await Investment.filter(
             account=account
         ).annotate(sum=Sum('amount')).first().values('sum'))['sum']
-        subs_q = Subscription.filter(account=account).values('id')
-        positions = Position.filter(subscription_id__in=Subquery(subs_q))
-        realised_pnl = await positions.filter(active=False).annotate(sum=Sum('pnl')).first().values_list('sum', flat=True) or 0
-        unrealised_pnl = await positions.filter(active=True).annotate(sum=Sum('pnl')).first().values_list('sum', flat=True) or 0
+        await ensure_pnl_rollup()
+        rollups = PnlRollup.filter(account=account)
+        realised_pnl = await rollups.annotate(sum=Sum('realised')).first().values_list('sum', flat=True) or 0
+        unrealised_pnl = await rollups.filter(
+            date=datetime.date.today()
+        ).annotate(sum=Sum('unrealised')).first().values_list('sum', flat=True) or 0
         await PnL.update_or_create(
             account=account,
             date=datetime.date.today(),
@@ -55,7 +235,13 @@ class PnlSave:
         )
 
     @staticmethod
-    async def generate_pnl_excel(account: Account):
+    async def get_pnl_report(account: Account) -> Dict:
+        ##
+        # Only trades of contracts expiring this month or later get detail
+        # sheets. Older months and the day wise totals come from pnlrollup.
+        ##
+        today = datetime.date.today()
+        month_start = today.replace(day=1)
         trade_exits = TradeExit.filter(position__subscription__account=account)
         opens_data = await trade_exits.filter(position__active=True).values(
             future_stock_name = 'position__instrument__future__stock__ticker',
@@ -72,7 +258,10 @@ class PnlSave:
             mtm = 'position__pnl',
             entry_time = 'entry_trade__timestamp',
         )
-        closed_data = await trade_exits.filter(position__active=False).values(
+        closed_data = await trade_exits.filter(
+            Q(position__instrument__future__expiry__gte=month_start) | Q(position__instrument__option__expiry__gte=month_start),
+            position__active=False
+        ).values(
             future_stock_name = 'position__instrument__future__stock__ticker',
             option_stock_name = 'position__instrument__option__stock__ticker',
             strike = 'position__instrument__option__strike',
@@ -88,129 +277,23 @@ class PnlSave:
             exit_time = 'exit_trade__timestamp',
         )
 
-        def create_df(data):
-            df = pd.DataFrame(data)
-            if df.empty:
-                return df
-            df['entry_time'] = df['entry_time'].dt.tz_convert('Asia/Kolkata').dt.tz_localize(None).dt.round(freq='s')
-            if 'exit_time' in df.columns:
-                df['exit_time'] = df['exit_time'].dt.tz_convert('Asia/Kolkata').dt.tz_localize(None).dt.round(freq='s')
-            df['side'] = df['side'].apply(lambda side: "LONG" if side == TradeSide.BUY else "SHORT")
-            df['stock_name'] = df['future_stock_name'].fillna(df['option_stock_name'])
-            df['expiry'] = df['future_expiry'].fillna(df['option_expiry'])
-            df['expiry'] = pd.to_datetime(df['expiry'])
-            if 'exit_time' in df.columns:
-                df = df[['stock_name', 'strike', 'expiry', 'qty', 'buy_price', 'sell_price', 'side', 'charges', 'pnl', 'entry_time', 'exit_time']]
-            else:
-                df = df[['stock_name', 'strike', 'expiry', 'qty', 'buy_price', 'sell_price', 'side', 'charges', 'cmp', 'mtm', 'entry_time']]
-            return df
+        investment = await Investment.filter(account=account).annotate(
+            sum_investment=Sum('amount')
+        ).first().values_list('sum_investment', flat=True)
+        return dict(
+            account_id=account.id,
+            account_name=account.name,
+            today=today,
+            open=opens_data,
+            closed=closed_data,
+            monthly_totals=await get_monthly_totals(account.id),
+            day_wise=await get_daily_totals(account.id, month_start),
+            investment=investment
+        )
 
-        df_open = create_df(opens_data)
-        df_closed = create_df(closed_data)
-        try:
-            expiry_mask = df_closed['expiry'].dropna().dt.year.round().astype('str') + '-' + df_closed['expiry'].dt.strftime("%b")
-        except KeyError:
-            expiry_mask = pd.Series()
-        sheet_names = expiry_mask.unique()
-        sheet_names = sorted(sheet_names, key= lambda month_year: datetime.datetime.strptime(month_year[-3:], "%b").month, reverse=True)
-        sheet_names.insert(0, "Summary")
-        if not df_open.empty:
-            sheet_names.insert(1, "OpenPositions")
-        fp = BytesIO()
-        try:
-            with pd.ExcelWriter(fp, engine='xlsxwriter', engine_kwargs={'options': {'strings_to_numbers': True}}) as excel:
-                summary = {}
-                last_row_idxs = {}
-                for sheet_name in sheet_names:
-                    excel.book.add_worksheet(sheet_name)
-                if not df_open.empty:
-                    last_row = ["TOTAL", '-', '-', '-', '-', '-', '-', df_open['charges'].sum(), '-', df_open['mtm'].sum(), '-']
-                    df_open.loc[df_open.shape[0]] = last_row
-                    sheet_name = "OpenPositions"
-                    df_open.to_excel(excel, sheet_name=sheet_name, index=False)
-                    last_row_idxs[sheet_name] = df_open.shape[0]
-                    sheet_names = sheet_names[2:]
-                else:
-                    sheet_names = sheet_names[1:]
-                for expiry in sheet_names:
-                    df: pd.DataFrame = df_closed[expiry == expiry_mask].reset_index(drop=True)
-                    charges = df['charges'].sum()
-                    pnl = df['pnl'].sum()
-                    last_row = ["TOTAL", '-', '-', '-', '-', '-', '-', charges, pnl, '-', '-']
-                    df.loc[df.shape[0]] = last_row
-                    last_row_idxs[expiry] = df.shape[0]
-                    df.to_excel(excel, sheet_name=expiry, index=False)
-                    summary[expiry] = {'cost': charges, 'pnl': pnl}
-                wb: Workbook = excel.book
-                num_format = wb.add_format({'num_format': "#,##0.00"})
-                bold_format = wb.add_format()
-                bold_format.set_bold()
-                sheets = wb.sheetnames
-                for sheet_name, ws in sheets.items():
-                    if sheet_name == "OpenPositions":
-                        cols = "BCDFGH"
-                    elif sheet_name == "Summary":
-                        continue
-                    else:
-                        cols = "BCDFG"
-                    for letter in cols:
-                        ws.set_column(f"{letter}:{letter}", None, num_format)
-                    last_row: int = last_row_idxs[sheet_name]
-                    ws.set_row(last_row, None, bold_format)
-                today = datetime.date.today()
-                day_wise_data = await TradeExit.filter(
-                    position__subscription__account=account,
-                    exit_trade__timestamp__gt=today.replace(day=1)
-                ).annotate(
-                    sum_pnl=Sum('position__pnl'),
-                    sum_charges=Sum('position__charges'),
-                    day=Extract("DAY", F("tradeexit__exit_trade\".\"timestamp"))
-                ).group_by('day').order_by('day').values('day', 'sum_pnl', 'sum_charges')
-                days = len(day_wise_data)
-                cols = days + 1
-                this_month = today.strftime("%Y-%b")
-                blank_row = np.repeat("", cols)
-                days_row = [f"{data['day']}-{today.strftime('%b-%y')}" for data in day_wise_data]
-                investment: float = await Investment.filter(account=account).annotate(
-                    sum_investment=Sum('amount')
-                ).first().values_list('sum_investment', flat=True)
-                pnl_rows = np.array([
-                    np.array(["Gross PnL", *days_row]),
-                    *[np.hstack(((expiry), np.repeat(returns['pnl'], days))) for expiry, returns in summary.items() if expiry != this_month],
-                    np.array([this_month, *np.array([data['sum_pnl'] for data in day_wise_data]).cumsum()])
-                ])
-                total_pnl_rows = pnl_rows[1:,1:].astype(np.int64).sum(axis=0)
-                cost_rows = np.array([
-                    np.array(["Costs", *days_row]),
-                    *[np.hstack(((expiry), np.repeat(returns['cost'], days))) for expiry, returns in summary.items() if expiry != this_month],
-                    np.array([this_month, *np.array([data['sum_charges'] for data in day_wise_data]).cumsum()])
-                ])
-                total_cost_rows = cost_rows[1:,1:].astype(np.int64).sum(axis=0)
-                roi_rows = np.array([
-                    np.array(["", *days_row]),
-                    np.array(["Investment", *np.repeat(investment, days)]),
-                    np.array(["Net Profit", *(total_pnl_rows - total_cost_rows)]),
-                    np.array(["ROI", *((total_pnl_rows - total_cost_rows) * 100 / investment)]),
-                ])
-                rows = np.array([
-                    blank_row,
-                    *pnl_rows,
-                    np.array(["Total", *total_pnl_rows]),
-                    blank_row,
-                    blank_row,
-                    *cost_rows,
-                    np.array(["Total", *total_cost_rows]),
-                    blank_row,
-                    blank_row,
-                    *roi_rows
-                ])
-                ws: worksheet.Worksheet = wb.sheetnames["Summary"]
-                for i, row in enumerate(rows):
-                    ws.write_row(i, 0, row)
-        except Exception as ex:
-            logging.error(f"Error in pnl generation for {account.id}-{account.name}", exc_info=ex)
-        fp.seek(0)
-        return fp
+    @staticmethod
+    async def generate_pnl_excel(account: Account) -> BytesIO:
+        return BytesIO(build_pnl_excel(await PnlSave.get_pnl_report(account)))
 
     @staticmethod
     async def generate_shadow_positions_excel():
@@ -221,6 +304,8 @@ class PnlSave:
             for account in accounts:
                 subscription = await Subscription.filter(account=account, is_hedge=False).get()
                 sub_data = await SubscriptionData.filter(subscription=subscription).get_or_none()
+                if sub_data:
+                    await load_shadow_state(sub_data)
                 if sub_data and 'positions' in sub_data.data:
                     df = pd.DataFrame(sub_data.data['positions'])
                     df['inst_id'] = df['inst_id'].astype('int')
@@ -237,6 +322,7 @@ class PnlSave:
 
     async def run(self):
         await self.save_eod_price()
+        await rollup_pnl()
         account_ids = await Subscription.filter(active=True).values_list('account_id', flat=True)
         accounts = await Account.filter(id__in=account_ids)
         for account in accounts:
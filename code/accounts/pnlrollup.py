@@ -0,0 +1,124 @@
+import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from database.models import PnlRollup, Position, Subscription, TradeExit
+from database.utils import bulk_upsert
+from tortoise.transactions import in_transaction
+
+
+RollupKey = Tuple[int, datetime.date, datetime.date]
+
+
+def get_expiry_month(expiry: Optional[datetime.date], date: datetime.date) -> datetime.date:
+    return (expiry or date).replace(day=1)
+
+
+def _rollup(rollups: Dict[RollupKey, PnlRollup], account_id: int, date: datetime.date, expiry: Optional[datetime.date]) -> PnlRollup:
+    key = (account_id, date, get_expiry_month(expiry, date))
+    if key not in rollups:
+        rollups[key] = PnlRollup(
+            account_id=account_id, date=date, expiry_month=key[2],
+            realised=Decimal(0), unrealised=Decimal(0), charges=Decimal(0)
+        )
+    return rollups[key]
+
+
+async def _rollup_realised(since: datetime.date, account_ids: Optional[List[int]] = None):
+    trade_exits = TradeExit.filter(
+        position__active=False,
+        exit_trade__timestamp__gte=datetime.datetime.combine(since, datetime.time())
+    )
+    rollups = PnlRollup.filter(date__gte=since)
+    if account_ids is not None:
+        trade_exits = trade_exits.filter(position__subscription__account_id__in=account_ids)
+        rollups = rollups.filter(account_id__in=account_ids)
+    closed = await trade_exits.values_list(
+        'position__subscription__account_id', 'exit_trade__timestamp',
+        'position__instrument__future__expiry', 'position__instrument__option__expiry',
+        'position__pnl', 'position__charges'
+    )
+    realised: Dict[RollupKey, PnlRollup] = {}
+    for account_id, timestamp, future_expiry, option_expiry, pnl, charges in closed:
+        rollup = _rollup(realised, account_id, timestamp.date(), future_expiry or option_expiry)
+        rollup.realised += Decimal(pnl)
+        rollup.charges += Decimal(charges)
+    await rollups.update(realised=0, charges=0)
+    await bulk_upsert(PnlRollup, list(realised.values()), ['account_id', 'date', 'expiry_month'], ['realised', 'charges'])
+
+
+async def record_closed_positions(positions: Iterable[Position]):
+    ##
+    # Recomputes today's realised pnl of the accounts whose positions just
+    # closed, so recording the same closures twice does no harm.
+    ##
+    positions = [position for position in positions if not position.active]
+    if not positions or await ensure_pnl_rollup():
+        return
+    account_ids = await Subscription.filter(
+        id__in={position.subscription_id for position in positions}
+    ).distinct().values_list('account_id', flat=True)
+    async with in_transaction():
+        await _rollup_realised(datetime.date.today(), list(account_ids))
+
+
+async def rollup_pnl(since: Optional[datetime.date] = None):
+    ##
+    # Rebuilds realised pnl and charges of every day from `since` out of the
+    # exit trades and snapshots today's unrealised pnl from the active
+    # positions. Defaults to today only, or to the first exit trade while the
+    # table is still empty. Pass an early date to backfill.
+    ##
+    today = datetime.date.today()
+    if since is None and not await PnlRollup.exists():
+        first_exit = await TradeExit.filter(
+            exit_trade_id__isnull=False
+        ).order_by('exit_trade__timestamp').first().values_list('exit_trade__timestamp', flat=True)
+        since = first_exit.date() if first_exit else None
+    since = since or today
+    active = await Position.filter(active=True).values_list(
+        'subscription__account_id', 'instrument__future__expiry', 'instrument__option__expiry', 'pnl'
+    )
+    unrealised: Dict[RollupKey, PnlRollup] = {}
+    for account_id, future_expiry, option_expiry, pnl in active:
+        _rollup(unrealised, account_id, today, future_expiry or option_expiry).unrealised += Decimal(pnl)
+    async with in_transaction():
+        await _rollup_realised(since)
+        await PnlRollup.filter(date=today).update(unrealised=0)
+        await bulk_upsert(PnlRollup, list(unrealised.values()), ['account_id', 'date', 'expiry_month'], ['unrealised'])
+
+
+async def ensure_pnl_rollup() -> bool:
+    ##
+    # pnlrollup starts out empty. Whoever touches it first rebuilds it from
+    # the trades, so nothing reads or adds to a table missing past closures.
+    ##
+    if await PnlRollup.exists():
+        return False
+    await rollup_pnl()
+    return True
+
+
+async def get_monthly_totals(account_id: int, expiry_months: Optional[List[datetime.date]] = None) -> Dict[datetime.date, Dict[str, Decimal]]:
+    await ensure_pnl_rollup()
+    rollups = PnlRollup.filter(account_id=account_id).exclude(realised=0, charges=0)
+    if expiry_months is not None:
+        rollups = rollups.filter(expiry_month__in=expiry_months)
+    totals = {}
+    for expiry_month, realised, charges in await rollups.order_by('expiry_month').values_list('expiry_month', 'realised', 'charges'):
+        total = totals.setdefault(expiry_month, {'pnl': Decimal(0), 'cost': Decimal(0)})
+        total['pnl'] += Decimal(realised)
+        total['cost'] += Decimal(charges)
+    return totals
+
+
+async def get_daily_totals(account_id: int, since: datetime.date) -> List[Dict]:
+    await ensure_pnl_rollup()
+    totals = {}
+    rollups = await PnlRollup.filter(
+        account_id=account_id, date__gte=since
+    ).exclude(realised=0, charges=0).order_by('date').values_list('date', 'realised', 'charges')
+    for date, realised, charges in rollups:
+        total = totals.setdefault(date, {'day': date.day, 'sum_pnl': Decimal(0), 'sum_charges': Decimal(0)})
+        total['sum_pnl'] += Decimal(realised)
+        total['sum_charges'] += Decimal(charges)
+    return list(totals.values())
@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from database.models import Instrument
+import settings
+
+
+SYMBOL_CACHE_SIZE = getattr(settings, 'SYMBOL_CACHE_SIZE', 4096)
+SYMBOL_CACHE_SECONDS = getattr(settings, 'SYMBOL_CACHE_SECONDS', 60 * 60)
+
+
+def format_symbol(instrument: Instrument) -> str:
+    if instrument.stock:
+        return instrument.stock.ticker
+    elif instrument.future:
+        return f"{instrument.future.stock.ticker} {instrument.future.expiry.strftime('%b')} FUT"
+    else:
+        return f"{instrument.option.stock.ticker} {instrument.option.strike} {instrument.option.expiry} {instrument.option.option_type.value}"
+
+
+class InstrumentCache:
+    ##
+    # Instruments are kept with their stock, future and option loaded, along
+    # with their display symbol. Tickers change on renames and instrument
+    # syncs, so entries are reloaded after `ttl` seconds and the cache is
+    # cleared at the start of every Lambda run. Least recently used ones are
+    # dropped past size.
+    ##
+
+    def __init__(self, size: int = SYMBOL_CACHE_SIZE, ttl: float = SYMBOL_CACHE_SECONDS) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, Instrument, str]]" = OrderedDict()
+
+    async def _load(self, inst_ids: Iterable[int]) -> Dict[int, Tuple[Instrument, str]]:
+        entries = {}
+        missing = []
+        now = time.monotonic()
+        for inst_id in set(inst_ids):
+            entry = self._entries.get(inst_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(inst_id)
+                entries[inst_id] = entry[1:]
+            else:
+                missing.append(inst_id)
+        if missing:
+            instruments = await Instrument.filter(id__in=missing).prefetch_related('stock', 'future__stock', 'option__stock')
+            for instrument in instruments:
+                entries[instrument.id] = (instrument, format_symbol(instrument))
+                self._entries[instrument.id] = (now, *entries[instrument.id])
+                self._entries.move_to_end(instrument.id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entries
+
+    async def get_instruments(self, inst_ids: Iterable[int]) -> Dict[int, Instrument]:
+        return {inst_id: instrument for inst_id, (instrument, _) in (await self._load(inst_ids)).items()}
+
+    async def get_symbols(self, inst_ids: Iterable[int]) -> Dict[int, str]:
+        return {inst_id: symbol for inst_id, (_, symbol) in (await self._load(inst_ids)).items()}
+
+    def clear(self):
+        self._entries.clear()
+
+
+_instrument_cache: Optional[InstrumentCache] = None
+
+
+def get_instrument_cache() -> InstrumentCache:
+    global _instrument_cache
+    if _instrument_cache is None:
+        _instrument_cache = InstrumentCache()
+    return _instrument_cache
+
+
+def set_instrument_cache(instrument_cache: Optional[InstrumentCache]):
+    global _instrument_cache
+    _instrument_cache = instrument_cache
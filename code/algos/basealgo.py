@@ -6,7 +6,14 @@ import numpy as np
 from typing import Dict, List, Literal, Optional, Tuple
 from decimal import Decimal
 from database.models import *
+from database.prevclose import get_prev_close
+from database.utils import assign_ids
+from accounts.pnlrollup import record_closed_positions
+from algos.marketsnapshot import MarketSnapshot
+from algos.signals import generate_signals
+from dataaggregator.tickstore import get_tick_store
 from strategies import strategy as StrategyModule
+from tortoise.queryset import QuerySet
 from tortoise.transactions import in_transaction
 from tortoise.expressions import Subquery
 from tortoise.functions import Sum
@@ -18,9 +25,37 @@ class BaseAlgo:
     def __init__(self) -> None:
         self.trades: List[Trade] = []
         self.algo: Algo = None
+        ##
+        # With batch_writes, entries and exits are only written by flush, so
+        # until then queries on Position or Trade do not see this run's
+        # entries and still see the positions it closed as active. Algos look
+        # up open positions through active_positions, which leaves out pending
+        # closes, and check get_pending_positions for positions they may have
+        # opened in the same run.
+        ##
+        self.batch_writes = False
+        self.live_price_max_age: Optional[float] = None
+        self.strategy_executor: Optional[str] = None
+        self._pending_entries: List[Tuple[Trade, Position]] = []
+        self._pending_exits: Dict[Tuple[bool, int], Tuple[Trade, Position]] = {}
+        self._closed_positions: List[Position] = []
 
     async def init(self):
         raise NotImplementedError
+
+    async def get_live_price(self, instrument_id: int) -> Optional[float]:
+        ##
+        # Prices from the tick store are only used when live_price_max_age is
+        # set and the tick is at most that many seconds old, otherwise callers
+        # fall back to the Ltp table.
+        ##
+        if self.live_price_max_age is None:
+            return None
+        try:
+            return await get_tick_store().get_price(instrument_id, self.live_price_max_age)
+        except Exception as ex:
+            logging.error(f"Error in reading live price for {instrument_id}", exc_info=ex)
+            return None
     
     async def run(self):
         raise NotImplementedError
@@ -37,10 +72,27 @@ class BaseAlgo:
         gst = 0.18 * (brokerage + sebi + exchange)
         total_charges = brokerage + stt + exchange + stamp_duty + sebi + gst
         return Decimal(total_charges)
+
+    @staticmethod
+    def charges_calculate_array(qty: np.ndarray, price: np.ndarray, sell: np.ndarray) -> np.ndarray:
+        ##
+        # Same operations in the same order as charges_calculate, so every
+        # element is bit for bit the float it would have returned.
+        ##
+        value = np.abs(qty) * price.astype(float)
+        brokerage = 0.0001 * value
+        stt = np.where(sell, 0.000125 * value, 0.0)
+        exchange = 0.000019 * value
+        stamp_duty = np.where(sell, 0.0, 0.00002 * value)
+        sebi = (value / 10000000) * 10
+        gst = 0.18 * (brokerage + sebi + exchange)
+        return brokerage + stt + exchange + stamp_duty + sebi + gst
     
     async def entry(self, sub: Subscription, instrument: Instrument, qty: int, side: TradeSide, price: float, reversal: bool = False):
         if qty == 0:
             return
+        if self.batch_writes:
+            return self._entry_batched(sub, instrument, qty, side, price, reversal)
         trade = await Trade.create(
                 subscription=sub,
                 instrument=instrument,
@@ -73,8 +125,84 @@ class BaseAlgo:
         self.trades.append(trade)
         return trade
 
+    def _entry_batched(self, sub: Subscription, instrument: Instrument, qty: int, side: TradeSide, price: float, reversal: bool = False):
+        trade = Trade(
+            subscription=sub,
+            instrument=instrument,
+            side=side,
+            qty=qty,
+            price=price
+        )
+        position = Position(
+            subscription=sub,
+            instrument=instrument,
+            qty=qty,
+            side=side,
+            buy_price=price if side == TradeSide.BUY else None,
+            sell_price=price if side == TradeSide.SELL else None,
+            charges=self.charges_calculate(qty, price, side),
+            pnl=0.0,
+            active=True,
+            reversal=reversal
+        )
+        self._pending_entries.append((trade, position))
+        self.trades.append(trade)
+        return trade
+
+    def get_pending_positions(self, subscription_id: int, instrument_id: Optional[int] = None) -> List[Position]:
+        return [
+            position for _, position in self._pending_entries
+            if position.subscription_id == subscription_id and position.active
+            and (instrument_id is None or position.instrument_id == instrument_id)
+        ]
+
+    @staticmethod
+    def _exit_key(position: Position) -> Tuple[bool, int]:
+        ##
+        # Stored positions are keyed by id, so another instance of the same row
+        # is recognised. Positions still pending entry have no id yet.
+        ##
+        if position._saved_in_db:
+            return True, position.pk
+        return False, id(position)
+
+    def active_positions(self, **filters) -> QuerySet[Position]:
+        positions = Position.filter(active=True, **filters)
+        closing = [position_id for stored, position_id in self._pending_exits if stored]
+        if closing:
+            positions = positions.exclude(id__in=closing)
+        return positions
+
+    def _close_position(self, position: Position, price: float):
+        if position.side == TradeSide.BUY:
+            position.sell_price = Decimal(price)
+        elif position.side == TradeSide.SELL:
+            position.buy_price = Decimal(price)
+        position.charges = (
+            self.charges_calculate(position.qty, position.buy_price, TradeSide.BUY)
+            + self.charges_calculate(position.qty, position.sell_price, TradeSide.SELL)
+        )
+        position.pnl = (Decimal(position.sell_price) - Decimal(position.buy_price)) * position.qty
+        position.active = False
+
     async def exit(self, position: Position,  price: float):
         side = TradeSide.SELL if position.side == TradeSide.BUY else TradeSide.BUY
+        if self.batch_writes:
+            key = self._exit_key(position)
+            if key in self._pending_exits:
+                logging.info(f"Position {position.pk} already exited in this run")
+                return None
+            trade = Trade(
+                subscription_id=position.subscription_id,
+                instrument_id=position.instrument_id,
+                side=side,
+                qty=position.qty,
+                price=price
+            )
+            self._close_position(position, price)
+            self._pending_exits[key] = (trade, position)
+            self.trades.append(trade)
+            return trade
         await position.fetch_related('subscription', 'instrument')
         trade = await Trade.create(
             subscription=position.subscription,
@@ -86,20 +214,60 @@ class BaseAlgo:
         trade_exit = await TradeExit.filter(position=position).get()
         trade_exit.exit_trade = trade
         await trade_exit.save()
-        if position.side == TradeSide.BUY:
-            position.sell_price = Decimal(price)
-        elif position.side == TradeSide.SELL:
-            position.buy_price = Decimal(price)
-        position.charges = (
-            self.charges_calculate(position.qty, position.buy_price, TradeSide.BUY)
-            + self.charges_calculate(position.qty, position.sell_price, TradeSide.SELL)
-        )
-        position.pnl = (position.sell_price - position.buy_price) * position.qty
-        position.active = False
+        self._close_position(position, price)
         await position.save()
+        self._closed_positions.append(position)
         self.trades.append(trade)
         return trade
-    
+
+    async def record_closed(self, positions: List[Position]):
+        try:
+            await record_closed_positions(positions)
+        except Exception as ex:
+            logging.error("Error in updating pnl rollup", exc_info=ex)
+
+    async def flush(self):
+        ##
+        # Positions closed by exit without batch_writes are only added to the
+        # pnl rollup here, in one go. If flush is never called the EOD rollup
+        # picks them up from the trades.
+        ##
+        closed, self._closed_positions = self._closed_positions, []
+        if not (self._pending_entries or self._pending_exits):
+            await self.record_closed(closed)
+            return
+        entries, self._pending_entries = self._pending_entries, []
+        exits, self._pending_exits = list(self._pending_exits.values()), {}
+        async with in_transaction():
+            trades = [trade for trade, _ in entries] + [trade for trade, _ in exits]
+            await assign_ids(trades)
+            new_positions = [position for _, position in entries]
+            await assign_ids(new_positions)
+            await Trade.bulk_create(trades)
+            await Position.bulk_create(new_positions)
+            exit_trade_ids = {id(position): trade.id for trade, position in exits}
+            await TradeExit.bulk_create([
+                TradeExit(
+                    entry_trade_id=trade.id,
+                    position_id=position.id,
+                    exit_trade_id=exit_trade_ids.get(id(position))
+                ) for trade, position in entries
+            ])
+            stored_exits = [(trade, position) for trade, position in exits if position._saved_in_db]
+            if stored_exits:
+                trade_exits = await TradeExit.filter(position_id__in=[position.id for _, position in stored_exits])
+                trade_exit_map = {trade_exit.position_id: trade_exit for trade_exit in trade_exits}
+                for trade, position in stored_exits:
+                    trade_exit_map[position.id].exit_trade_id = trade.id
+                await TradeExit.bulk_update(trade_exit_map.values(), fields=['exit_trade_id'])
+                await Position.bulk_update(
+                    [position for _, position in stored_exits],
+                    fields=['buy_price', 'sell_price', 'charges', 'pnl', 'active']
+                )
+        for obj in [*trades, *new_positions]:
+            obj._saved_in_db = True
+        await self.record_closed(closed + [position for _, position in exits])
+
     async def rollover(self):
         today = datetime.date.today()
         positions = await Position.filter(
@@ -133,21 +301,15 @@ class BaseAlgoStrat(BaseAlgo):
         self.net_new = net_new
         self.strategy: StrategyModule = importlib.import_module(f"strategies.{self.strategy_obj.name}")
 
-    async def get_data_for_stock(self, stock: Stock) -> List[float]:
-        return await Ohlc.filter(instrument__stock=stock, interval=Interval.EOD, timestamp__lt=datetime.date.today()).order_by('-timestamp').limit(365).values_list('close', flat=True)
-
-    async def get_price_for_stock(self, stock: Stock) -> float:
-        ltp = await Ltp.filter(instrument__stock=stock).get()
-        return ltp.price
-    
     async def get_yesterdays_price_for_stock(self, stock: Stock) -> float:
-        ohlc_1, ohlc_2 = await Ohlc.filter(instrument__stock=stock, interval=Interval.EOD).order_by('-timestamp').limit(2)
-        if ohlc_1.timestamp.date() < datetime.date.today():
-            return ohlc_1.close
-        else:
-            return ohlc_2.close
-
-    async def get_price_for_future(self, future: Future) -> float:
+        instrument_id = await Instrument.filter(stock=stock).first().values_list('id', flat=True)
+        return await get_prev_close(instrument_id)
+
+    async def get_price_for_future(self, future: Future, instrument_id: Optional[int] = None) -> float:
+        if instrument_id is not None:
+            price = await self.get_live_price(instrument_id)
+            if price is not None:
+                return price
         ltp = await Ltp.filter(instrument__future=future).get()
         return ltp.price
     
@@ -160,7 +322,7 @@ class BaseAlgoStrat(BaseAlgo):
     async def exit_positions(self, positions: List[Position]):
         for position in positions:
             await position.fetch_related('instrument__future')
-            price = await self.get_price_for_future(position.instrument.future)
+            price = await self.get_price_for_future(position.instrument.future, position.instrument_id)
             await self.exit(position, price)
 
     async def get_investment_per_stock(self, investment):
@@ -174,7 +336,7 @@ class BaseAlgoStrat(BaseAlgo):
         except Exception as ex:
             logging.error(f"Error in getting future for {stock}", exc_info=ex)
             return
-        price = await self.get_price_for_future(instrument.future)
+        price = await self.get_price_for_future(instrument.future, instrument.id)
         for sub in subscriptions:
             await sub.fetch_related('account')
             investment_sum = await Investment.filter(account=sub.account).annotate(sum=Sum('amount')).first().values('sum')
@@ -187,17 +349,8 @@ class BaseAlgoStrat(BaseAlgo):
         subscriptions = Subscription.filter(algo=self.algo, active=True)
         stock_ids = StockGroupMap.filter(stock_group=self.stock_group).values('stock__id')
         stocks = await Stock.filter(id__in=Subquery(stock_ids))
-        for stock in stocks:
-            logging.info(f"Running algo for {stock}")
-            price_array = await self.get_data_for_stock(stock)
-            price_array = np.array(price_array)
-            price = await self.get_price_for_stock(stock)
-            try:
-                side = self.strategy.process(price_array, price)
-            except Exception as ex:
-                logging.error(f"Could not process strategy for {stock}", exc_info=ex)
-                continue
-            logging.info(f"{stock} is {side}")
+        side_map = await generate_signals(self.strategy, stocks, self.strategy_executor, self.stock_group)
+        for stock, side in side_map.items():
             portfolios = Position.filter(
                 subscription__id__in=Subquery(subscriptions.values('id')),
                 instrument__future__stock=stock,
@@ -255,17 +408,14 @@ class BaseAlgoPnlRMS(BaseAlgoStrat):
         for sub in subscriptions:
             positions = await Position.filter(subscription=sub, active=True)
             await self.exit_positions(positions)
-            investment_sum = await Investment.filter(account=sub.account).annotate(sum=Sum('amount')).first().values('sum')
-            investment = investment_sum['sum']
+            investment = self.snapshot.get_investment(sub.account_id)
             invest_per_stock = await self.get_investment_per_stock(investment)
             store_positions = []
             net_new_blocks = {}
             for stock, side in side_map.items():
                 if not side == 'HOLD':
-                    future = await Future.filter(stock=stock, expiry__gt=datetime.date.today()).order_by('expiry').first()
-                    instrument = await Instrument.filter(future=future).select_related('future__stock').get()
-                    ltp = await Ltp.get(instrument=instrument)
-                    price = ltp.price
+                    instrument = self.snapshot.get_future_instrument(stock)
+                    price = self.snapshot.get_price(instrument.id)
                     qty = self.get_qty(investment, invest_per_stock, instrument, price)
                     store_positions.append({
                         'inst_id': instrument.id,
@@ -327,48 +477,53 @@ class BaseAlgoPnlRMS(BaseAlgoStrat):
                     await self.exit(position, ltp.price)
 
     async def run(self):
-        side_map = {}
         stock_ids = StockGroupMap.filter(stock_group=self.stock_group).values('stock__id')
         stocks = await Stock.filter(id__in=Subquery(stock_ids))
-        for stock in stocks:
-            logging.info(f"Running algo for {stock}")
-            price_array = await self.get_data_for_stock(stock)
-            price_array = np.array(price_array)
-            price = await self.get_price_for_stock(stock)
-            try:
-                side = self.strategy.process(price_array, price)
-            except Exception as ex:
-                logging.error(f"Could not process strategy for {stock}", exc_info=ex)
-                continue
-            logging.info(f"{stock} is {side}")
-            side_map[stock] = side
+        side_map = await generate_signals(self.strategy, stocks, self.strategy_executor, self.stock_group)
         subscriptions = await Subscription.filter(algo=self.algo, active=True).select_related('account')
+        sub_datas = await SubscriptionData.filter(subscription_id__in=[sub.id for sub in subscriptions])
+        sub_data_map = {sub_data.subscription_id: sub_data for sub_data in sub_datas}
+        nifty_gap_sub_datas = await SubscriptionData.filter(
+            subscription__account_id__in=[sub.account_id for sub in subscriptions],
+            subscription__algo=self.nifty_gap_exit_algo,
+            subscription__active=True
+        ).select_related('subscription')
+        nifty_gap_data_map = {sub_data.subscription.account_id: sub_data.data for sub_data in nifty_gap_sub_datas}
+        stored_inst_ids = [values['inst_id'] for sub_data in sub_datas for values in sub_data.data.get('positions', [])]
+        self.snapshot = MarketSnapshot()
+        await self.snapshot.init(stocks, stored_inst_ids, [sub.account_id for sub in subscriptions])
+        active_positions = await Position.filter(
+            subscription_id__in=[sub.id for sub in subscriptions],
+            active=True,
+            instrument__future_id__isnull=False
+        ).select_related('instrument__future')
+        position_map: Dict[Tuple[int, int], Position] = {
+            (position.subscription_id, position.instrument.future.stock_id): position for position in active_positions
+        }
         net_new_subs = []
         to_exit = set()
         today = datetime.date.today()
         for sub in subscriptions:
-            try:
-                sub_data = await SubscriptionData.get(subscription=sub)
-            except DoesNotExist:
+            sub_data = sub_data_map.get(sub.id)
+            if not sub_data:
                 net_new_subs.append(sub)
                 continue
             stored_positions: List[dict] = sub_data.data.get('positions', [])
             net_new_blocks: dict = sub_data.data.get('net_new_blocks', {})
             trade_allowed: bool = sub_data.data.get('trade_allowed', True)
             try:
-                nifty_gap_sub = await Subscription.filter(account=sub.account, algo=self.nifty_gap_exit_algo, active=True).get()
-                nifty_gap_sub_data = await SubscriptionData.filter(subscription=nifty_gap_sub).get()
-                long_nifty_exit = nifty_gap_sub_data.data['long_nifty_exit']
-                short_nifty_exit = nifty_gap_sub_data.data['short_nifty_exit']
-            except (DoesNotExist, KeyError):
+                nifty_gap_data = nifty_gap_data_map[sub.account_id]
+                long_nifty_exit = nifty_gap_data['long_nifty_exit']
+                short_nifty_exit = nifty_gap_data['short_nifty_exit']
+            except KeyError:
                 long_nifty_exit = False
                 short_nifty_exit = False
             if self.mode == 'REGULAR':
                 long_mtm, short_mtm = 0, 0
                 stored_positions_changed = []
                 for values in stored_positions:
-                    instrument = await Instrument.get(id=values['inst_id']).select_related('future__stock')
-                    ltp = await Ltp.get(instrument=instrument)
+                    instrument = self.snapshot.get_instrument(values['inst_id'])
+                    ltp_price = self.snapshot.get_price(instrument.id)
                     if 'exit_time' in values:
                         if datetime.datetime.fromisoformat(values['exit_time']).date() < today:
                             continue
@@ -376,13 +531,12 @@ class BaseAlgoPnlRMS(BaseAlgoStrat):
                             new_price = values['exit_price']
                     else:
                         if TradeSide(values['side']).name != side_map.get(instrument.future.stock):
-                            values['exit_price'] = ltp.price
+                            values['exit_price'] = ltp_price
                             values['exit_time'] = datetime.datetime.now().isoformat()
                             net_new_blocks.pop(instrument.future.stock.ticker, None)
-                        new_price = ltp.price
+                        new_price = ltp_price
                     if datetime.datetime.fromisoformat(values['entry_time']).date() < today:
-                        ohlc = await Ohlc.filter(instrument=instrument, interval=Interval.EOD, timestamp__lt=today).order_by('-timestamp').first()
-                        old_price = ohlc.close
+                        old_price = self.snapshot.get_old_price(instrument.id)
                     else:
                         old_price = values['price']
                     if TradeSide(values['side']) == TradeSide.BUY:
@@ -404,45 +558,38 @@ class BaseAlgoPnlRMS(BaseAlgoStrat):
                 long_entry_allowed: bool = sub_data.data.get('long_entry_allowed', False)
                 short_entry_allowed: bool = sub_data.data.get('short_entry_allowed', False)
                 for values in stored_positions:
-                    instrument = await Instrument.get(id=values['inst_id']).select_related('future__stock')
-                    ltp = await Ltp.get(instrument=instrument)
+                    instrument = self.snapshot.get_instrument(values['inst_id'])
+                    ltp_price = self.snapshot.get_price(instrument.id)
                     if 'exit_time' not in values and TradeSide(values['side']).name != side_map.get(instrument.future.stock):
-                        values['exit_price'] = ltp.price
+                        values['exit_price'] = ltp_price
                         values['exit_time'] = datetime.datetime.now().isoformat()
                         net_new_blocks.pop(instrument.future.stock.ticker, None)
                     ## fluff for saving in sheet
-                    new_price = ltp.price
+                    new_price = ltp_price
                     if datetime.datetime.fromisoformat(values['entry_time']).date() < today:
-                        ohlc = await Ohlc.filter(instrument=instrument, interval=Interval.EOD, timestamp__lt=today).order_by('-timestamp').first()
-                        old_price = ohlc.close
+                        old_price = self.snapshot.get_old_price(instrument.id)
                     else:
                         old_price = values['price']
                     if TradeSide(values['side']) == TradeSide.BUY:
                         mtm = (new_price - old_price) * values['qty']
                     elif TradeSide(values['side']) == TradeSide.SELL:
                         mtm = (old_price - new_price) * values['qty']
-                    values['price'] = values.get('exit_price', ltp.price)
+                    values['price'] = values.get('exit_price', ltp_price)
                     values['old_price'] = old_price
                     values['mtm'] = mtm
             stock_sides: List[Tuple[Stock, TradeSide]] = []
             for values in stored_positions:
-                instrument = await Instrument.filter(id=values['inst_id']).get().select_related('future__stock')
+                instrument = self.snapshot.get_instrument(values['inst_id'])
                 if 'exit_time' not in values:
                     stock_sides.append((instrument.future.stock, TradeSide(values['side'])))
+            investment = self.snapshot.get_investment(sub.account_id)
+            invest_per_stock = await self.get_investment_per_stock(investment)
             for stock, side in side_map.items():
-                position = await Position.filter(
-                    subscription=sub,
-                    instrument__future__stock=stock,
-                    active=True
-                ).get_or_none()
+                position = position_map.get((sub.id, stock.id))
                 if side != 'HOLD':
-                    future = await Future.filter(stock=stock, expiry__gt=datetime.date.today()).order_by('expiry').first()
-                    instrument = await Instrument.filter(future=future).select_related('future__stock').get()
-                    ltp = await Ltp.get(instrument=instrument)
-                    price = ltp.price
+                    instrument = self.snapshot.get_future_instrument(stock)
+                    price = self.snapshot.get_price(instrument.id)
                     trade_side = TradeSide.BUY if side == 'BUY' else TradeSide.SELL
-                    investment = await Investment.filter(account=sub.account).annotate(sum=Sum('amount')).first().values_list('sum', flat=True)
-                    invest_per_stock = await self.get_investment_per_stock(investment)
                     qty = self.get_qty(investment, invest_per_stock, instrument, price)
                     if (stock, trade_side) not in stock_sides and not self.exit_only:
                         stored_positions.append({
@@ -493,8 +640,7 @@ class BaseAlgoPnlRMS(BaseAlgoStrat):
                     next_instrument = await Instrument.filter(future__stock=instrument.future.stock, future__expiry__gt=today).order_by('future__expiry').first()
                     values['inst_id'] = next_instrument.id
                     if values.get('old_price'):
-                        ohlc = await Ohlc.filter(instrument=next_instrument, interval=Interval.EOD, timestamp__lt=today).order_by('-timestamp').first()
-                        values['old_price'] = ohlc.close
+                        values['old_price'] = await get_prev_close(next_instrument.id)
                 stored_positions_change.append(values)
             sub_data.data['positions'] = stored_positions_change
             await sub_data.save()
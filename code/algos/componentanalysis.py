@@ -2,6 +2,7 @@ import datetime
 from typing import List, Literal
 from algos.basealgo import BaseAlgo
 from algos.shadowanalysis import ShadowPosition
+from algos.shadowstore import load_shadow_state
 from database.models import Account, Algo, Ltp, Subscription, SubscriptionData, TradeSide
 from tortoise.expressions import Subquery
 
@@ -28,6 +29,8 @@ class ComponentAnalysis(BaseAlgo):
         for sub in subs:
             sub_data, _ = await SubscriptionData.get_or_create(subscription=sub, defaults=dict(data={}))
             sub_data_main = await SubscriptionData.filter(subscription__account=sub.account, subscription__is_hedge=False).get_or_none()
+            if sub_data_main:
+                await load_shadow_state(sub_data_main)
             try:
                 sync_date = datetime.date.fromisoformat(sub_data.data.get('sync_date'))
                 if sync_date < today:
@@ -0,0 +1,65 @@
+import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, Optional
+from database.models import Instrument, Investment, Ltp, Stock
+from database.prevclose import get_prev_closes
+from tortoise.functions import Sum
+
+
+class MarketSnapshot:
+
+    def __init__(self) -> None:
+        self.future_instruments: Dict[int, Instrument] = {}
+        self.instruments: Dict[int, Instrument] = {}
+        self.prices: Dict[int, float] = {}
+        self.old_prices: Dict[int, float] = {}
+        self.investments: Dict[int, Decimal] = {}
+
+    async def init(self, stocks: Iterable[Stock], inst_ids: Iterable[int] = (), account_ids: Iterable[int] = ()):
+        today = datetime.date.today()
+        stock_ids = [stock.id for stock in stocks]
+        futures = await Instrument.filter(
+            future__stock_id__in=stock_ids,
+            future__expiry__gt=today
+        ).order_by('-future__expiry').select_related('future__stock')
+        for instrument in futures:
+            self.future_instruments[instrument.future.stock_id] = instrument
+        await self.add_instruments(inst_ids)
+        await self.add_accounts(account_ids)
+
+    async def add_instruments(self, inst_ids: Iterable[int]):
+        new_ids = set(inst_ids) - self.instruments.keys()
+        if new_ids:
+            instruments = await Instrument.filter(id__in=new_ids).select_related('future__stock')
+            self.instruments.update({instrument.id: instrument for instrument in instruments})
+        self.instruments.update({instrument.id: instrument for instrument in self.future_instruments.values()})
+        to_price = self.instruments.keys() - self.prices.keys()
+        if not to_price:
+            return
+        ltps = await Ltp.filter(instrument_id__in=to_price).values_list('instrument_id', 'price')
+        self.prices.update(dict(ltps))
+        self.old_prices.update(await get_prev_closes(to_price))
+
+    async def add_accounts(self, account_ids: Iterable[int]):
+        new_ids = set(account_ids) - self.investments.keys()
+        if not new_ids:
+            return
+        sums = await Investment.filter(
+            account_id__in=new_ids
+        ).annotate(sum=Sum('amount')).group_by('account_id').values_list('account_id', 'sum')
+        self.investments.update({account_id: Decimal(amount) for account_id, amount in sums})
+
+    def get_future_instrument(self, stock: Stock) -> Optional[Instrument]:
+        return self.future_instruments.get(stock.id)
+
+    def get_instrument(self, inst_id: int) -> Instrument:
+        return self.instruments[inst_id]
+
+    def get_price(self, inst_id: int) -> float:
+        return self.prices[inst_id]
+
+    def get_old_price(self, inst_id: int) -> float:
+        return self.old_prices[inst_id]
+
+    def get_investment(self, account_id: int) -> Decimal:
+        return self.investments.get(account_id)
@@ -1,6 +1,6 @@
-import datetime
 from algos.basealgo import BaseAlgo
-from database.models import Algo, Interval, Ltp, Ohlc, Position, Subscription, SubscriptionData, TradeSide
+from database.models import Algo, Ltp, Position, Subscription, SubscriptionData, TradeSide
+from database.prevclose import get_prev_close
 from tortoise.exceptions import DoesNotExist
 
 
@@ -12,13 +12,9 @@ class NiftyGapExit(BaseAlgo):
         self.index_ticker = "NIFTY 50"
 
     async def nifty_price_increase_percent(self) -> float:
-        ohlc1, ohlc2 = await Ohlc.filter(instrument__stock__ticker=self.index_ticker, interval=Interval.EOD).order_by('-timestamp').limit(2)
-        if ohlc1.timestamp.date() == datetime.date.today():
-            ohlc = ohlc2
-        else:
-            ohlc = ohlc1
         ltp = await Ltp.filter(instrument__stock__ticker=self.index_ticker).get()
-        return ((ltp.price - ohlc.close) * 100 / ohlc.close)
+        close = await get_prev_close(ltp.instrument_id)
+        return ((ltp.price - close) * 100 / close)
     
     async def run(self):
         nifty_price_increase = await self.nifty_price_increase_percent()
@@ -42,8 +42,9 @@ class NiftyIndexRMS(BaseAlgoPnlRMS):
         await super().run()
         instrument = self.index_future_instrument
         subs = await Subscription.filter(active=True, algo=self.algo).select_related('account')
-        ltp = await Ltp.filter(instrument=instrument).get()
-        price = ltp.price
+        await self.snapshot.add_instruments([instrument.id])
+        await self.snapshot.add_accounts([sub.account_id for sub in subs])
+        price = self.snapshot.get_price(instrument.id)
         for sub in subs:
             try:
                 sub_data = await SubscriptionData.filter(subscription=sub).get()
@@ -61,9 +62,7 @@ class NiftyIndexRMS(BaseAlgoPnlRMS):
                 long_nifty_exit = False
                 short_nifty_exit = False
             position = await Position.filter(subscription=sub, active=True).get_or_none()
-            investment = await Investment.filter(account=sub.account).annotate(
-                sum=Sum('amount')
-            ).first().values_list('sum', flat=True)
+            investment = self.snapshot.get_investment(sub.account_id)
             qty = self.get_qty(investment, investment, instrument, price)
             if (
                 (position and position.side == TradeSide.BUY)
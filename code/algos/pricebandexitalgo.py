@@ -1,7 +1,8 @@
 import datetime
 import logging
 from algos.basealgo import BaseAlgo
-from database.models import Account, Algo, Instrument, Interval, Ltp, Ohlc, Position, Subscription, TradeExit, TradeSide
+from database.models import Account, Algo, Instrument, Ltp, Position, Subscription, TradeExit, TradeSide
+from database.prevclose import get_prev_close
 
 
 class PriceBandExitAlgo(BaseAlgo):
@@ -14,10 +15,8 @@ class PriceBandExitAlgo(BaseAlgo):
         return float(ltp.price)
     
     async def get_yesterdays_price(self, position: Position) -> float:
-        instrument = position.instrument
         today = datetime.date.today()
-        ohlc = await Ohlc.filter(instrument=instrument, interval=Interval.EOD, timestamp__lt=today).order_by('-timestamp').first()
-        yesterdays_price = ohlc.close
+        yesterdays_price = await get_prev_close(position.instrument_id)
         trade_exit = await TradeExit.filter(position=position).select_related('entry_trade').get()
         if trade_exit.entry_trade.timestamp.date() == today:
             entry_price = float(trade_exit.entry_trade.price)
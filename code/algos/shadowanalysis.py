@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 from decimal import Decimal
 import importlib
@@ -7,7 +8,12 @@ from typing import Dict, List, Literal, Optional, Tuple, TypedDict, Set
 import numpy as np
 import pytz
 from algos.basealgo import BaseAlgo
+from algos.shadowmtm import ShadowBook
+from algos.shadowstore import load_shadow_state, save_shadow_state
+from algos.signals import generate_signals
+from dataaggregator.tickstore import get_tick_store
 from database.models import *
+from database.prevclose import get_prev_close, get_prev_closes
 from strategies import strategy as StrategyModule
 from tortoise.expressions import Subquery
 from tortoise.functions import Sum
@@ -29,7 +35,7 @@ class ShadowPosition(TypedDict):
 
 class ShadowAnalysis(BaseAlgo):
 
-    async def init(self, strategy_name: str, stock_group_name: str, shadow_mode: str = "NOOP", trade_mode: str = "NOOP"):
+    async def init(self, strategy_name: str, stock_group_name: str, shadow_mode: str = "NOOP", trade_mode: str = "NOOP", concurrent: bool = False):
         self.strategy_obj = await Strategy.get(name=strategy_name)
         self.algo = await Algo.get(name=self.__class__.__name__)
         self.stock_group = await StockGroup.get(name=stock_group_name)
@@ -37,6 +43,8 @@ class ShadowAnalysis(BaseAlgo):
         self.shadow_mode: Literal["SHADOW", "SHADOW_MTM", "SHADOW_EXIT", "NOOP", "VALUES_RESET"] = shadow_mode
         self.trade_mode: Literal["ENTRY", "EXIT", "NOOP", "SHADOWCHECK", "SHADOWCHECKREVERSE", "SHADOWCHECKEXITONLY", "SHADOWEXIT"] = trade_mode
         self._stock_calls = {}
+        self._stock_calls_lock = asyncio.Lock()
+        self.concurrent = concurrent
 
     @staticmethod
     def max_value_at_risk(investment: Decimal) -> float:
@@ -48,17 +56,27 @@ class ShadowAnalysis(BaseAlgo):
 
     @staticmethod
     async def get_old_price(instrument: Instrument) -> float:
-        ohlc = await Ohlc.filter(
-            instrument=instrument, interval=Interval.EOD,
-            timestamp__lt=datetime.date.today()
-        ).order_by('-timestamp').first()
-        return ohlc.close
+        return await get_prev_close(instrument.id)
 
-    @staticmethod
-    async def get_current_price(instrument: Instrument) -> float:
+    async def get_current_price(self, instrument: Instrument) -> float:
+        price = await self.get_live_price(instrument.id)
+        if price is not None:
+            return price
         ltp = await Ltp.filter(instrument=instrument).get()
         return ltp.price
 
+    async def get_current_prices(self, inst_ids: List[int]) -> Dict[int, float]:
+        prices = {}
+        if self.live_price_max_age is not None and inst_ids:
+            try:
+                prices = await get_tick_store().get_prices(inst_ids, self.live_price_max_age)
+            except Exception as ex:
+                logging.error("Error in reading live prices", exc_info=ex)
+        missing = [inst_id for inst_id in inst_ids if inst_id not in prices]
+        if missing:
+            prices.update(dict(await Ltp.filter(instrument_id__in=missing).values_list('instrument_id', 'price')))
+        return prices
+
     async def get_investment_per_stock(self, investment):
         if self.stock_group.name == "Nifty50":
             return (investment * 5 / 40) * Decimal(1.10)
@@ -88,13 +106,6 @@ class ShadowAnalysis(BaseAlgo):
         qty = int(invest_per_stock // Decimal(instrument.future.lot_size * price))
         return max(qty, 1) * instrument.future.lot_size
 
-    async def get_data_for_stock(self, stock: Stock) -> List[float]:
-        return await Ohlc.filter(instrument__stock=stock, interval=Interval.EOD, timestamp__lt=datetime.date.today()).order_by('-timestamp').limit(365).values_list('close', flat=True)
-
-    async def get_price_for_stock(self, stock: Stock) -> float:
-        ltp = await Ltp.filter(instrument__stock=stock).get()
-        return ltp.price
-
     def should_add_stoploss(self, mtm_tracking_arr: List[float]):
         if len(mtm_tracking_arr) < 3:
             return False
@@ -125,19 +136,10 @@ class ShadowAnalysis(BaseAlgo):
             )
         return False    
 
-    async def get_shadow_mtms(self, sub_data: SubscriptionData):
-        long_mtm, short_mtm = 0, 0
-        long_count, short_count = 0, 0
-        shadow_positions: List[ShadowPosition] = sub_data.data.get('positions', [])
-        for values in shadow_positions:
-            if TradeSide(values['side']) == TradeSide.BUY:
-                long_mtm += values['mtm']
-                if not 'exit_time' in values:
-                    long_count += 1
-            elif TradeSide(values['side']) == TradeSide.SELL:
-                short_mtm += values['mtm']
-                if not 'exit_time' in values:
-                    short_count += 1
+    async def get_shadow_mtms(self, sub_data: SubscriptionData, book: Optional[ShadowBook] = None):
+        if book is None:
+            book = ShadowBook(sub_data.data.get('positions', []))
+        long_mtm, short_mtm, long_count, short_count = book.totals()
         long_days_high_mtm = max([*sub_data.data.get('long_mtm_tracking', []), long_mtm])
         short_days_high_mtm = max([*sub_data.data.get('short_mtm_tracking', []), short_mtm])
         try:
@@ -239,28 +241,22 @@ class ShadowAnalysis(BaseAlgo):
         )
 
     async def generate_stock_calls(self) -> Dict[Stock, TradeSide]:
-        if self._stock_calls:
-            return self._stock_calls
+        async with self._stock_calls_lock:
+            if not self._stock_calls:
+                self._stock_calls = await self._generate_stock_calls()
+        return self._stock_calls
+
+    async def _generate_stock_calls(self) -> Dict[Stock, TradeSide]:
         side_map = {}
         stock_ids = StockGroupMap.filter(stock_group=self.stock_group).values('stock__id')
         stocks = await Stock.filter(id__in=Subquery(stock_ids))
-        for stock in stocks:
-            logging.info(f"Running algo for {stock}")
-            price_array = await self.get_data_for_stock(stock)
-            price_array = np.array(price_array)
-            price = await self.get_price_for_stock(stock)
-            try:
-                side = self.strategy.process(price_array, price)
-            except Exception as ex:
-                logging.error(f"Could not process strategy for {stock}", exc_info=ex)
-                continue
-            logging.info(f"{stock} is {side}")
+        signals = await generate_signals(self.strategy, stocks, self.strategy_executor, self.stock_group)
+        for stock, side in signals.items():
             try:
                 side_map[stock] = TradeSide(side.lower())
             except ValueError:
                 pass
-        self._stock_calls = side_map
-        return self._stock_calls
+        return side_map
 
     async def update_shadow_position_mtm(self, shadow_position: ShadowPosition) -> ShadowPosition:
         today = datetime.date.today()
@@ -325,14 +321,18 @@ class ShadowAnalysis(BaseAlgo):
                         'mtm': 0.0
                     })
         sub_data.data['positions'] = new_shadow_positions
-        await sub_data.save()
+        await save_shadow_state(sub_data)
 
-    async def update_shadow_mtm(self, sub_data: SubscriptionData):
+    async def update_shadow_mtm(self, sub_data: SubscriptionData) -> ShadowBook:
         shadow_positions: List[ShadowPosition] = sub_data.data.get('positions', [])
-        for shadow_position in shadow_positions:
-            await self.update_shadow_position_mtm(shadow_position)
+        book = ShadowBook(shadow_positions)
+        prices = await self.get_current_prices(book.price_ids())
+        old_price_ids = book.old_price_ids()
+        prev_closes = await get_prev_closes(old_price_ids) if old_price_ids else {}
+        book.revalue(prices, prev_closes)
         sub_data.data['positions'] = shadow_positions
-        await sub_data.save()
+        await save_shadow_state(sub_data)
+        return book
 
     async def enter_from_shadow(self, sub_data: SubscriptionData,  side: Optional[TradeSide] = None, partial: Optional[bool] = False):
         if not sub_data.data.get('trade_allowed', True):
@@ -342,9 +342,8 @@ class ShadowAnalysis(BaseAlgo):
         for shadow_position in shadow_positions:
             if side and side != TradeSide(shadow_position['side']):
                 continue
-            position = await Position.filter(
+            position = await self.active_positions(
                 subscription=sub_data.subscription,
-                active=True,
                 instrument_id=shadow_position['inst_id']
             ).get_or_none()
             if not shadow_position.get('exit_time') and not position:
@@ -370,9 +369,8 @@ class ShadowAnalysis(BaseAlgo):
             if side != TradeSide(shadow_position['side']) or shadow_position.get('exit_time'):
                 continue
             instrument = await Instrument.filter(id=shadow_position['inst_id']).get()
-            position = await Position.filter(
+            position = await self.active_positions(
                 subscription=sub_data.subscription,
-                active=True,
                 instrument=instrument
             ).get_or_none()
             ltp = await Ltp.filter(instrument=instrument).get()
@@ -398,16 +396,15 @@ class ShadowAnalysis(BaseAlgo):
                 continue
             if not shadow_position.get('exit_time'):
                 shadow_set.add((shadow_position['inst_id'], TradeSide(shadow_position['side'])))
-        positions = await Position.filter(subscription=sub_data.subscription, active=True).select_related('instrument')
+        positions = await self.active_positions(subscription=sub_data.subscription).select_related('instrument')
         for position in positions:
             if side and position.side != side:
                 continue
             position_set.add((position.instrument.id, position.side))
         to_exit = position_set - shadow_set
         for inst_id, side in to_exit:
-            position = await Position.filter(
+            position = await self.active_positions(
                 subscription=sub_data.subscription,
-                active=True,
                 instrument_id=inst_id,
                 side=side
             ).get_or_none()
@@ -421,8 +418,7 @@ class ShadowAnalysis(BaseAlgo):
         opposite_side = TradeSide.SELL if side == TradeSide.BUY else TradeSide.BUY
         for shadow_position in shadow_positions:
             if not shadow_position.get('exit_time') and TradeSide(shadow_position['side']) == side:
-                position = await Position.filter(
-                    active=True,
+                position = await self.active_positions(
                     subscription=sub_data.subscription,
                     instrument_id=shadow_position['inst_id'],
                     side=opposite_side,
@@ -437,8 +433,7 @@ class ShadowAnalysis(BaseAlgo):
         await sub_data.fetch_related('subscription')
         for shadow_position in shadow_positions:
             if not shadow_position.get('exit_time') and TradeSide(shadow_position['side']) == side:
-                position = await Position.filter(
-                    active=True,
+                position = await self.active_positions(
                     subscription=sub_data.subscription,
                     instrument_id=shadow_position['inst_id'],
                     side=side
@@ -447,316 +442,348 @@ class ShadowAnalysis(BaseAlgo):
                     ltp = await Ltp.filter(instrument=position.instrument).get()
                     await self.exit(position, ltp.price)
 
+    @staticmethod
+    def get_pool_size() -> int:
+        return getattr(Subscription._meta.db, 'pool_maxsize', 1)
+
     async def run(self):
         subscriptions = await Subscription.filter(algo=self.algo, active=True).select_related('account')
-        for sub in subscriptions:
-            sub_data, _ = await SubscriptionData.get_or_create(subscription=sub, defaults=dict(data={}))
-            shadow_long_status: Literal["ENTERED", "EXITED", "REVERSED", "ENTEREDSL"] = sub_data.data.get('shadow_long_status', 'EXITED')
-            shadow_short_status: Literal["ENTERED", "EXITED", "REVERSED", "ENTEREDSL"] = sub_data.data.get('shadow_short_status', 'EXITED')
-            long_entry_count, long_exit_count = sub_data.data.get('long_entry_count', 0), sub_data.data.get('long_exit_count', 0)
-            short_entry_count, short_exit_count = sub_data.data.get('short_entry_count', 0), sub_data.data.get('short_exit_count', 0)
-            long_kill_switch = sub_data.data.get('long_kill_switch', False)
-            short_kill_switch = sub_data.data.get('short_kill_switch', False)
-            long_on_going = sub_data.data.get('long_on_going', False)
-            short_on_going = sub_data.data.get('short_on_going', False)
-            long_sl = sub_data.data.get('long_sl')
-            short_sl = sub_data.data.get('short_sl')
-            trade_counter = sub_data.data.get('trade_counter', 0)
-            if self.shadow_mode == "SHADOW":
-                # 9:20 and 3:15
-                stock_calls = await self.generate_stock_calls()
-                await self.save_shadow_portfolio(sub_data, stock_calls)
-            elif self.shadow_mode == "SHADOW_MTM":
-                # every 15 mins from 9:30
-                await self.update_shadow_mtm(sub_data)
-            elif self.shadow_mode == "SHADOW_EXIT":
-                stock_calls = await self.generate_stock_calls()
-                await self.save_shadow_portfolio(sub_data, stock_calls, exit_only=True)
-            (
-                long_mtm,
-                short_mtm,
-                long_days_high_mtm,
-                short_days_high_mtm,
-                long_start_mtm,
-                short_start_mtm,
-                long_count,
-                short_count,
-                long_reset_mtm,
-                short_reset_mtm
-            ) = await self.get_shadow_mtms(sub_data)
-            if not self.shadow_mode == "NOOP":
-                sub_data.data.setdefault('long_mtm_tracking', []).append(long_mtm)
-                sub_data.data.setdefault('short_mtm_tracking', []).append(short_mtm)
-            if self.shadow_mode == "VALUES_RESET":
-                sub_data.data.pop('long_mtm_tracking', None)
-                sub_data.data.pop('short_mtm_tracking', None)
-                sub_data.data.pop('banned_stocks', None)
-                sub_data.data.pop('long_stoploss', None)
-                sub_data.data.pop('long_stoploss_active', None)
-                sub_data.data.pop('short_stoploss', None)
-                sub_data.data.pop('short_stoploss_active', None)
-                long_entry_count, long_exit_count = 0, 0
-                short_entry_count, short_exit_count = 0, 0
-                long_kill_switch = False
-                short_kill_switch = False
-                if shadow_long_status == "ENTERED":
-                    long_on_going = True
-                else:
-                    long_on_going = False
-                if shadow_short_status == "ENTERED":
-                    short_on_going = True
-                else:
-                    short_on_going = False
-            investment = await Investment.filter(
-                account=sub.account
-            ).annotate(sum=Sum('amount')).first().values_list('sum', flat=True)
-            if self.trade_mode == "EXIT":
-                # 3:15
-                if shadow_long_status == "REVERSED":
-                    await self.exit_reversed(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                elif shadow_long_status == "ENTEREDSL":
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                elif (
-                    shadow_long_status == "ENTERED" 
-                    and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                if shadow_short_status == "REVERSED":
-                    await self.exit_reversed(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                elif shadow_short_status == "ENTEREDSL":
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                elif (
-                    shadow_short_status == "ENTERED"
-                    and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                if sub_data.data.get('long_stoploss_active', False):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                elif sub_data.data.get('short_stoploss_active', False):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                await self.exit_from_shadow(sub_data)
-            if self.trade_mode == "NOOP":
-                logging.info("Trade Mode NOOP. Not doing anything.")
-            if self.trade_mode == "SHADOWEXIT":
-                await self.exit_from_shadow(sub_data)
-            if self.trade_mode == "ENTRY":
-                # 9:45
-                logging.info("Trade Mode ENTRY.")
-                # should_exit checks to be added
-                if (
-                    shadow_long_status == "ENTERED" 
-                    and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                elif shadow_long_status == "ENTERED":
-                    await self.exit_from_shadow(sub_data, TradeSide.BUY)
-                    await self.enter_from_shadow(sub_data, TradeSide.BUY)
-                elif (
-                    shadow_long_status == "EXITED"
-                    and self.should_enter(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.BUY)
-                    shadow_long_status = "ENTERED"
-                elif (
-                    shadow_long_status == "EXITED"
-                    and self.should_enter_with_sl(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm, long_start_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.BUY)
-                    shadow_long_status = "ENTEREDSL"
-                    long_sl = self.get_stoploss(long_start_mtm, long_mtm)
-                if (
-                    shadow_short_status == "ENTERED"
-                    and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                elif shadow_short_status == "ENTERED":
-                    await self.exit_from_shadow(sub_data, TradeSide.SELL)
-                    await self.enter_from_shadow(sub_data, TradeSide.SELL)
-                elif (
-                    shadow_short_status == "EXITED"
-                    and self.should_enter(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.SELL)
-                    shadow_short_status = "ENTERED" 
-                elif (
-                    shadow_short_status == "EXITED"
-                    and self.should_enter_with_sl(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm, short_start_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.SELL)
-                    shadow_short_status = "ENTEREDSL"
-                    short_sl = self.get_stoploss(short_start_mtm, short_mtm)
-            if self.trade_mode == "SHADOWCHECK":
-                # every 15 mins from 10:00
-                if (
-                    shadow_long_status == "ENTERED" 
-                    and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                    long_exit_count += 1
-                    long_on_going = False
-                elif (
-                    shadow_long_status == "ENTEREDSL" 
-                    and (
-                        self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
-                        or self.sl_hit(long_sl, long_mtm)
-                    )
-                ):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                    long_exit_count += 1
-                    long_on_going = False
-                elif (
-                    shadow_long_status == "EXITED"
-                    and not long_kill_switch
-                    and self.should_enter(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.BUY)
-                    shadow_long_status = "ENTERED"
-                    long_entry_count += 1
-                elif (
-                    shadow_long_status == "EXITED"
-                    and not long_kill_switch
-                    and self.should_enter_with_sl(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm, long_start_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.BUY)
-                    shadow_long_status = "ENTEREDSL"
-                    long_sl = self.get_stoploss(long_start_mtm, long_mtm)
-                    long_entry_count += 1
-                if (
-                    shadow_short_status == "ENTERED"
-                    and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                    short_exit_count += 1
-                    short_on_going = False
-                elif (
-                    shadow_short_status == "ENTEREDSL"
-                    and (
-                        self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
-                        or self.sl_hit(short_sl, short_mtm)
-                    )
-                ):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                    short_exit_count += 1
-                    short_on_going = False
-                elif (
-                    shadow_short_status == "EXITED"
-                    and not short_kill_switch
-                    and self.should_enter(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.SELL)
-                    shadow_short_status = "ENTERED"
-                    short_entry_count += 1
-                elif (
-                    shadow_short_status == "EXITED"
-                    and not short_kill_switch
-                    and self.should_enter_with_sl(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm, short_start_mtm)
-                ):
-                    await self.enter_from_shadow(sub_data, TradeSide.SELL)
-                    shadow_short_status = "ENTEREDSL"
-                    short_sl = self.get_stoploss(short_start_mtm, short_mtm)
-                    short_entry_count += 1
-            if self.trade_mode == "SHADOWCHECKEXITONLY":
-                if (
-                    shadow_long_status == "ENTERED" 
-                    and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                    long_on_going = False
-                elif (
-                    shadow_long_status == "ENTEREDSL" 
-                    and (
-                        self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
-                        or self.sl_hit(long_sl, long_mtm)
-                    )
-                ):
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                    long_exit_count += 1
-                    long_on_going = False
-                if (
-                    shadow_short_status == "ENTERED"
-                    and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
-                ):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                    short_on_going = False
-                elif (
-                    shadow_short_status == "ENTEREDSL"
-                    and (
-                        self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
-                        or self.sl_hit(short_sl, short_mtm)
-                    )
-                ):
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-                    short_exit_count += 1
-                    short_on_going = False
-            if self.trade_mode == "SHADOWCHECKREVERSE":
-                if (
-                    shadow_long_status != "REVERSED"
-                    and self.should_reverse(investment, long_mtm, long_reset_mtm, long_count, short_count)
-                ):
-                    long_sl = self.get_stoploss(min(long_mtm, long_reset_mtm), long_mtm)
-                    await self.exit_all(sub_data, TradeSide.BUY)
-                    await self.enter_reverse_from_shadow(sub_data, TradeSide.BUY)
-                    shadow_long_status = "REVERSED"
-                elif (
-                    shadow_long_status == "REVERSED"
-                    and (
-                        self.should_exit_reverse(long_mtm, long_reset_mtm)
-                        or self.sl_hit(long_sl, long_mtm)
-                    )
-                ):
-                    await self.exit_reversed(sub_data, TradeSide.BUY)
-                    shadow_long_status = "EXITED"
-                if (
-                    shadow_short_status != "REVERSED"
-                    and self.should_reverse(investment, short_mtm, short_reset_mtm, short_count, long_count)
-                ):
-                    short_sl = self.get_stoploss(min(short_mtm, short_reset_mtm), short_mtm)
-                    await self.exit_all(sub_data, TradeSide.SELL)
-                    await self.enter_reverse_from_shadow(sub_data, TradeSide.SELL)
-                    shadow_short_status = "REVERSED"
-                elif (
-                    shadow_short_status == "REVERSED"
-                    and (
-                        self.should_exit_reverse(short_mtm, short_reset_mtm)
-                        or self.sl_hit(short_sl, short_mtm)
-                    )
-                ):
-                    await self.exit_reversed(sub_data, TradeSide.SELL)
-                    shadow_short_status = "EXITED"
-            sub_data.data['shadow_short_status'] = shadow_short_status
-            sub_data.data['shadow_long_status'] = shadow_long_status
-            sub_data.data['long_entry_count'] = long_entry_count
-            sub_data.data['long_exit_count'] = long_exit_count
-            sub_data.data['short_entry_count'] = short_entry_count
-            sub_data.data['short_entry_count'] = short_entry_count
-            sub_data.data['long_kill_switch'] = long_kill_switch
-            sub_data.data['short_kill_switch'] = short_kill_switch
-            sub_data.data['long_on_going'] = long_on_going
-            sub_data.data['short_on_going'] = short_on_going
-            sub_data.data['long_sl'] = long_sl
-            sub_data.data['short_sl'] = short_sl
-            await sub_data.save()
+        if not self.concurrent:
+            for sub in subscriptions:
+                await self.run_subscription(sub)
+            return
+        trades_count = len(self.trades)
+        semaphore = asyncio.Semaphore(self.get_pool_size())
+
+        async def run_bounded(sub: Subscription):
+            async with semaphore:
+                await self.run_subscription(sub)
+
+        results = await asyncio.gather(*[run_bounded(sub) for sub in subscriptions], return_exceptions=True)
+        for sub, result in zip(subscriptions, results):
+            if isinstance(result, Exception):
+                logging.error(f"Error in {self.algo.name} for subscription {sub.id}", exc_info=result)
+        ##
+        # Subscriptions interleave their entries and exits, so trades are put
+        # back in the order a sequential run would have produced them.
+        ##
+        order = {sub.id: i for i, sub in enumerate(subscriptions)}
+        self.trades[trades_count:] = sorted(
+            self.trades[trades_count:],
+            key=lambda trade: order.get(trade.subscription_id, len(order))
+        )
+
+    async def run_subscription(self, sub: Subscription):
+        sub_data, _ = await SubscriptionData.get_or_create(subscription=sub, defaults=dict(data={}))
+        await load_shadow_state(sub_data)
+        shadow_long_status: Literal["ENTERED", "EXITED", "REVERSED", "ENTEREDSL"] = sub_data.data.get('shadow_long_status', 'EXITED')
+        shadow_short_status: Literal["ENTERED", "EXITED", "REVERSED", "ENTEREDSL"] = sub_data.data.get('shadow_short_status', 'EXITED')
+        long_entry_count, long_exit_count = sub_data.data.get('long_entry_count', 0), sub_data.data.get('long_exit_count', 0)
+        short_entry_count, short_exit_count = sub_data.data.get('short_entry_count', 0), sub_data.data.get('short_exit_count', 0)
+        long_kill_switch = sub_data.data.get('long_kill_switch', False)
+        short_kill_switch = sub_data.data.get('short_kill_switch', False)
+        long_on_going = sub_data.data.get('long_on_going', False)
+        short_on_going = sub_data.data.get('short_on_going', False)
+        long_sl = sub_data.data.get('long_sl')
+        short_sl = sub_data.data.get('short_sl')
+        trade_counter = sub_data.data.get('trade_counter', 0)
+        book = None
+        if self.shadow_mode == "SHADOW":
+            # 9:20 and 3:15
+            stock_calls = await self.generate_stock_calls()
+            await self.save_shadow_portfolio(sub_data, stock_calls)
+        elif self.shadow_mode == "SHADOW_MTM":
+            # every 15 mins from 9:30
+            book = await self.update_shadow_mtm(sub_data)
+        elif self.shadow_mode == "SHADOW_EXIT":
+            stock_calls = await self.generate_stock_calls()
+            await self.save_shadow_portfolio(sub_data, stock_calls, exit_only=True)
+        (
+            long_mtm,
+            short_mtm,
+            long_days_high_mtm,
+            short_days_high_mtm,
+            long_start_mtm,
+            short_start_mtm,
+            long_count,
+            short_count,
+            long_reset_mtm,
+            short_reset_mtm
+        ) = await self.get_shadow_mtms(sub_data, book)
+        if not self.shadow_mode == "NOOP":
+            sub_data.data.setdefault('long_mtm_tracking', []).append(long_mtm)
+            sub_data.data.setdefault('short_mtm_tracking', []).append(short_mtm)
+        if self.shadow_mode == "VALUES_RESET":
+            sub_data.data.pop('long_mtm_tracking', None)
+            sub_data.data.pop('short_mtm_tracking', None)
+            sub_data.data.pop('banned_stocks', None)
+            sub_data.data.pop('long_stoploss', None)
+            sub_data.data.pop('long_stoploss_active', None)
+            sub_data.data.pop('short_stoploss', None)
+            sub_data.data.pop('short_stoploss_active', None)
+            long_entry_count, long_exit_count = 0, 0
+            short_entry_count, short_exit_count = 0, 0
+            long_kill_switch = False
+            short_kill_switch = False
+            if shadow_long_status == "ENTERED":
+                long_on_going = True
+            else:
+                long_on_going = False
+            if shadow_short_status == "ENTERED":
+                short_on_going = True
+            else:
+                short_on_going = False
+        investment = await Investment.filter(
+            account=sub.account
+        ).annotate(sum=Sum('amount')).first().values_list('sum', flat=True)
+        if self.trade_mode == "EXIT":
+            # 3:15
+            if shadow_long_status == "REVERSED":
+                await self.exit_reversed(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+            elif shadow_long_status == "ENTEREDSL":
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+            elif (
+                shadow_long_status == "ENTERED" 
+                and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+            if shadow_short_status == "REVERSED":
+                await self.exit_reversed(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+            elif shadow_short_status == "ENTEREDSL":
+                await self.exit_all(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+            elif (
+                shadow_short_status == "ENTERED"
+                and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+            if sub_data.data.get('long_stoploss_active', False):
+                await self.exit_all(sub_data, TradeSide.BUY)
+            elif sub_data.data.get('short_stoploss_active', False):
+                await self.exit_all(sub_data, TradeSide.SELL)
+            await self.exit_from_shadow(sub_data)
+        if self.trade_mode == "NOOP":
+            logging.info("Trade Mode NOOP. Not doing anything.")
+        if self.trade_mode == "SHADOWEXIT":
+            await self.exit_from_shadow(sub_data)
+        if self.trade_mode == "ENTRY":
+            # 9:45
+            logging.info("Trade Mode ENTRY.")
+            # should_exit checks to be added
+            if (
+                shadow_long_status == "ENTERED" 
+                and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+            elif shadow_long_status == "ENTERED":
+                await self.exit_from_shadow(sub_data, TradeSide.BUY)
+                await self.enter_from_shadow(sub_data, TradeSide.BUY)
+            elif (
+                shadow_long_status == "EXITED"
+                and self.should_enter(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.BUY)
+                shadow_long_status = "ENTERED"
+            elif (
+                shadow_long_status == "EXITED"
+                and self.should_enter_with_sl(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm, long_start_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.BUY)
+                shadow_long_status = "ENTEREDSL"
+                long_sl = self.get_stoploss(long_start_mtm, long_mtm)
+            if (
+                shadow_short_status == "ENTERED"
+                and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.SELL)
+            elif shadow_short_status == "ENTERED":
+                await self.exit_from_shadow(sub_data, TradeSide.SELL)
+                await self.enter_from_shadow(sub_data, TradeSide.SELL)
+            elif (
+                shadow_short_status == "EXITED"
+                and self.should_enter(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.SELL)
+                shadow_short_status = "ENTERED" 
+            elif (
+                shadow_short_status == "EXITED"
+                and self.should_enter_with_sl(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm, short_start_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.SELL)
+                shadow_short_status = "ENTEREDSL"
+                short_sl = self.get_stoploss(short_start_mtm, short_mtm)
+        if self.trade_mode == "SHADOWCHECK":
+            # every 15 mins from 10:00
+            if (
+                shadow_long_status == "ENTERED" 
+                and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+                long_exit_count += 1
+                long_on_going = False
+            elif (
+                shadow_long_status == "ENTEREDSL" 
+                and (
+                    self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
+                    or self.sl_hit(long_sl, long_mtm)
+                )
+            ):
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+                long_exit_count += 1
+                long_on_going = False
+            elif (
+                shadow_long_status == "EXITED"
+                and not long_kill_switch
+                and self.should_enter(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.BUY)
+                shadow_long_status = "ENTERED"
+                long_entry_count += 1
+            elif (
+                shadow_long_status == "EXITED"
+                and not long_kill_switch
+                and self.should_enter_with_sl(investment, long_mtm, long_count, long_days_high_mtm, long_entry_count, long_reset_mtm, long_start_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.BUY)
+                shadow_long_status = "ENTEREDSL"
+                long_sl = self.get_stoploss(long_start_mtm, long_mtm)
+                long_entry_count += 1
+            if (
+                shadow_short_status == "ENTERED"
+                and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+                short_exit_count += 1
+                short_on_going = False
+            elif (
+                shadow_short_status == "ENTEREDSL"
+                and (
+                    self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
+                    or self.sl_hit(short_sl, short_mtm)
+                )
+            ):
+                await self.exit_all(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+                short_exit_count += 1
+                short_on_going = False
+            elif (
+                shadow_short_status == "EXITED"
+                and not short_kill_switch
+                and self.should_enter(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.SELL)
+                shadow_short_status = "ENTERED"
+                short_entry_count += 1
+            elif (
+                shadow_short_status == "EXITED"
+                and not short_kill_switch
+                and self.should_enter_with_sl(investment, short_mtm, short_count, short_days_high_mtm, short_entry_count, short_reset_mtm, short_start_mtm)
+            ):
+                await self.enter_from_shadow(sub_data, TradeSide.SELL)
+                shadow_short_status = "ENTEREDSL"
+                short_sl = self.get_stoploss(short_start_mtm, short_mtm)
+                short_entry_count += 1
+        if self.trade_mode == "SHADOWCHECKEXITONLY":
+            if (
+                shadow_long_status == "ENTERED" 
+                and self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+                long_on_going = False
+            elif (
+                shadow_long_status == "ENTEREDSL" 
+                and (
+                    self.should_exit(investment, long_mtm, long_count, long_days_high_mtm, long_exit_count, long_on_going, long_reset_mtm)
+                    or self.sl_hit(long_sl, long_mtm)
+                )
+            ):
+                await self.exit_all(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+                long_exit_count += 1
+                long_on_going = False
+            if (
+                shadow_short_status == "ENTERED"
+                and self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
+            ):
+                await self.exit_all(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+                short_on_going = False
+            elif (
+                shadow_short_status == "ENTEREDSL"
+                and (
+                    self.should_exit(investment, short_mtm, short_count, short_days_high_mtm, short_exit_count, short_on_going, short_reset_mtm)
+                    or self.sl_hit(short_sl, short_mtm)
+                )
+            ):
+                await self.exit_all(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+                short_exit_count += 1
+                short_on_going = False
+        if self.trade_mode == "SHADOWCHECKREVERSE":
+            if (
+                shadow_long_status != "REVERSED"
+                and self.should_reverse(investment, long_mtm, long_reset_mtm, long_count, short_count)
+            ):
+                long_sl = self.get_stoploss(min(long_mtm, long_reset_mtm), long_mtm)
+                await self.exit_all(sub_data, TradeSide.BUY)
+                await self.enter_reverse_from_shadow(sub_data, TradeSide.BUY)
+                shadow_long_status = "REVERSED"
+            elif (
+                shadow_long_status == "REVERSED"
+                and (
+                    self.should_exit_reverse(long_mtm, long_reset_mtm)
+                    or self.sl_hit(long_sl, long_mtm)
+                )
+            ):
+                await self.exit_reversed(sub_data, TradeSide.BUY)
+                shadow_long_status = "EXITED"
+            if (
+                shadow_short_status != "REVERSED"
+                and self.should_reverse(investment, short_mtm, short_reset_mtm, short_count, long_count)
+            ):
+                short_sl = self.get_stoploss(min(short_mtm, short_reset_mtm), short_mtm)
+                await self.exit_all(sub_data, TradeSide.SELL)
+                await self.enter_reverse_from_shadow(sub_data, TradeSide.SELL)
+                shadow_short_status = "REVERSED"
+            elif (
+                shadow_short_status == "REVERSED"
+                and (
+                    self.should_exit_reverse(short_mtm, short_reset_mtm)
+                    or self.sl_hit(short_sl, short_mtm)
+                )
+            ):
+                await self.exit_reversed(sub_data, TradeSide.SELL)
+                shadow_short_status = "EXITED"
+        sub_data.data['shadow_short_status'] = shadow_short_status
+        sub_data.data['shadow_long_status'] = shadow_long_status
+        sub_data.data['long_entry_count'] = long_entry_count
+        sub_data.data['long_exit_count'] = long_exit_count
+        sub_data.data['short_entry_count'] = short_entry_count
+        sub_data.data['short_entry_count'] = short_entry_count
+        sub_data.data['long_kill_switch'] = long_kill_switch
+        sub_data.data['short_kill_switch'] = short_kill_switch
+        sub_data.data['long_on_going'] = long_on_going
+        sub_data.data['short_on_going'] = short_on_going
+        sub_data.data['long_sl'] = long_sl
+        sub_data.data['short_sl'] = short_sl
+        await save_shadow_state(sub_data)
 
     async def rollover(self):
         await super().rollover()
         today = datetime.date.today()
         sub_datas = await SubscriptionData.filter(subscription__active=True, subscription__algo=self.algo)
         for sub_data in sub_datas:
+            await load_shadow_state(sub_data)
             stored_positions: List[ShadowPosition] = sub_data.data.get('positions', [])
             stored_positions_change = []
             for values in stored_positions:
@@ -765,8 +792,7 @@ class ShadowAnalysis(BaseAlgo):
                     next_instrument = await Instrument.filter(future__stock=instrument.future.stock, future__expiry__gt=today).order_by('future__expiry').first()
                     values['inst_id'] = next_instrument.id
                     if values.get('old_price'):
-                        ohlc = await Ohlc.filter(instrument=next_instrument, interval=Interval.EOD, timestamp__lt=today).order_by('-timestamp').first()
-                        values['old_price'] = ohlc.close
+                        values['old_price'] = await get_prev_close(next_instrument.id)
                 stored_positions_change.append(values)
             sub_data.data['positions'] = stored_positions_change
-            await sub_data.save()
\ No newline at end of file
+            await save_shadow_state(sub_data)
\ No newline at end of file
@@ -0,0 +1,62 @@
+import datetime
+from typing import List, Mapping, Tuple
+import numpy as np
+from database.models import TradeSide
+
+
+class ShadowBook:
+
+    def __init__(self, positions: List[dict], today: datetime.date = None) -> None:
+        today = today or datetime.date.today()
+        self.positions = positions
+        self.inst_ids = np.array([values['inst_id'] for values in positions], dtype=np.int64)
+        self.sides = np.array([1.0 if TradeSide(values['side']) == TradeSide.BUY else -1.0 for values in positions])
+        self.qtys = np.array([values['qty'] for values in positions], dtype=float)
+        self.entry_prices = np.array([values['price'] for values in positions], dtype=float)
+        self.old_prices = np.array([values.get('old_price', np.nan) for values in positions], dtype=float)
+        self.exit_prices = np.array([values.get('exit_price', np.nan) for values in positions], dtype=float)
+        self.mtms = np.array([values.get('mtm') or 0.0 for values in positions], dtype=float)
+        self.open = np.array(['exit_time' not in values for values in positions], dtype=bool)
+        self.carried = np.array([
+            datetime.datetime.fromisoformat(values['entry_time']).date() < today for values in positions
+        ], dtype=bool)
+
+    @staticmethod
+    def _join(inst_ids: np.ndarray, prices: Mapping[int, float]) -> np.ndarray:
+        ids, inverse = np.unique(inst_ids, return_inverse=True)
+        return np.array([prices.get(inst_id, np.nan) for inst_id in ids.tolist()], dtype=float)[inverse]
+
+    def price_ids(self) -> List[int]:
+        return np.unique(self.inst_ids[np.isnan(self.exit_prices)]).tolist()
+
+    def old_price_ids(self) -> List[int]:
+        return np.unique(self.inst_ids[self.carried]).tolist()
+
+    def revalue(self, prices: Mapping[int, float], prev_closes: Mapping[int, float]):
+        ##
+        # Positions carried from an earlier day are marked from the previous
+        # close, the rest from their entry price. Exited positions keep their
+        # exit price, everything else is marked at the current price.
+        ##
+        if not self.positions:
+            return
+        old_prices = np.where(self.carried, self._join(self.inst_ids, prev_closes), self.entry_prices)
+        current = np.where(np.isnan(self.exit_prices), self._join(self.inst_ids, prices), self.exit_prices)
+        missing = np.isnan(old_prices) | np.isnan(current)
+        if missing.any():
+            raise KeyError(f"No price for instruments {np.unique(self.inst_ids[missing]).tolist()}")
+        self.old_prices = old_prices
+        self.mtms = self.sides * (current - old_prices) * self.qtys
+        for values, old_price, mtm in zip(self.positions, self.old_prices.tolist(), self.mtms.tolist()):
+            values['old_price'] = old_price
+            values['mtm'] = mtm
+
+    def totals(self) -> Tuple[float, float, int, int]:
+        long = self.sides > 0
+        short = ~long
+        return (
+            float(self.mtms[long].sum()),
+            float(self.mtms[short].sum()),
+            int((long & self.open).sum()),
+            int((short & self.open).sum()),
+        )
@@ -0,0 +1,133 @@
+import datetime
+from itertools import zip_longest
+from typing import List
+from database.models import MtmTick, ShadowPositionRecord, SubscriptionData, TradeSide
+from database.utils import assign_ids
+from tortoise.transactions import in_transaction
+
+
+SHADOW_KEYS = ('positions', 'long_mtm_tracking', 'short_mtm_tracking')
+POSITION_FIELDS = [
+    'instrument_id', 'side', 'qty', 'price', 'entry_time', 'entry_price',
+    'exit_time', 'exit_price', 'old_price', 'mtm', 'days_high_mtm'
+]
+
+
+def _naive(timestamp: datetime.datetime) -> datetime.datetime:
+    return timestamp.replace(tzinfo=None)
+
+
+def record_to_position(record: ShadowPositionRecord) -> dict:
+    values = {
+        'inst_id': record.instrument_id,
+        'price': record.price,
+        'side': record.side.value,
+        'qty': record.qty,
+        'entry_time': _naive(record.entry_time).isoformat(),
+    }
+    for key in ('entry_price', 'old_price', 'mtm', 'days_high_mtm', 'exit_price'):
+        value = getattr(record, key)
+        if value is not None:
+            values[key] = value
+    if record.exit_time is not None:
+        values['exit_time'] = _naive(record.exit_time).isoformat()
+    return values
+
+
+def position_to_record(subscription_id: int, values: dict) -> ShadowPositionRecord:
+    exit_time = values.get('exit_time')
+    return ShadowPositionRecord(
+        subscription_id=subscription_id,
+        instrument_id=values['inst_id'],
+        side=TradeSide(values['side']),
+        qty=values['qty'],
+        price=values['price'],
+        entry_time=datetime.datetime.fromisoformat(values['entry_time']),
+        entry_price=values.get('entry_price'),
+        exit_time=datetime.datetime.fromisoformat(exit_time) if exit_time else None,
+        exit_price=values.get('exit_price'),
+        old_price=values.get('old_price'),
+        mtm=values.get('mtm'),
+        days_high_mtm=values.get('days_high_mtm'),
+    )
+
+
+async def load_shadow_state(sub_data: SubscriptionData) -> SubscriptionData:
+    ##
+    # Fills sub_data.data with positions and mtm tracking in the old json layout
+    # so callers can keep reading it as before. Subscriptions that were never
+    # written to the tables keep whatever is still in the json blob.
+    ##
+    records = await ShadowPositionRecord.filter(subscription_id=sub_data.subscription_id).order_by('id')
+    if records:
+        sub_data.data['positions'] = [record_to_position(record) for record in records]
+    ticks = await MtmTick.filter(
+        subscription_id=sub_data.subscription_id
+    ).order_by('timestamp', 'id').values_list('long_mtm', 'short_mtm')
+    if ticks:
+        sub_data.data['long_mtm_tracking'] = [long_mtm for long_mtm, _ in ticks if long_mtm is not None]
+        sub_data.data['short_mtm_tracking'] = [short_mtm for _, short_mtm in ticks if short_mtm is not None]
+    return sub_data
+
+
+async def _save_positions(subscription_id: int, positions: List[dict]):
+    stored = await ShadowPositionRecord.filter(
+        subscription_id=subscription_id
+    ).values_list('id', 'instrument_id', 'entry_time')
+    id_map = {(inst_id, _naive(entry_time)): record_id for record_id, inst_id, entry_time in stored}
+    records, new_records = [], []
+    for values in positions:
+        record = position_to_record(subscription_id, values)
+        record_id = id_map.pop((record.instrument_id, record.entry_time), None)
+        if record_id is None:
+            new_records.append(record)
+        else:
+            record.pk = record_id
+            record._saved_in_db = True
+            records.append(record)
+    if id_map:
+        await ShadowPositionRecord.filter(id__in=list(id_map.values())).delete()
+    ##
+    # bulk_create(on_conflict=...) cannot update more than one column with the
+    # pinned pypika-tortoise, so existing rows go through bulk_update instead.
+    ##
+    if records:
+        await ShadowPositionRecord.bulk_update(records, fields=POSITION_FIELDS)
+    if new_records:
+        await assign_ids(new_records)
+        await ShadowPositionRecord.bulk_create(new_records)
+
+
+async def _save_mtm_ticks(subscription_id: int, long_tracking: List[float], short_tracking: List[float]):
+    stored = await MtmTick.filter(subscription_id=subscription_id).count()
+    tracking = list(zip_longest(long_tracking, short_tracking))
+    if len(tracking) < stored:
+        await MtmTick.filter(subscription_id=subscription_id).delete()
+        stored = 0
+    ticks = [
+        MtmTick(subscription_id=subscription_id, long_mtm=long_mtm, short_mtm=short_mtm)
+        for long_mtm, short_mtm in tracking[stored:]
+    ]
+    if ticks:
+        await MtmTick.bulk_create(ticks)
+
+
+async def save_shadow_state(sub_data: SubscriptionData):
+    ##
+    # Positions are written with one bulk update and one bulk insert, only new
+    # mtm ticks are inserted and the json blob is saved without either. A
+    # missing tracking key means it was reset, so stored ticks are dropped.
+    ##
+    state = {key: sub_data.data.pop(key) for key in SHADOW_KEYS if key in sub_data.data}
+    try:
+        async with in_transaction():
+            if 'positions' in state:
+                await _save_positions(sub_data.subscription_id, state['positions'])
+            await _save_mtm_ticks(
+                sub_data.subscription_id,
+                state.get('long_mtm_tracking', []),
+                state.get('short_mtm_tracking', [])
+            )
+            await sub_data.save()
+    finally:
+        sub_data.data.update(state)
@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+import json
+import time
+from typing import Awaitable, Callable, Dict, Optional
+import aioredis
+import settings
+from database.models import SignalCache
+from tortoise.exceptions import IntegrityError
+
+
+SIGNAL_CACHE = getattr(settings, 'SIGNAL_CACHE', "db")
+
+
+class BaseSignalCache:
+
+    ttl_seconds = 60 * 60
+    wait_seconds = 120
+    poll_seconds = 0.5
+
+    async def get(self, key: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    async def set(self, key: str, signals: Dict[str, str]):
+        raise NotImplementedError
+
+    async def claim(self, key: str) -> bool:
+        raise NotImplementedError
+
+    async def release(self, key: str):
+        raise NotImplementedError
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Dict[str, str]]]) -> Dict[str, str]:
+        ##
+        # Algos running in parallel at the same tick ask for the same key. The
+        # first one to claim it computes the signals, the others poll until they
+        # are stored, and compute them themselves if that takes too long.
+        ##
+        signals = await self.get(key)
+        if signals is not None:
+            return signals
+        if await self.claim(key):
+            try:
+                signals = await compute()
+            except Exception:
+                await self.release(key)
+                raise
+            await self.set(key, signals)
+            return signals
+        deadline = time.monotonic() + self.wait_seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_seconds)
+            signals = await self.get(key)
+            if signals is not None:
+                return signals
+        return await compute()
+
+
+class DbSignalCache(BaseSignalCache):
+
+    async def get(self, key: str) -> Optional[Dict[str, str]]:
+        entry = await SignalCache.filter(key=key, expires__gt=datetime.datetime.now()).get_or_none()
+        return entry.signals if entry else None
+
+    async def set(self, key: str, signals: Dict[str, str]):
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=self.ttl_seconds)
+        await SignalCache.update_or_create(key=key, defaults=dict(signals=signals, expires=expires))
+
+    async def claim(self, key: str) -> bool:
+        now = datetime.datetime.now()
+        await SignalCache.filter(expires__lte=now).delete()
+        try:
+            await SignalCache.create(key=key, signals=None, expires=now + datetime.timedelta(seconds=self.wait_seconds))
+        except IntegrityError:
+            return False
+        return True
+
+    async def release(self, key: str):
+        await SignalCache.filter(key=key, signals=None).delete()
+
+
+class RedisSignalCache(BaseSignalCache):
+
+    key_prefix = "signals:"
+
+    def __init__(self, url: str) -> None:
+        self.redis = aioredis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[Dict[str, str]]:
+        signals = await self.redis.get(f"{self.key_prefix}{key}")
+        return json.loads(signals) if signals is not None else None
+
+    async def set(self, key: str, signals: Dict[str, str]):
+        await self.redis.set(f"{self.key_prefix}{key}", json.dumps(signals), ex=self.ttl_seconds)
+
+    async def claim(self, key: str) -> bool:
+        return bool(await self.redis.set(f"{self.key_prefix}{key}:lock", 1, nx=True, ex=self.wait_seconds))
+
+    async def release(self, key: str):
+        await self.redis.delete(f"{self.key_prefix}{key}:lock")
+
+
+_signal_cache: Optional[BaseSignalCache] = None
+
+
+def get_signal_cache() -> BaseSignalCache:
+    global _signal_cache
+    if _signal_cache is None:
+        ##
+        # SIGNAL_CACHE is "db" to share signals through the signalcache table
+        # or "redis" to use REDIS_URL instead.
+        ##
+        if SIGNAL_CACHE == "redis":
+            _signal_cache = RedisSignalCache(settings.REDIS_URL)
+        elif SIGNAL_CACHE == "db":
+            _signal_cache = DbSignalCache()
+        else:
+            raise ValueError(f"Unknown SIGNAL_CACHE {SIGNAL_CACHE}")
+    return _signal_cache
+
+
+def set_signal_cache(signal_cache: Optional[BaseSignalCache]):
+    global _signal_cache
+    _signal_cache = signal_cache
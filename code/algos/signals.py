@@ -0,0 +1,248 @@
+import asyncio
+import datetime
+import importlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Literal, Optional, Tuple
+import numpy as np
+import settings
+from algos.signalcache import get_signal_cache
+from database.models import Interval, Ltp, Ohlc, Stock, StockGroup
+from strategies import strategy as StrategyModule
+from tortoise.expressions import RawSQL
+from tortoise.functions import Max
+
+
+STRATEGY_WORKERS = os.cpu_count() or 1
+##
+# Where each strategy module runs, by module name: "inline" on the event loop,
+# "thread" in a thread pool or "process" in spawned worker processes. Strategies
+# not listed run inline, e.g. {"momentum": "process"}.
+##
+STRATEGY_EXECUTORS: Dict[str, str] = getattr(settings, 'STRATEGY_EXECUTORS', {})
+
+_executors: Dict[str, Executor] = {}
+
+
+async def get_price_matrix(stocks: List[Stock], nbars: int = 365) -> Tuple[np.ndarray, np.ndarray]:
+    ##
+    # Rows follow the order of stocks, columns are closes newest first like the
+    # per stock query used to return. Stocks with fewer bars are padded with nan.
+    # The last nbars bars of each stock are numbered in the database, so a long
+    # gap in a stock's history still yields all the bars it has.
+    ##
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    stock_ids = [stock.id for stock in stocks]
+    row_map = {stock_id: row for row, stock_id in enumerate(stock_ids)}
+    bars = Ohlc.filter(
+        instrument__stock_id__in=stock_ids,
+        interval=Interval.EOD,
+        timestamp__lt=today
+    ).annotate(
+        bar=RawSQL('ROW_NUMBER() OVER (PARTITION BY "ohlc"."instrument_id" ORDER BY "ohlc"."timestamp" DESC)')
+    ).values('close', 'bar', stock_id='instrument__stock_id')
+    closes = await Ohlc._meta.db.execute_query_dict(
+        f'SELECT "stock_id", "bar", "close" FROM ({bars.sql()}) AS "bars" WHERE "bar" <= {int(nbars)}'
+    )
+    price_matrix = np.full((len(stock_ids), nbars), np.nan)
+    if closes:
+        rows = np.array([row_map[close['stock_id']] for close in closes])
+        cols = np.array([close['bar'] - 1 for close in closes])
+        price_matrix[rows, cols] = [close['close'] for close in closes]
+    price_vector = np.full(len(stock_ids), np.nan)
+    ltps = await Ltp.filter(instrument__stock_id__in=stock_ids).values_list('instrument__stock_id', 'price')
+    for stock_id, price in ltps:
+        price_vector[row_map[stock_id]] = price
+    return price_matrix, price_vector
+
+
+def process_batch_rows(strategy: StrategyModule, names: List[str], price_matrix: np.ndarray, price_vector: np.ndarray) -> List[Optional[str]]:
+    ##
+    # Same rules as the per stock path: stocks without a price are left out
+    # and a failing strategy yields no signals instead of an exception.
+    ##
+    sides: List[Optional[str]] = [None] * len(names)
+    priced = np.flatnonzero(~np.isnan(price_vector))
+    for row in np.flatnonzero(np.isnan(price_vector)):
+        logging.error(f"Price not found for {names[row]}")
+    if not priced.size:
+        return sides
+    try:
+        batch_sides = list(strategy.process_batch(price_matrix[priced], price_vector[priced]))
+        if len(batch_sides) != priced.size:
+            raise ValueError(f"process_batch returned {len(batch_sides)} sides for {priced.size} stocks")
+    except Exception as ex:
+        logging.error(f"Could not process strategy for {len(priced)} stocks", exc_info=ex)
+        return sides
+    for row, side in zip(priced.tolist(), batch_sides):
+        logging.info(f"{names[row]} is {side}")
+        sides[row] = side
+    return sides
+
+
+def process_rows(strategy: StrategyModule, names: List[str], price_matrix: np.ndarray, price_vector: np.ndarray) -> List[Optional[str]]:
+    if hasattr(strategy, 'process_batch'):
+        return process_batch_rows(strategy, names, price_matrix, price_vector)
+    sides = []
+    for name, price_array, price in zip(names, price_matrix, price_vector):
+        logging.info(f"Running algo for {name}")
+        if np.isnan(price):
+            logging.error(f"Price not found for {name}")
+            sides.append(None)
+            continue
+        try:
+            side = strategy.process(price_array[~np.isnan(price_array)], float(price))
+        except Exception as ex:
+            logging.error(f"Could not process strategy for {name}", exc_info=ex)
+            sides.append(None)
+            continue
+        logging.info(f"{name} is {side}")
+        sides.append(side)
+    return sides
+
+
+def _process_shared_rows(module_name: str, shm_name: str, shape: Tuple[int, int], start: int, stop: int, names: List[str], price_vector: np.ndarray) -> List[Optional[str]]:
+    shm = SharedMemory(name=shm_name)
+    try:
+        price_matrix = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        sides = process_rows(importlib.import_module(module_name), names, price_matrix[start:stop], price_vector)
+        del price_matrix
+        return sides
+    finally:
+        shm.close()
+
+
+def process_stocks(strategy: StrategyModule, stocks: List[Stock], price_matrix: np.ndarray, price_vector: np.ndarray) -> Dict[Stock, Literal["BUY", "SELL", "HOLD"]]:
+    sides = process_rows(strategy, [str(stock) for stock in stocks], price_matrix, price_vector)
+    return {stock: side for stock, side in zip(stocks, sides) if side is not None}
+
+
+def get_executor_mode(strategy: StrategyModule) -> Literal["inline", "thread", "process"]:
+    name = strategy.__name__.rsplit('.', 1)[-1]
+    return STRATEGY_EXECUTORS.get(name, "inline")
+
+
+def get_executor(mode: Literal["thread", "process"]) -> Executor:
+    executor = _executors.get(mode)
+    if executor is None:
+        if mode == "process":
+            ##
+            # Forking would copy the running loop and its open db sockets into
+            # every worker, spawned workers start clean.
+            ##
+            executor = ProcessPoolExecutor(max_workers=STRATEGY_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=STRATEGY_WORKERS)
+        _executors[mode] = executor
+    return executor
+
+
+def _chunks(strategy: StrategyModule, count: int) -> List[Tuple[int, int]]:
+    ##
+    # process_batch may look across stocks, so it always gets the whole matrix.
+    ##
+    if hasattr(strategy, 'process_batch'):
+        return [(0, count)]
+    bounds = np.linspace(0, count, min(STRATEGY_WORKERS, count) + 1).astype(int).tolist()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+async def _run_in_threads(strategy: StrategyModule, names: List[str], price_matrix: np.ndarray, price_vector: np.ndarray) -> List[Optional[str]]:
+    loop = asyncio.get_running_loop()
+    executor = get_executor("thread")
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, process_rows, strategy, names[start:stop], price_matrix[start:stop], price_vector[start:stop])
+        for start, stop in _chunks(strategy, len(names))
+    ])
+    return [side for sides in results for side in sides]
+
+
+async def _run_in_processes(strategy: StrategyModule, names: List[str], price_matrix: np.ndarray, price_vector: np.ndarray) -> List[Optional[str]]:
+    ##
+    # The price matrix is copied once into shared memory and every worker maps
+    # its own rows, so only the small per chunk arguments are pickled.
+    ##
+    loop = asyncio.get_running_loop()
+    executor = get_executor("process")
+    price_matrix = np.ascontiguousarray(price_matrix, dtype=float)
+    shm = SharedMemory(create=True, size=max(price_matrix.nbytes, 1))
+    try:
+        shared = np.ndarray(price_matrix.shape, dtype=float, buffer=shm.buf)
+        shared[:] = price_matrix
+        del shared
+        results = await asyncio.gather(*[
+            loop.run_in_executor(
+                executor, _process_shared_rows, strategy.__name__, shm.name, price_matrix.shape,
+                start, stop, names[start:stop], price_vector[start:stop]
+            )
+            for start, stop in _chunks(strategy, len(names))
+        ])
+    finally:
+        shm.close()
+        shm.unlink()
+    return [side for sides in results for side in sides]
+
+
+async def run_strategy(strategy: StrategyModule, stocks: List[Stock], price_matrix: np.ndarray, price_vector: np.ndarray, mode: Optional[str] = None) -> Dict[Stock, Literal["BUY", "SELL", "HOLD"]]:
+    mode = mode or get_executor_mode(strategy)
+    if mode == "inline" or not stocks:
+        return process_stocks(strategy, stocks, price_matrix, price_vector)
+    names = [str(stock) for stock in stocks]
+    if mode == "process":
+        try:
+            sides = await _run_in_processes(strategy, names, price_matrix, price_vector)
+            return {stock: side for stock, side in zip(stocks, sides) if side is not None}
+        except Exception as ex:
+            ##
+            # Lambda has no /dev/shm, so neither process pools nor shared
+            # memory can be created there. Workers may also fail to import the
+            # strategy or unpickle its arguments. Errors inside the strategy
+            # are handled by process_rows, so anything reaching here is the
+            # pool's and the rows are run in threads instead.
+            ##
+            logging.error(f"Process pool unavailable for {strategy.__name__}, using threads", exc_info=ex)
+            if isinstance(ex, BrokenProcessPool):
+                _executors.pop("process", None)
+    sides = await _run_in_threads(strategy, names, price_matrix, price_vector)
+    return {stock: side for stock, side in zip(stocks, sides) if side is not None}
+
+
+async def get_signal_cache_key(strategy: StrategyModule, stock_group: StockGroup, stocks: List[Stock]) -> str:
+    ##
+    # Signals only change when the inputs of get_price_matrix do, so the key is
+    # the newest Ltp write and the newest EOD bar behind the group's stocks.
+    ##
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    stock_ids = [stock.id for stock in stocks]
+    ltp_snapshot = await Ltp.filter(
+        instrument__stock_id__in=stock_ids
+    ).annotate(latest=Max('timestamp')).first().values_list('latest', flat=True)
+    eod_date = await Ohlc.filter(
+        instrument__stock_id__in=stock_ids,
+        interval=Interval.EOD,
+        timestamp__lt=today
+    ).annotate(latest=Max('timestamp')).first().values_list('latest', flat=True)
+    name = strategy.__name__.rsplit('.', 1)[-1]
+    return ":".join([
+        name, stock_group.name,
+        ltp_snapshot.isoformat() if ltp_snapshot else "",
+        eod_date.date().isoformat() if eod_date else "",
+    ])
+
+
+async def generate_signals(strategy: StrategyModule, stocks: List[Stock], mode: Optional[str] = None, stock_group: Optional[StockGroup] = None) -> Dict[Stock, Literal["BUY", "SELL", "HOLD"]]:
+    if stock_group is None:
+        price_matrix, price_vector = await get_price_matrix(stocks)
+        return await run_strategy(strategy, stocks, price_matrix, price_vector, mode)
+
+    async def compute() -> Dict[str, str]:
+        signals = await generate_signals(strategy, stocks, mode)
+        return {stock.ticker: str(side) for stock, side in signals.items()}
+
+    key = await get_signal_cache_key(strategy, stock_group, stocks)
+    signals = await get_signal_cache().get_or_compute(key, compute)
+    return {stock: signals[stock.ticker] for stock in stocks if stock.ticker in signals}
@@ -2,7 +2,9 @@ import datetime
 from decimal import Decimal
 import logging
 from typing import List, Literal
+from accounts.pnlrollup import get_monthly_totals
 from accounts.killswitch import exit_all_trades, exit_trades_for_account, reverse_trade_exit, send_trades_from_shadow, reverse_trades
+from algos.shadowstore import load_shadow_state
 from apiserver.utils import JWTAuthBackend, serialize
 from dataaggregator.truedata.datasaver import TrueData
 import settings
@@ -55,6 +57,7 @@ async def get_pnl(request: Request):
     except (KeyError, DoesNotExist, ValueError):
         raise HTTPException(status_code=404)
     trade_exits = TradeExit.filter(position__subscription__account=account)
+    summary = None
     if mode == "open":
         data = await trade_exits.filter(position__active=True).values(
             future_stock_name = 'position__instrument__future__stock__ticker',
@@ -93,6 +96,8 @@ async def get_pnl(request: Request):
             entry_time = 'entry_trade__timestamp',
             exit_time = 'exit_trade__timestamp',
         )
+        totals = await get_monthly_totals(account.id, [date_start])
+        summary = totals.get(date_start, {'pnl': Decimal(0), 'cost': Decimal(0)})
     else:
         raise HTTPException(status_code=400)
     for value_dict in data:
@@ -102,6 +107,8 @@ async def get_pnl(request: Request):
         value_dict['expiry'] = value_dict.get('future_expiry', value_dict.get('option_expiry', None))
         value_dict.pop('future_expiry', None)
         value_dict.pop('option_expiry', None)
+    if summary is not None:
+        return JSONResponse(dict(pnl=serialize(data), summary=serialize([summary])[0]))
     return JSONResponse(dict(pnl=serialize(data)))
 
 
@@ -113,6 +120,7 @@ async def get_shadow(request: Request):
         sub_data = await SubscriptionData.filter(subscription__account=account, subscription__is_hedge=False).get()
     except DoesNotExist:
         raise HTTPException(status_code=404)
+    await load_shadow_state(sub_data)
     shadow_positions = sub_data.data.get('positions', [])
     for values in shadow_positions:
         instrument = await Instrument.filter(
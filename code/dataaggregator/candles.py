@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+import logging
+from typing import Dict, List, Optional, Tuple
+import pytz
+from database.models import Interval, Ohlc
+from database.utils import bulk_upsert
+import settings
+
+
+INTERVAL_SECONDS = {
+    Interval.MIN_1: 60,
+    Interval.MIN_5: 5 * 60,
+    Interval.MIN_30: 30 * 60,
+    Interval.HOUR: 60 * 60,
+}
+MARKET_TIMEZONE = pytz.timezone('Asia/Kolkata')
+MAX_PENDING_CANDLES = getattr(settings, 'MAX_PENDING_CANDLES', 100000)
+
+
+def market_now() -> datetime.datetime:
+    ##
+    # Bars are stored as naive exchange time, the way XTS stamps its candles,
+    # whatever timezone the process runs in.
+    ##
+    return datetime.datetime.now(MARKET_TIMEZONE).replace(tzinfo=None)
+
+
+class Candle:
+
+    __slots__ = ('start', 'open', 'high', 'low', 'close')
+
+    def __init__(self, start: datetime.datetime, open_price: float, high: float, low: float, close: float) -> None:
+        self.start = start
+        self.open = open_price
+        self.high = high
+        self.low = low
+        self.close = close
+
+    def merge(self, high: float, low: float, close: float):
+        self.high = max(self.high, high)
+        self.low = min(self.low, low)
+        self.close = close
+
+
+class CandleBuilder:
+
+    flush_seconds = 5
+
+    def __init__(self, higher_intervals: Tuple[Interval, ...] = (Interval.MIN_5, Interval.MIN_30, Interval.HOUR), max_pending: int = MAX_PENDING_CANDLES) -> None:
+        self.higher_intervals = higher_intervals
+        self.max_pending = max_pending
+        self._open: Dict[Tuple[int, Interval], Candle] = {}
+        self._closed: Dict[Tuple[int, Interval, datetime.datetime], Candle] = {}
+        self._last_closed: Dict[Tuple[int, Interval], datetime.datetime] = {}
+
+    @staticmethod
+    def bucket(timestamp: datetime.datetime, interval: Interval) -> datetime.datetime:
+        day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = int((timestamp - day).total_seconds())
+        return day + datetime.timedelta(seconds=seconds - seconds % INTERVAL_SECONDS[interval])
+
+    def add_tick(self, instrument_id: int, price: float, timestamp: Optional[datetime.datetime] = None):
+        self.add_bar(instrument_id, timestamp or market_now(), price, price, price, price)
+
+    def add_bar(self, instrument_id: int, timestamp: datetime.datetime, open_price: float, high: float, low: float, close: float):
+        ##
+        # Ticks and streamed candles only ever touch the 1 minute bar. Higher
+        # intervals are built from 1 minute bars as they close, so each tick
+        # costs one dict lookup however many intervals are kept.
+        ##
+        self._update(instrument_id, Interval.MIN_1, timestamp, open_price, high, low, close)
+
+    def _update(self, instrument_id: int, interval: Interval, timestamp: datetime.datetime, open_price: float, high: float, low: float, close: float):
+        start = self.bucket(timestamp, interval)
+        key = (instrument_id, interval)
+        candle = self._open.get(key)
+        if candle is not None and candle.start == start:
+            candle.merge(high, low, close)
+            return
+        if (candle is not None and candle.start > start) or start <= self._last_closed.get(key, datetime.datetime.min):
+            return
+        if candle is not None:
+            self._close(instrument_id, interval, candle)
+        self._open[key] = Candle(start, open_price, high, low, close)
+
+    def _close(self, instrument_id: int, interval: Interval, candle: Candle):
+        self._closed[(instrument_id, interval, candle.start)] = candle
+        self._last_closed[(instrument_id, interval)] = candle.start
+        if interval == Interval.MIN_1:
+            for higher_interval in self.higher_intervals:
+                self._update(instrument_id, higher_interval, candle.start, candle.open, candle.high, candle.low, candle.close)
+
+    def close_due(self, now: Optional[datetime.datetime] = None):
+        now = now or market_now()
+        for interval in (Interval.MIN_1, *self.higher_intervals):
+            length = datetime.timedelta(seconds=INTERVAL_SECONDS[interval])
+            for (instrument_id, candle_interval), candle in list(self._open.items()):
+                if candle_interval == interval and candle.start + length <= now:
+                    del self._open[(instrument_id, interval)]
+                    self._close(instrument_id, interval, candle)
+
+    async def flush(self, now: Optional[datetime.datetime] = None) -> List[Ohlc]:
+        self.close_due(now)
+        closed, self._closed = self._closed, {}
+        ohlcs = [
+            Ohlc(instrument_id=instrument_id, timestamp=start, interval=interval, open=candle.open, high=candle.high, low=candle.low, close=candle.close)
+            for (instrument_id, interval, start), candle in closed.items()
+        ]
+        try:
+            await bulk_upsert(Ohlc, ohlcs, ['instrument_id', 'timestamp', 'interval'], ['open', 'high', 'low', 'close'])
+        except Exception as ex:
+            ##
+            # Unsaved bars are retried on the next flush, but only up to
+            # max_pending so a database outage cannot grow memory without end.
+            ##
+            logging.error("Error in saving candles", exc_info=ex)
+            dropped = 0
+            for key, candle in closed.items():
+                if len(self._closed) < self.max_pending:
+                    self._closed.setdefault(key, candle)
+                else:
+                    dropped += 1
+            if dropped:
+                logging.error(f"Dropped {dropped} unsaved candles past {self.max_pending}")
+            return []
+        return ohlcs
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.flush_seconds)
+                await self.flush()
+        finally:
+            await self.flush()
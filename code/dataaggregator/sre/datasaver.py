@@ -1,26 +1,41 @@
+import asyncio
 import datetime
-from typing import Dict, List, Literal, Tuple
+import json
+import logging
+from typing import Dict, List, Literal, Optional, Tuple
 import settings
 import aiohttp
-import aioredis
 import socketio
 import os
 import io
+import tempfile
 import pandas as pd
+from dataaggregator.candles import CandleBuilder
+from dataaggregator.tickstore import BaseTickStore, get_tick_store
 from database.models import Instrument, Stock
 from urllib.parse import urlencode
 
 
+SEGMENT_CODES = {'NSECM': 1, 'NSEFO': 2}
+
+
 class SREMarketData:
 
+    instrument_master_path = os.path.join(tempfile.gettempdir(), 'sre_instrument_master.pkl')
+
     def __init__(self) -> None:
         self._access_token = None
         self._user_id = None
         self._api_root = "https://xts.sre.co.in/apimarketdata"
         self._socketio_root = "https://xts.sre.co.in"
         self._instrument_master = pd.DataFrame()
+        self._instrument_index: Dict[str, int] = {}
+        self._exchange_instrument_ids: Dict[int, int] = {}
         self.sio = socketio.AsyncClient()
-        # self.redis = aioredis.from_url(settings.REDIS_URL)
+        self.tick_store: Optional[BaseTickStore] = None
+        self.candle_builder: Optional[CandleBuilder] = None
+        self._subscriptions: List[dict] = []
+        self._tick_instrument_ids: Dict[Tuple[int, int], int] = {}
 
     @property
     def access_token(self):
@@ -49,7 +64,7 @@ class SREMarketData:
                 return res.ok
             
     def _get_exchange_segment(self, instrument: Instrument):
-        if instrument.stock:
+        if instrument.stock_id:
             return "NSECM"
         else:
             return "NSEFO"
@@ -64,7 +79,46 @@ class SREMarketData:
             base_symbol = ticker
         return base_symbol
         
-    async def get_instrument_master(self):
+    def _read_cached_master(self) -> Optional[pd.DataFrame]:
+        try:
+            modified = datetime.date.fromtimestamp(os.path.getmtime(self.instrument_master_path))
+            if modified != datetime.date.today():
+                return None
+            return pd.read_pickle(self.instrument_master_path)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            logging.error("Error in reading cached instrument master", exc_info=ex)
+            return None
+
+    def _write_cached_master(self, df: pd.DataFrame):
+        tmp_path = f"{self.instrument_master_path}.tmp"
+        try:
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, self.instrument_master_path)
+        except Exception as ex:
+            logging.error("Error in caching instrument master", exc_info=ex)
+
+    def _set_instrument_master(self, df: pd.DataFrame):
+        ##
+        # Descriptions are looked up once per order, so they are indexed here
+        # instead of scanning the master. The first row wins on duplicates as
+        # with the old df[...].iloc[0] lookup.
+        ##
+        self._instrument_master = df
+        unique = df.drop_duplicates('Description')
+        self._instrument_index = dict(zip(unique['Description'], unique['ExchangeInstrumentID'].tolist()))
+        self._exchange_instrument_ids = {}
+
+    async def get_instrument_master(self, use_cache=True):
+        df = self._read_cached_master() if use_cache else None
+        if df is None:
+            df = await self.download_instrument_master()
+            self._write_cached_master(df)
+        self._set_instrument_master(df)
+        return df
+
+    async def download_instrument_master(self) -> pd.DataFrame:
         async with aiohttp.ClientSession() as session:
             async with session.post(f"{self._api_root}/instruments/master", json={
                 'exchangeSegmentList': ['NSECM', 'NSEFO']
@@ -109,22 +163,24 @@ class SREMarketData:
         df['PriceDenominator'].fillna(df[mask_opt]['extra8'], inplace=True)
         df['FullName'].fillna(df[mask_opt]['extra9'], inplace=True)
         df.drop(columns=['extra1', 'extra2', 'extra3', 'extra4', 'extra5', 'extra6', 'extra7', 'extra8', 'extra9'], inplace=True)
-        self._instrument_master = df
         return df
 
     async def _get_exchange_instrument_id(self, instrument: Instrument):
-        df = self._instrument_master
+        if instrument.id in self._exchange_instrument_ids:
+            return self._exchange_instrument_ids[instrument.id]
         await instrument.fetch_related('stock', 'future__stock', 'option__stock')
         if instrument.stock:
             symbol = self._get_base_symbol(instrument.stock)
-            row = df[df['Description'] == f"{symbol}-EQ"].iloc[0]
+            description = f"{symbol}-EQ"
         elif instrument.future:
             symbol = self._get_base_symbol(instrument.future.stock)
-            row = df[df['Description'] == f"{symbol}{instrument.future.expiry.strftime('%y%b').upper()}FUT"].iloc[0]
+            description = f"{symbol}{instrument.future.expiry.strftime('%y%b').upper()}FUT"
         elif instrument.option:
             symbol = self._get_base_symbol(instrument.option.stock)
-            row = df[df['Description'] == f"{symbol}{instrument.option.expiry.strftime('%y%b').upper()}{instrument.option.strike}{instrument.option.option_type.value}"].iloc[0]
-        return row['ExchangeInstrumentID']
+            description = f"{symbol}{instrument.option.expiry.strftime('%y%b').upper()}{instrument.option.strike}{instrument.option.option_type.value}"
+        exchange_instrument_id = self._instrument_index[description]
+        self._exchange_instrument_ids[instrument.id] = exchange_instrument_id
+        return exchange_instrument_id
     
     async def _market_depth_api(self, instruments: List[dict]) -> Dict[Literal['Bids', 'Asks'], List[Dict[Literal['Price'], float]]]:
         async with aiohttp.ClientSession() as session:
@@ -140,9 +196,8 @@ class SREMarketData:
                 return data['result']['listQuotes']
     
     async def subscribe_ticker(self, tickers: List[str], segment: Literal["NSECM", "NSEFO"]) -> Dict[Literal['Bids', 'Asks'], List[Dict[Literal['Price'], float]]]:
-        df = self._instrument_master
         instruments = [{
-            'exchangeInstrumentID': df[df['Description'] == ticker].iloc[0]['ExchangeInstrumentID'],
+            'exchangeInstrumentID': self._instrument_index[ticker],
             'exchangeSegment': segment
         } for ticker in tickers]
         return await self._market_depth_api(instruments)
@@ -150,25 +205,74 @@ class SREMarketData:
     async def get_bid_ask(self, instrument: Instrument) -> Tuple[List[Dict[Literal['Price'], float]], List[Dict[Literal['Price'], float]]]:
         market_depth = await self._market_depth_api([{
             'exchangeInstrumentID': int(await self._get_exchange_instrument_id(instrument)),
-            'exchangeSegment': "NSECM" if instrument.stock else "NSEFO"
+            'exchangeSegment': "NSECM" if instrument.stock_id else "NSEFO"
         }])
         return market_depth['Bids'], market_depth['Asks']
 
+    async def subscribe_instruments(self, instruments: List[dict], message_code: int = 1501):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{self._api_root}/instruments/subscription", json={
+                'instruments': instruments,
+                'xtsMessageCode': message_code
+            }, headers={
+                'authorization': self.access_token
+            }) as res:
+                if not res.ok:
+                    raise ValueError("Subscription failed")
+                return await res.json()
+
     async def _on_connect(self):
-        print("Connected")
+        logging.info("Market data stream connected")
+        if self._subscriptions:
+            await self.subscribe_instruments(self._subscriptions)
+            if self.candle_builder is not None:
+                await self.subscribe_instruments(self._subscriptions, message_code=1505)
 
     async def _on_disconnect(self):
-        print("Connected")
-    
+        logging.info("Market data stream disconnected")
+
+    def _get_tick_instrument_id(self, data: dict) -> Optional[int]:
+        return self._tick_instrument_ids.get((data.get('ExchangeSegment'), data.get('ExchangeInstrumentID')))
+
+    async def _save_tick(self, data: dict, price: float = None, bid: float = None, ask: float = None):
+        instrument_id = self._get_tick_instrument_id(data)
+        if instrument_id is None:
+            return
+        if self.candle_builder is not None and price:
+            self.candle_builder.add_tick(instrument_id, price)
+        if self.tick_store is not None:
+            await self.tick_store.set_tick(instrument_id, price=price, bid=bid, ask=ask)
+
     async def _on_touchline(self, data: dict):
-        print(data)
+        data = json.loads(data) if isinstance(data, str) else data
+        touchline = data.get('Touchline', {})
+        await self._save_tick(
+            data,
+            price=touchline.get('LastTradedPrice'),
+            bid=touchline.get('BidInfo', {}).get('Price'),
+            ask=touchline.get('AskInfo', {}).get('Price')
+        )
 
     async def _on_marketdepth(self, data: dict):
-        exchange_instrument_id = data['ExchangeInstrumentID']
-        await self.redis.hmset(exchange_instrument_id, data)
+        data = json.loads(data) if isinstance(data, str) else data
+        bids, asks = data.get('Bids') or [{}], data.get('Asks') or [{}]
+        await self._save_tick(
+            data,
+            price=data.get('Touchline', {}).get('LastTradedPrice'),
+            bid=bids[0].get('Price'),
+            ask=asks[0].get('Price')
+        )
 
     async def _on_candle(self, data: dict):
-        print(data)
+        data = json.loads(data) if isinstance(data, str) else data
+        instrument_id = self._get_tick_instrument_id(data)
+        if self.candle_builder is None or instrument_id is None:
+            return
+        ##
+        # XTS bar times are seconds since 1980-01-01 exchange time.
+        ##
+        timestamp = datetime.datetime(1980, 1, 1) + datetime.timedelta(seconds=data['BarTime'])
+        self.candle_builder.add_bar(instrument_id, timestamp, data['Open'], data['High'], data['Low'], data['Close'])
 
     async def _on_marketstatus(self, data: dict):
         print(data)
@@ -177,7 +281,8 @@ class SREMarketData:
         print(data)
 
     async def _on_ltp(self, data: dict):
-        print(data)
+        data = json.loads(data) if isinstance(data, str) else data
+        await self._save_tick(data, price=data.get('LastTradedPrice'))
 
     async def run_socketio(self):
         self.sio.on('connect', self._on_connect)
@@ -195,4 +300,32 @@ class SREMarketData:
             'broadcastMode': "Full"
         })
         await self.sio.connect(self._socketio_root + "?" + params, socketio_path="/apimarketdata/socket.io", )
-        await self.sio.wait()
\ No newline at end of file
+        await self.sio.wait()
+
+    async def run_tick_ingestion(self, instruments: List[Instrument], tick_store: Optional[BaseTickStore] = None, candle_builder: Optional[CandleBuilder] = None):
+        ##
+        # Keeps last price, best bid/ask and receive time per Instrument.id in
+        # the tick store for as long as the stream runs. Ticks are keyed by
+        # segment as exchange instrument ids are only unique within one.
+        ##
+        self.tick_store = tick_store or get_tick_store()
+        self.candle_builder = candle_builder
+        if not self._instrument_index:
+            await self.get_instrument_master()
+        self._subscriptions = []
+        for instrument in instruments:
+            try:
+                exchange_instrument_id = int(await self._get_exchange_instrument_id(instrument))
+            except KeyError as ex:
+                logging.error(f"No exchange instrument for {instrument.id}", exc_info=ex)
+                continue
+            segment = self._get_exchange_segment(instrument)
+            self._tick_instrument_ids[(SEGMENT_CODES[segment], exchange_instrument_id)] = instrument.id
+            self._subscriptions.append({'exchangeSegment': segment, 'exchangeInstrumentID': exchange_instrument_id})
+        flusher = asyncio.create_task(candle_builder.run()) if candle_builder else None
+        try:
+            await self.run_socketio()
+        finally:
+            if flusher:
+                flusher.cancel()
+                await asyncio.gather(flusher, return_exceptions=True)
\ No newline at end of file
@@ -0,0 +1,108 @@
+import time
+from typing import Dict, Iterable, Optional
+import aioredis
+import settings
+
+
+TICK_STORE = getattr(settings, 'TICK_STORE', "local")
+
+
+class BaseTickStore:
+
+    async def set_tick(self, instrument_id: int, price: float = None, bid: float = None, ask: float = None, timestamp: float = None):
+        raise NotImplementedError
+
+    async def get_ticks(self, instrument_ids: Iterable[int]) -> Dict[int, Dict[str, float]]:
+        raise NotImplementedError
+
+    async def get_tick(self, instrument_id: int) -> Optional[Dict[str, float]]:
+        return (await self.get_ticks([instrument_id])).get(instrument_id)
+
+    async def get_prices(self, instrument_ids: Iterable[int], max_age: float) -> Dict[int, float]:
+        now = time.time()
+        return {
+            instrument_id: tick['price']
+            for instrument_id, tick in (await self.get_ticks(instrument_ids)).items()
+            if 'price' in tick and now - tick.get('price_timestamp', 0) <= max_age
+        }
+
+    async def get_price(self, instrument_id: int, max_age: float) -> Optional[float]:
+        return (await self.get_prices([instrument_id], max_age)).get(instrument_id)
+
+    @staticmethod
+    def _tick_values(price, bid, ask, timestamp) -> Dict[str, float]:
+        ##
+        # Depth ticks carry only bid and ask, so the last price keeps its own
+        # receive time and its age is never taken from a later depth tick.
+        ##
+        values = {key: value for key, value in (('price', price), ('bid', bid), ('ask', ask)) if value is not None}
+        values['timestamp'] = timestamp or time.time()
+        if price is not None:
+            values['price_timestamp'] = values['timestamp']
+        return values
+
+
+class LocalTickStore(BaseTickStore):
+
+    def __init__(self) -> None:
+        self._ticks: Dict[int, Dict[str, float]] = {}
+
+    async def set_tick(self, instrument_id: int, price: float = None, bid: float = None, ask: float = None, timestamp: float = None):
+        self._ticks.setdefault(instrument_id, {}).update(self._tick_values(price, bid, ask, timestamp))
+
+    async def get_ticks(self, instrument_ids: Iterable[int]) -> Dict[int, Dict[str, float]]:
+        return {
+            instrument_id: dict(self._ticks[instrument_id])
+            for instrument_id in instrument_ids if instrument_id in self._ticks
+        }
+
+
+class RedisTickStore(BaseTickStore):
+
+    key_prefix = "tick:"
+    expire_seconds = 24 * 60 * 60
+
+    def __init__(self, url: str) -> None:
+        self.redis = aioredis.from_url(url, decode_responses=True)
+
+    async def set_tick(self, instrument_id: int, price: float = None, bid: float = None, ask: float = None, timestamp: float = None):
+        key = f"{self.key_prefix}{instrument_id}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping=self._tick_values(price, bid, ask, timestamp))
+            pipe.expire(key, self.expire_seconds)
+            await pipe.execute()
+
+    async def get_ticks(self, instrument_ids: Iterable[int]) -> Dict[int, Dict[str, float]]:
+        instrument_ids = list(instrument_ids)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for instrument_id in instrument_ids:
+                pipe.hgetall(f"{self.key_prefix}{instrument_id}")
+            results = await pipe.execute()
+        return {
+            instrument_id: {key: float(value) for key, value in tick.items()}
+            for instrument_id, tick in zip(instrument_ids, results) if tick
+        }
+
+
+_tick_store: Optional[BaseTickStore] = None
+
+
+def get_tick_store() -> BaseTickStore:
+    global _tick_store
+    if _tick_store is None:
+        ##
+        # TICK_STORE is "local" for a single process or "redis" to share ticks
+        # between the ingestion task and the algo runs through REDIS_URL.
+        ##
+        if TICK_STORE == "redis":
+            _tick_store = RedisTickStore(settings.REDIS_URL)
+        elif TICK_STORE == "local":
+            _tick_store = LocalTickStore()
+        else:
+            raise ValueError(f"Unknown TICK_STORE {TICK_STORE}")
+    return _tick_store
+
+
+def set_tick_store(tick_store: Optional[BaseTickStore]):
+    global _tick_store
+    _tick_store = tick_store
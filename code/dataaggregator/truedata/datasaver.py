@@ -1,5 +1,6 @@
+import asyncio
 import logging
-from typing import List, Literal
+from typing import Dict, List, Literal, Optional, Tuple
 import io
 import datetime
 import aiohttp
@@ -7,15 +8,24 @@ import numpy as np
 import settings
 import pandas as pd
 from asyncio import sleep
+from dataaggregator.ratelimit import TokenBucket
 from database.models import Future, Instrument, Interval, Ohlc, Ltp, Option, OptionType, Position, Stock, StockGroupMap
+from database.prevclose import refresh_prev_closes
+from database.utils import assign_ids, bulk_upsert
 from tortoise.models import Q
-from tortoise.exceptions import DoesNotExist, MultipleObjectsReturned
 from tortoise.expressions import Subquery
 from tortoise.transactions import in_transaction
 
 
 class TrueData:
 
+    history_rate = 5
+    history_burst = 5
+    history_concurrency = 5
+    history_batch_size = 25
+    history_nbars = 365
+    history_incremental_window = datetime.timedelta(days=30)
+
     def __init__(self) -> None:
         self._access_token = None
 
@@ -110,88 +120,161 @@ class TrueData:
                 await Ltp.filter(instrument_id__in=instrument_ids).delete()
                 await Ltp.bulk_create(ltps)
 
-    async def save_historical_data(self, instruments: List[Instrument]):
+    async def get_historical_bars(self, session: aiohttp.ClientSession, symbol: str, nbars: int = 365) -> pd.DataFrame:
+        async with session.get("https://history.truedata.in/getlastnbars", params={
+            'symbol': symbol,
+            'nbars': nbars,
+            'response': 'csv',
+            'interval': 'eod',
+            'bidask': 0
+        }) as res:
+            data = await res.text()
+        return pd.read_csv(io.StringIO(data))
+
+    @staticmethod
+    async def save_ohlc_batch(batch: List[Tuple[Instrument, pd.DataFrame]]):
+        ##
+        # The downloaded range replaces what is stored from its first bar on,
+        # so bars the vendor has since dropped go away like they used to.
+        # Instruments starting on the same day share one delete.
+        ##
+        ohlcs = []
+        starts: Dict[datetime.datetime, List[int]] = {}
+        for instrument, df in batch:
+            df = df.drop_duplicates(subset='timestamp', keep='last')
+            timestamps = pd.to_datetime(df['timestamp']).dt.to_pydatetime()
+            starts.setdefault(min(timestamps), []).append(instrument.id)
+            ohlcs += [
+                Ohlc(instrument_id=instrument.id, timestamp=timestamp, interval=Interval.EOD, open=open_price, high=high, low=low, close=close)
+                for timestamp, open_price, high, low, close in zip(
+                    timestamps, df['dopen'].to_list(), df['dhigh'].to_list(), df['dlow'].to_list(), df['dclose'].to_list()
+                )
+            ]
+        logging.info(f"Entering to db {len(ohlcs)}")
         async with in_transaction():
-            ohlcs = []
-            for instrument in instruments:
-                await sleep(0.5)
+            for start, instrument_ids in starts.items():
+                await Ohlc.filter(instrument_id__in=instrument_ids, interval=Interval.EOD, timestamp__gte=start).delete()
+            await bulk_upsert(Ohlc, ohlcs, ['instrument_id', 'timestamp', 'interval'], ['open', 'high', 'low', 'close'])
+
+    async def get_last_bars(self, instruments: List[Instrument]) -> Dict[int, Tuple[datetime.datetime, float]]:
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        bars = await Ohlc.filter(
+            instrument_id__in=[instrument.id for instrument in instruments],
+            interval=Interval.EOD,
+            timestamp__gte=today - self.history_incremental_window
+        ).order_by('timestamp').values_list('instrument_id', 'timestamp', 'close')
+        return {inst_id: (timestamp.replace(tzinfo=None), close) for inst_id, timestamp, close in bars}
+
+    @staticmethod
+    def is_continuous(df: pd.DataFrame, last_timestamp: datetime.datetime, last_close: float) -> bool:
+        ##
+        # The first requested bar overlaps the last stored one. If it is missing
+        # bars were skipped, if its close moved the history was adjusted for a
+        # corporate action. Either way the stored bars can't be extended.
+        ##
+        if df.empty:
+            return False
+        overlap = df[pd.to_datetime(df['timestamp']) == last_timestamp]
+        return not overlap.empty and np.isclose(overlap['dclose'].iloc[-1], last_close, rtol=1e-4)
+
+    async def save_historical_data(self, instruments: List[Instrument], incremental=False):
+        ##
+        # Downloads share one session and run history_concurrency at a time,
+        # paced by the token bucket. Finished frames are written every
+        # history_batch_size instruments so no transaction spans network calls.
+        ##
+        limiter = TokenBucket(self.history_rate, self.history_burst)
+        semaphore = asyncio.Semaphore(self.history_concurrency)
+        headers = {'Authorization': f"Bearer {self.access_token}"}
+        last_bars = await self.get_last_bars(instruments) if incremental else {}
+        today = datetime.date.today()
+        async with aiohttp.ClientSession(headers=headers) as session:
+
+            async def fetch(symbol: str, nbars: int) -> pd.DataFrame:
+                await limiter.acquire()
+                return await self.get_historical_bars(session, symbol, nbars)
+
+            async def download(instrument: Instrument) -> Tuple[Instrument, Optional[pd.DataFrame]]:
                 symbol = await self.get_symbol(instrument)
-                logging.info(f"Saving historical data for {symbol}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get("https://history.truedata.in/getlastnbars", params={
-                        'symbol': symbol,
-                        'nbars': 365,
-                        'response': 'csv',
-                        'interval': 'eod',
-                        'bidask': 0
-                    }, headers={
-                        'Authorization': f"Bearer {self.access_token}"
-                    }) as res:
-                        data = await res.text()
-                        df = pd.read_csv(io.StringIO(data))
-                logging.info(f"Entering to db {df.shape[0]}")
-                inst_ohlcs = {}
-                for row in df.itertuples():
-                    ohlc = Ohlc(
-                        instrument=instrument,
-                        timestamp=row.timestamp,
-                        interval=Interval.EOD,
-                        open=row.dopen,
-                        high=row.dhigh,
-                        low=row.dlow,
-                        close=row.dclose
-                    )
-                    inst_ohlcs[row.timestamp] = ohlc
-                if inst_ohlcs:
-                    timestamp = min(ohlc.timestamp for ohlc in inst_ohlcs.values())
-                    await Ohlc.filter(instrument=instrument, interval=Interval.EOD, timestamp__gte=timestamp).delete()
-                    ohlcs += list(inst_ohlcs.values())
-            await Ohlc.bulk_create(ohlcs)
+                async with semaphore:
+                    logging.info(f"Saving historical data for {symbol}")
+                    try:
+                        last_bar = last_bars.get(instrument.id)
+                        if not last_bar:
+                            return instrument, await fetch(symbol, self.history_nbars)
+                        nbars = int(np.busday_count(last_bar[0].date(), today)) + 1
+                        df = await fetch(symbol, min(nbars, self.history_nbars))
+                        if not self.is_continuous(df, *last_bar):
+                            logging.info(f"Gap or adjustment in {symbol}, fetching full history")
+                            df = await fetch(symbol, self.history_nbars)
+                        return instrument, df
+                    except Exception as ex:
+                        logging.error(f"Error in getting historical data for {symbol}", exc_info=ex)
+                        return instrument, None
 
-    async def save_historical_data_for_stocks(self):
+            batch = []
+            for task in asyncio.as_completed([download(instrument) for instrument in instruments]):
+                instrument, df = await task
+                if df is None or df.empty:
+                    continue
+                batch.append((instrument, df))
+                if len(batch) >= self.history_batch_size:
+                    await self.save_ohlc_batch(batch)
+                    batch = []
+            if batch:
+                await self.save_ohlc_batch(batch)
+
+    async def save_historical_data_for_stocks(self, incremental=False):
         instruments = await Instrument.filter(stock_id__in=Subquery(StockGroupMap.all().values('stock__id')))
         instruments += await Instrument.filter(stock__is_index=True)
-        await self.save_historical_data(instruments)
+        await self.save_historical_data(instruments, incremental=incremental)
 
-    async def save_historical_data_for_futures(self):
+    async def save_historical_data_for_futures(self, incremental=False):
         instruments = await Instrument.filter(
             future__stock_id__in=Subquery(StockGroupMap.all().values('stock__id')),
             future__expiry__gte=datetime.date.today()
         )
-        await self.save_historical_data(instruments)
+        await self.save_historical_data(instruments, incremental=incremental)
+
+    @staticmethod
+    async def save_prices(ltps: List[Ltp], ohlcs: List[Ohlc], instrument_ids: List[int], timestamp: datetime.datetime, upsert=False):
+        async with in_transaction():
+            if upsert:
+                await bulk_upsert(Ltp, ltps, ['instrument_id'], ['price', 'timestamp'])
+                await bulk_upsert(Ohlc, ohlcs, ['instrument_id', 'timestamp', 'interval'], ['open', 'high', 'low', 'close'])
+                return
+            await Ltp.filter(instrument_id__in=instrument_ids).delete()
+            await Ltp.bulk_create(ltps)
+            if ohlcs:
+                await Ohlc.filter(instrument_id__in=instrument_ids, interval=Interval.EOD, timestamp__gte=timestamp).delete()
+                await Ohlc.bulk_create(ohlcs)
 
-    async def save_ltp_all(self, eq=True, fo=True, ohlc=True):
+    async def save_ltp_all(self, eq=True, fo=True, ohlc=True, upsert=False):
         if eq:
             df = await self.get_bhavcopy('EQ')
-            symbols = df['symbol'].to_list()
-            instruments = await Instrument.filter(stock__ticker__in=symbols).select_related('stock')
+            instruments = await Instrument.filter(
+                stock__ticker__in=df['symbol'].to_list()
+            ).values('id', symbol='stock__ticker')
+            df2 = pd.merge(
+                pd.DataFrame(instruments, columns=['id', 'symbol']),
+                df.drop_duplicates(subset='symbol'),
+                on='symbol'
+            )
             now = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            ltps = []
+            instrument_ids = df2['id'].to_list()
+            ltps = [
+                Ltp(instrument_id=inst_id, price=close)
+                for inst_id, close in zip(instrument_ids, df2['close'].to_list())
+            ]
             ohlcs = []
-            for instrument in instruments:
-                try:
-                    row = df[df['symbol'] == instrument.stock.ticker].iloc[0]
-                except (IndexError, KeyError):
-                    logging.error(f"Error in getting price for {instrument.stock}")
-                    continue
-                ltps.append(Ltp(instrument=instrument, price=row['close']))
-                if ohlc:
-                    ohlcs.append(Ohlc(
-                        instrument=instrument,
-                        timestamp=now,
-                        interval=Interval.EOD,
-                        open=row['open'],
-                        high=row['high'],
-                        low=row['low'],
-                        close=row['close']
-                    ))
-            instrument_ids = [inst.id for inst in instruments]
-            async with in_transaction():
-                await Ltp.filter(instrument_id__in=instrument_ids).delete()
-                await Ltp.bulk_create(ltps)
-                if ohlc:
-                    await Ohlc.filter(instrument_id__in=instrument_ids, interval=Interval.EOD, timestamp__gte=now).delete()
-                    await Ohlc.bulk_create(ohlcs)
+            if ohlc:
+                ohlcs = [
+                    Ohlc(instrument_id=inst_id, timestamp=now, interval=Interval.EOD, open=open_price, high=high, low=low, close=close)
+                    for inst_id, open_price, high, low, close in df2[['id', 'open', 'high', 'low', 'close']].itertuples(index=False)
+                ]
+            await self.save_prices(ltps, ohlcs, instrument_ids, now, upsert=upsert)
+            if ohlcs:
+                await refresh_prev_closes(since=now.date())
         if fo:
             df = await self.get_bhavcopy('FO')
             futures = await Instrument.filter(future_id__isnull=False).values('id', 'future__stock__name', 'future__expiry')
@@ -216,99 +299,137 @@ class TrueData:
                 ltps.append(Ltp(instrument_id=row.id, price=row.close))
             option_ids = df2['id'].to_list()
             instrument_ids = future_ids + option_ids
-            async with in_transaction():
-                await Ltp.filter(instrument_id__in=instrument_ids).delete()
-                await Ltp.bulk_create(ltps)
+            await self.save_prices(ltps, [], instrument_ids, None, upsert=upsert)
 
-    async def populate_instruments(self):
+    async def get_all_symbols(self, segment: Literal['eq', 'fo']) -> pd.DataFrame:
         async with aiohttp.ClientSession() as session:
             async with session.get("https://api.truedata.in/getAllSymbols", params={
-                'segment': 'eq',
-                'user': settings.TRUEDATA_USERNAME,
-                'password': settings.TRUEDATA_PASSWORD,
-                'csv': 'true',
-                'allexpiry': 'false'
-            }) as res:
-                data = await res.text()
-                df = pd.read_csv(io.StringIO(data),
-                    names=['truedata_id', 'symbol', 'type', 'isin', 'exchange', 'lot_size', 'strike', 'expiry', 'extra_1', 'extra_2']    
-                )
-        for row in df.itertuples():
-            if row.type in ['EQ', 'IN']:
-                stock = await Stock.filter(ticker=row.symbol).get_or_none()
-                is_index = row.type == 'IN'
-                if not stock:
-                    stock = await Stock.create(
-                        ticker=row.symbol,
-                        isin=row.isin,
-                        is_index=is_index,
-                        name=row.extra_1,
-                    )
-                elif stock.is_index != is_index or stock.name != row.extra_1 or stock.ticker != row.symbol:
-                    stock.ticker = row.symbol
-                    stock.is_index = is_index
-                    stock.name = row.extra_1
-                    await stock.save()
-                await Instrument.get_or_create(
-                    stock=stock,
-                    future=None,
-                    option=None
-                )
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://api.truedata.in/getAllSymbols", params={
-                'segment': 'fo',
+                'segment': segment,
                 'user': settings.TRUEDATA_USERNAME,
                 'password': settings.TRUEDATA_PASSWORD,
                 'csv': 'true',
                 'allexpiry': 'false'
             }) as res:
                 data = await res.text()
-                df = pd.read_csv(io.StringIO(data),
-                    names=['truedata_id', 'symbol', 'type', 'isin', 'exchange', 'lot_size', 'strike', 'expiry', 'extra_1', 'extra_2']    
-                )
+        return pd.read_csv(io.StringIO(data),
+            names=['truedata_id', 'symbol', 'type', 'isin', 'exchange', 'lot_size', 'strike', 'expiry', 'extra_1', 'extra_2']
+        )
+
+    @staticmethod
+    async def sync_stocks(df: pd.DataFrame):
+        df = df[df['type'].isin(['EQ', 'IN'])].drop_duplicates('symbol', keep='last')
+        df = df.astype(object).where(df.notna(), None)
+        stocks = {stock.ticker: stock for stock in await Stock.all()}
+        new_stocks, updated_stocks = [], []
+        for symbol, isin, stock_type, name in zip(df['symbol'], df['isin'], df['type'], df['extra_1']):
+            is_index = stock_type == 'IN'
+            stock = stocks.get(symbol)
+            if not stock:
+                stock = Stock(ticker=symbol, isin=isin, is_index=is_index, name=name)
+                stocks[symbol] = stock
+                new_stocks.append(stock)
+            elif stock.is_index != is_index or stock.name != name:
+                stock.is_index = is_index
+                stock.name = name
+                updated_stocks.append(stock)
+        async with in_transaction():
+            await assign_ids(new_stocks)
+            await Stock.bulk_create(new_stocks, batch_size=1000)
+            if updated_stocks:
+                await Stock.bulk_update(updated_stocks, fields=['is_index', 'name'], batch_size=1000)
+            stock_ids = {stocks[symbol].id for symbol in df['symbol']}
+            existing = set(await Instrument.filter(stock_id__in=list(stock_ids)).values_list('stock_id', flat=True))
+            await Instrument.bulk_create([
+                Instrument(stock_id=stock_id) for stock_id in stock_ids - existing
+            ], batch_size=1000)
+
+    @staticmethod
+    async def sync_derivatives(df: pd.DataFrame):
+        ##
+        # Contracts map to stocks by name, names that match no stock or more
+        # than one are skipped like before. Existing contracts are only loaded
+        # for the expiries in the master and keyed the same way as the rows.
+        ##
+        stock_names = pd.Series(dict(await Stock.all().values_list('id', 'name')), dtype=object)
+        name_counts = stock_names.value_counts()
+        unique_names = stock_names[stock_names.map(name_counts) == 1]
+        name_map = pd.Series(unique_names.index, index=unique_names.values)
+        df = df.assign(
+            stock_id=df['name'].map(name_map),
+            expiry=pd.to_datetime(df['expiry'], format="%d-%m-%Y").dt.date
+        )
+        for name in df.loc[df['stock_id'].isna(), 'name'].unique():
+            logging.error(f"Error for stock {name}")
+        df = df.dropna(subset='stock_id').astype({'stock_id': int, 'lot_size': int})
+        futures_df = df[df['type'] == 'XX'].drop_duplicates(['stock_id', 'expiry'], keep='last')
+        options_df = df[df['type'] != 'XX'].astype({'strike': int}).drop_duplicates(
+            ['stock_id', 'strike', 'expiry', 'type'], keep='last'
+        )
+        expiries = list(df['expiry'].unique())
+
+        futures = {
+            (future.stock_id, future.expiry): future
+            for future in await Future.filter(expiry__in=expiries)
+        }
+        new_futures, updated_futures = [], []
+        for stock_id, expiry, lot_size in zip(futures_df['stock_id'].tolist(), futures_df['expiry'], futures_df['lot_size'].tolist()):
+            future = futures.get((stock_id, expiry))
+            if not future:
+                future = Future(stock_id=stock_id, expiry=expiry, lot_size=lot_size)
+                futures[(stock_id, expiry)] = future
+                new_futures.append(future)
+            elif future.lot_size != lot_size:
+                future.lot_size = lot_size
+                updated_futures.append(future)
+
+        options = {
+            (option.stock_id, option.strike, option.expiry, option.option_type.value): option
+            for option in await Option.filter(expiry__in=expiries)
+        }
+        new_options, updated_options = [], []
+        for key in zip(
+            options_df['stock_id'].tolist(), options_df['strike'].tolist(), options_df['expiry'], options_df['type'], options_df['lot_size'].tolist()
+        ):
+            stock_id, strike, expiry, option_type, lot_size = key
+            option = options.get(key[:4])
+            if not option:
+                option = Option(stock_id=stock_id, strike=strike, expiry=expiry, option_type=OptionType(option_type), lot_size=lot_size)
+                options[key[:4]] = option
+                new_options.append(option)
+            elif option.lot_size != lot_size:
+                option.lot_size = lot_size
+                updated_options.append(option)
+
+        async with in_transaction():
+            await assign_ids(new_futures)
+            await Future.bulk_create(new_futures, batch_size=1000)
+            if updated_futures:
+                await Future.bulk_update(updated_futures, fields=['lot_size'], batch_size=1000)
+            await assign_ids(new_options)
+            await Option.bulk_create(new_options, batch_size=1000)
+            if updated_options:
+                await Option.bulk_update(updated_options, fields=['lot_size'], batch_size=1000)
+
+            future_ids = {futures[key].id for key in zip(futures_df['stock_id'], futures_df['expiry'])}
+            option_ids = {
+                options[key].id
+                for key in zip(options_df['stock_id'], options_df['strike'], options_df['expiry'], options_df['type'])
+            }
+            existing_futures = set(await Instrument.filter(future_id__in=list(future_ids)).values_list('future_id', flat=True))
+            existing_options = set(await Instrument.filter(option_id__in=list(option_ids)).values_list('option_id', flat=True))
+            await Instrument.bulk_create(
+                [Instrument(future_id=future_id) for future_id in future_ids - existing_futures] +
+                [Instrument(option_id=option_id) for option_id in option_ids - existing_options],
+                batch_size=1000
+            )
+
+    async def populate_instruments(self):
+        await self.sync_stocks(await self.get_all_symbols('eq'))
+        df = await self.get_all_symbols('fo')
         df['name'] = df['symbol'].str.extract(r"([A-Z&\-]+)\d{2}[A-Z]{3}FUT")[0]
         opt_name = df['symbol'].str.extract(r"([A-Z&\-]+)\d{2}\d{2}\d+(C|P)E")[0]
         df['name'] = df['name'].fillna(opt_name)
         df = df.dropna(subset='name').reset_index(drop=True)
         df2 = await self.get_bhavcopy(segment='FO')
         df = pd.merge(df, df2, on='symbol').reset_index(drop=True)
-        for row in df.itertuples():
-            try:
-                stock = await Stock.filter(name=row.name).get()
-            except (DoesNotExist, MultipleObjectsReturned):
-                logging.error(f"Error for stock {row}")
-                continue
-            if row.type == 'XX':
-                fut, _ = await Future.get_or_create(
-                    stock=stock,
-                    expiry=datetime.datetime.strptime(row.expiry, "%d-%m-%Y").date(),
-                    defaults=dict(
-                        lot_size=row.lot_size
-                    )
-                )
-                if fut.lot_size != row.lot_size:
-                    fut.lot_size = row.lot_size
-                    await fut.save()
-                await Instrument.get_or_create(
-                    stock=None,
-                    future=fut,
-                    option=None
-                )
-            else:
-                opt, _ = await Option.get_or_create(
-                    stock=stock,
-                    strike=row.strike,
-                    expiry=datetime.datetime.strptime(row.expiry, "%d-%m-%Y").date(),
-                    option_type=OptionType(row.type),
-                    defaults=dict(
-                        lot_size=row.lot_size,
-                    )
-                )
-                if opt.lot_size != row.lot_size:
-                    opt.lot_size = row.lot_size
-                    await opt.save()
-                await Instrument.get_or_create(
-                    stock=None,
-                    future=None,
-                    option=opt
-                )
+        await self.sync_derivatives(df)
@@ -0,0 +1,28 @@
+import logging
+from database.models import SREOrders
+
+
+_status_checked = False
+
+
+async def widen_sreorders_status():
+    ##
+    # XTS statuses like 'PartiallyFilled' need a longer sreorders.status than
+    # the table was created with. The aerich migrations are written in the
+    # sqlite dialect, which does not enforce VARCHAR lengths, so the column is
+    # widened here on postgres only, once per process, the same way the ohlc
+    # partitions are kept out of the migrations.
+    ##
+    global _status_checked
+    db = SREOrders._meta.db
+    if _status_checked or db.capabilities.dialect != "postgres":
+        return
+    length = SREOrders._meta.fields_map['status'].max_length
+    rows = await db.execute_query_dict(
+        "SELECT character_maximum_length AS length FROM information_schema.columns "
+        "WHERE table_name = 'sreorders' AND column_name = 'status'"
+    )
+    if rows and rows[0]['length'] is not None and rows[0]['length'] < length:
+        await db.execute_script(f'ALTER TABLE "sreorders" ALTER COLUMN "status" TYPE VARCHAR({length});')
+        logging.info(f"Widened sreorders.status to {length}")
+    _status_checked = True
@@ -75,13 +75,32 @@ class Ohlc(Model):
 
     class Meta:
         unique_together = ('instrument', 'timestamp', 'interval')
+        indexes = (('instrument', 'interval', 'timestamp', 'close'),)
+
+
+class PrevClose(Model):
+    instrument = fields.ForeignKeyField("models.Instrument", on_delete=fields.CASCADE)
+    date = fields.DateField()
+    close = fields.FloatField()
+
+    class Meta:
+        unique_together = ('instrument', 'date')
 
 
 class Ltp(Model):
-    instrument = fields.ForeignKeyField("models.Instrument", on_delete=fields.CASCADE, unique=True)
+    instrument = fields.ForeignKeyField("models.Instrument", on_delete=fields.CASCADE)
     price = fields.FloatField()
     timestamp = fields.DatetimeField(auto_now=True)
 
+    class Meta:
+        unique_together = (('instrument',),)
+
+
+class SignalCache(Model):
+    key = fields.CharField(max_length=254, unique=True)
+    signals = fields.JSONField(null=True)
+    expires = fields.DatetimeField()
+
 
 class StockOldName(Model):
     stock = fields.ForeignKeyField("models.Stock", on_delete=fields.CASCADE)
@@ -133,6 +152,35 @@ class SubscriptionData(Model):
     data = fields.JSONField()
 
 
+class ShadowPositionRecord(Model):
+    subscription = fields.ForeignKeyField("models.Subscription", on_delete=fields.CASCADE)
+    instrument = fields.ForeignKeyField("models.Instrument", on_delete=fields.CASCADE)
+    side = fields.CharEnumField(TradeSide)
+    qty = fields.IntField()
+    price = fields.FloatField()
+    entry_time = fields.DatetimeField()
+    entry_price = fields.FloatField(null=True)
+    exit_time = fields.DatetimeField(null=True)
+    exit_price = fields.FloatField(null=True)
+    old_price = fields.FloatField(null=True)
+    mtm = fields.FloatField(null=True)
+    days_high_mtm = fields.FloatField(null=True)
+
+    class Meta:
+        table = "shadowposition"
+        indexes = (('subscription', 'exit_time'),)
+
+
+class MtmTick(Model):
+    subscription = fields.ForeignKeyField("models.Subscription", on_delete=fields.CASCADE)
+    timestamp = fields.DatetimeField(auto_now_add=True)
+    long_mtm = fields.FloatField(null=True)
+    short_mtm = fields.FloatField(null=True)
+
+    class Meta:
+        indexes = (('subscription', 'timestamp'),)
+
+
 class Investment(Model):
     account = fields.ForeignKeyField("models.Account", on_delete=fields.CASCADE)
     amount = fields.DecimalField(max_digits=13, decimal_places=2)
@@ -147,6 +195,18 @@ class PnL(Model):
     realised_pnl = fields.DecimalField(max_digits=13, decimal_places=2)
 
 
+class PnlRollup(Model):
+    account = fields.ForeignKeyField("models.Account", on_delete=fields.CASCADE)
+    date = fields.DateField()
+    expiry_month = fields.DateField()
+    realised = fields.DecimalField(max_digits=13, decimal_places=2, default=0)
+    unrealised = fields.DecimalField(max_digits=13, decimal_places=2, default=0)
+    charges = fields.DecimalField(max_digits=13, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('account', 'date', 'expiry_month')
+
+
 class Trade(Model):
     subscription = fields.ForeignKeyField("models.Subscription", on_delete=fields.CASCADE)
     instrument = fields.ForeignKeyField("models.Instrument", on_delete=fields.CASCADE)
@@ -200,7 +260,7 @@ class SREOrders(Model):
     trade = fields.ForeignKeyField("models.Trade", on_delete=fields.CASCADE)
     timestamp = fields.DatetimeField(auto_now_add=True)
     app_order_id = fields.IntField(null=True)
-    status = fields.CharField(max_length=10, null=True, default=None)
+    status = fields.CharField(max_length=20, null=True, default=None)
 
 
 class AccountEmail(Model):
@@ -0,0 +1,141 @@
+import datetime
+import logging
+from typing import List
+from database.models import Instrument, Interval, Ohlc
+from tortoise.expressions import Q, Subquery
+from tortoise.transactions import in_transaction
+
+
+PARTITION_MONTHS_AHEAD = 2
+INTRADAY_RETENTION_MONTHS = 3
+DERIVATIVE_RETENTION_DAYS = 30
+INTRADAY_INTERVALS = (Interval.MIN_1, Interval.MIN_5, Interval.MIN_30, Interval.HOUR)
+
+
+def _month_start(date: datetime.date) -> datetime.date:
+    return date.replace(day=1)
+
+
+def _add_months(date: datetime.date, months: int) -> datetime.date:
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def _interval_table(interval: Interval) -> str:
+    return f"ohlc_{interval.value}"
+
+
+def _month_table(interval: Interval, month: datetime.date) -> str:
+    return f"ohlc_{interval.value}_{month.strftime('%Y%m')}"
+
+
+def _month_partition_sql(interval: Interval, month: datetime.date) -> str:
+    return (
+        f'CREATE TABLE IF NOT EXISTS "{_month_table(interval, month)}" PARTITION OF "{_interval_table(interval)}" '
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}');"
+    )
+
+
+def _is_postgres() -> bool:
+    return Ohlc._meta.db.capabilities.dialect == "postgres"
+
+
+async def is_ohlc_partitioned() -> bool:
+    rows = await Ohlc._meta.db.execute_query_dict("SELECT relkind FROM pg_class WHERE relname = 'ohlc'")
+    return bool(rows) and rows[0]['relkind'] == 'p'
+
+
+async def partition_ohlc_table():
+    ##
+    # One off conversion of ohlc into a table partitioned by interval, each
+    # interval partitioned by month of timestamp. Partition keys have to be
+    # part of every unique constraint, so the primary key becomes
+    # (id, interval, timestamp). The covering index is created on the parent
+    # and inherited by every partition.
+    ##
+    if not _is_postgres() or await is_ohlc_partitioned():
+        return
+    rows = await Ohlc._meta.db.execute_query_dict('SELECT MIN("timestamp") AS first FROM "ohlc"')
+    first = rows[0]['first']
+    first_month = _month_start(first.date() if first else datetime.date.today())
+    last_month = _add_months(datetime.date.today(), PARTITION_MONTHS_AHEAD)
+    statements = [
+        'ALTER TABLE "ohlc" RENAME TO "ohlc_unpartitioned";',
+        'ALTER TABLE "ohlc_unpartitioned" DROP CONSTRAINT IF EXISTS "ohlc_pkey";',
+        'CREATE TABLE "ohlc" (LIKE "ohlc_unpartitioned" INCLUDING DEFAULTS) PARTITION BY LIST ("interval");',
+        'ALTER TABLE "ohlc" ADD PRIMARY KEY ("id", "interval", "timestamp");',
+        'ALTER TABLE "ohlc" ADD CONSTRAINT "uid_ohlc_instrum_partitioned" UNIQUE ("instrument_id", "timestamp", "interval");',
+        'ALTER TABLE "ohlc" ADD FOREIGN KEY ("instrument_id") REFERENCES "instrument" ("id") ON DELETE CASCADE;',
+    ]
+    for interval in Interval:
+        statements += [
+            f'CREATE TABLE "{_interval_table(interval)}" PARTITION OF "ohlc" '
+            f"FOR VALUES IN ('{interval.value}') PARTITION BY RANGE (\"timestamp\");",
+            f'CREATE TABLE "{_interval_table(interval)}_default" PARTITION OF "{_interval_table(interval)}" DEFAULT;',
+        ]
+        month = first_month
+        while month <= last_month:
+            statements.append(_month_partition_sql(interval, month))
+            month = _add_months(month, 1)
+    statements += [
+        'DROP INDEX IF EXISTS "idx_ohlc_instrum_204799";',
+        'CREATE INDEX "idx_ohlc_instrum_204799" ON "ohlc" ("instrument_id", "interval", "timestamp" DESC) INCLUDE ("close");',
+        'INSERT INTO "ohlc" SELECT * FROM "ohlc_unpartitioned";',
+        'ALTER SEQUENCE "ohlc_id_seq" OWNED BY "ohlc"."id";',
+        'DROP TABLE "ohlc_unpartitioned";',
+    ]
+    async with in_transaction() as conn:
+        await conn.execute_script("\n".join(statements))
+
+
+async def create_ohlc_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD):
+    if not _is_postgres() or not await is_ohlc_partitioned():
+        return
+    month = _month_start(datetime.date.today())
+    statements = [
+        _month_partition_sql(interval, _add_months(month, offset))
+        for interval in Interval
+        for offset in range(months_ahead + 1)
+    ]
+    await Ohlc._meta.db.execute_script("\n".join(statements))
+
+
+async def drop_expired_ohlc_partitions(retention_months: int = INTRADAY_RETENTION_MONTHS) -> List[str]:
+    ##
+    # Intraday bars are only kept for retention_months. Whole month partitions
+    # are dropped instead of deleting rows so no vacuum is needed afterwards.
+    ##
+    if not _is_postgres() or not await is_ohlc_partitioned():
+        return []
+    cutoff = _add_months(_month_start(datetime.date.today()), -retention_months)
+    rows = await Ohlc._meta.db.execute_query_dict(
+        "SELECT child.relname AS name FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = ANY($1::text[])",
+        [[_interval_table(interval) for interval in INTRADAY_INTERVALS]]
+    )
+    expired = []
+    for row in rows:
+        suffix = row['name'].rsplit('_', 1)[-1]
+        if not suffix.isdigit():
+            continue
+        if datetime.date(int(suffix[:4]), int(suffix[4:]), 1) < cutoff:
+            expired.append(row['name'])
+    if expired:
+        await Ohlc._meta.db.execute_script("\n".join(f'DROP TABLE IF EXISTS "{name}";' for name in expired))
+        logging.info(f"Dropped ohlc partitions {expired}")
+    return expired
+
+
+async def delete_expired_derivative_ohlc(retention_days: int = DERIVATIVE_RETENTION_DAYS) -> int:
+    cutoff = datetime.date.today() - datetime.timedelta(days=retention_days)
+    expired = Instrument.filter(Q(future__expiry__lt=cutoff) | Q(option__expiry__lt=cutoff)).values('id')
+    return await Ohlc.filter(instrument_id__in=Subquery(expired)).delete()
+
+
+async def maintain_ohlc():
+    await create_ohlc_partitions()
+    await drop_expired_ohlc_partitions()
+    deleted = await delete_expired_derivative_ohlc()
+    logging.info(f"Deleted {deleted} ohlc rows of expired contracts")
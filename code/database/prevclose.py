@@ -0,0 +1,94 @@
+import datetime
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+from database.models import Interval, Ohlc, PrevClose
+from database.utils import bulk_upsert
+from tortoise.expressions import RawSQL
+from tortoise.transactions import in_transaction
+
+
+PREV_CLOSE_LOOKBACK_DAYS = 15
+PREV_CLOSE_CACHE_SECONDS = 300
+
+##
+# Per `before` date: load time, closes, and the instruments already looked up
+# in Ohlc, found or not, so a miss costs one query per cache period.
+##
+_prev_closes: Dict[datetime.date, Tuple[float, Dict[int, float], Set[int]]] = {}
+
+
+async def refresh_prev_closes(since: Optional[datetime.date] = None):
+    ##
+    # Copies the EOD closes saved since `since` into prevclose, one row per
+    # instrument per day, and drops the days the loader no longer looks at.
+    # Run once after the EOD bars are saved.
+    ##
+    today = datetime.date.today()
+    cutoff = today - datetime.timedelta(days=PREV_CLOSE_LOOKBACK_DAYS)
+    since = max(since or cutoff, cutoff)
+    closes = await Ohlc.filter(
+        interval=Interval.EOD,
+        timestamp__gte=datetime.datetime.combine(since, datetime.time())
+    ).order_by('timestamp').values_list('instrument_id', 'timestamp', 'close')
+    prev_closes = {
+        (inst_id, timestamp.date()): PrevClose(instrument_id=inst_id, date=timestamp.date(), close=close)
+        for inst_id, timestamp, close in closes
+    }
+    async with in_transaction():
+        await bulk_upsert(PrevClose, list(prev_closes.values()), ['instrument_id', 'date'], ['close'])
+        await PrevClose.filter(date__lt=cutoff).delete()
+    _prev_closes.clear()
+
+
+async def _load(before: datetime.date) -> Tuple[float, Dict[int, float], Set[int]]:
+    cached = _prev_closes.get(before)
+    if cached and time.monotonic() - cached[0] < PREV_CLOSE_CACHE_SECONDS:
+        return cached
+    if not await PrevClose.exists():
+        await refresh_prev_closes()
+    closes = await PrevClose.filter(
+        date__lt=before,
+        date__gte=before - datetime.timedelta(days=PREV_CLOSE_LOOKBACK_DAYS)
+    ).order_by('date').values_list('instrument_id', 'close')
+    _prev_closes[before] = (time.monotonic(), dict(closes), set())
+    return _prev_closes[before]
+
+
+async def load_prev_closes(before: Optional[datetime.date] = None) -> Dict[int, float]:
+    ##
+    # Latest close before `before` for every instrument, read in one query and
+    # kept in process for PREV_CLOSE_CACHE_SECONDS. An empty prevclose table
+    # is filled from Ohlc first.
+    ##
+    return (await _load(before or datetime.date.today()))[1]
+
+
+async def get_prev_closes(inst_ids: Iterable[int], before: Optional[datetime.date] = None) -> Dict[int, float]:
+    ##
+    # prevclose only keeps PREV_CLOSE_LOOKBACK_DAYS, so instruments whose last
+    # EOD bar is older are looked up in Ohlc, like before the table existed.
+    # Only the newest bar of each is read, and the result is added to the
+    # cache. Instruments without any bar are left out.
+    ##
+    before = before or datetime.date.today()
+    _, prev_closes, looked_up = await _load(before)
+    inst_ids = set(inst_ids)
+    missing = inst_ids - prev_closes.keys() - looked_up
+    if missing:
+        bars = Ohlc.filter(
+            instrument_id__in=missing,
+            interval=Interval.EOD,
+            timestamp__lt=datetime.datetime.combine(before, datetime.time())
+        ).annotate(
+            bar=RawSQL('ROW_NUMBER() OVER (PARTITION BY "ohlc"."instrument_id" ORDER BY "ohlc"."timestamp" DESC)')
+        ).values('instrument_id', 'close', 'bar')
+        rows = await Ohlc._meta.db.execute_query_dict(
+            f'SELECT "instrument_id", "close" FROM ({bars.sql()}) AS "bars" WHERE "bar" = 1'
+        )
+        prev_closes.update({row['instrument_id']: row['close'] for row in rows})
+        looked_up.update(missing)
+    return {inst_id: prev_closes[inst_id] for inst_id in inst_ids if inst_id in prev_closes}
+
+
+async def get_prev_close(inst_id: int, before: Optional[datetime.date] = None) -> Optional[float]:
+    return (await get_prev_closes([inst_id], before)).get(inst_id)
@@ -0,0 +1,64 @@
+from typing import List, Sequence, Type
+from tortoise.models import Model
+
+
+async def reserve_ids(model: Type[Model], count: int) -> List[int]:
+    ##
+    # Postgres hands out ids from the table's sequence, so concurrent runs
+    # never collide. The MAX(id) + 1 fallback is only safe with one writer and
+    # is limited to the sqlite databases used by tests and local runs.
+    ##
+    if count <= 0:
+        return []
+    db = model._meta.db
+    table = model._meta.db_table
+    dialect = db.capabilities.dialect
+    if dialect == "postgres":
+        rows = await db.execute_query_dict(
+            f"SELECT nextval(pg_get_serial_sequence('\"{table}\"', 'id')) AS id FROM generate_series(1, $1)",
+            [count]
+        )
+        return [row['id'] for row in rows]
+    if dialect != "sqlite":
+        raise NotImplementedError(f"Reserving ids is not supported on {dialect}")
+    rows = await db.execute_query_dict(f'SELECT COALESCE(MAX("id"), 0) AS id FROM "{table}"')
+    start = rows[0]['id'] + 1
+    return list(range(start, start + count))
+
+
+async def assign_ids(objects: Sequence[Model]):
+    ##
+    # bulk_create does not return generated keys, so ids are reserved up front
+    # and written explicitly. Rows referencing these objects can then be built
+    # before anything hits the db.
+    ##
+    if not objects:
+        return
+    ids = await reserve_ids(type(objects[0]), len(objects))
+    for obj, obj_id in zip(objects, ids):
+        obj.pk = obj_id
+        obj._custom_generated_pk = True
+
+
+async def bulk_upsert(model: Type[Model], objects: Sequence[Model], on_conflict: Sequence[str], update_fields: Sequence[str]):
+    ##
+    # bulk_create(on_conflict=..., update_fields=...) passes every update field
+    # to a single do_update call, which the pinned pypika-tortoise only accepts
+    # one of. Build the same statement with one do_update per field instead.
+    ##
+    if not objects:
+        return
+    db = model._meta.db
+    executor = db.executor_class(model=model, db=db)
+    projection = model._meta.fields_db_projection
+    regular_columns, columns = executor._prepare_insert_columns(include_generated=objects[0]._custom_generated_pk)
+    query = executor._prepare_insert_statement(columns, has_generated=False).on_conflict(
+        *[projection[field] for field in on_conflict]
+    )
+    for field in update_fields:
+        query = query.do_update(projection[field])
+    values = [
+        [executor.column_map[column](getattr(obj, column), obj) for column in regular_columns]
+        for obj in objects
+    ]
+    await db.execute_many(str(query), values)
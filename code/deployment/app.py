@@ -280,14 +280,7 @@ class StallionStack(Stack):
             self, "place_sre_trades_rollover",
             lambda_function=lmd,
             payload=sfn.TaskInput.from_object({
-                'action': 'place_sre_trades'
-            })
-        )
-        check_trades = tasks.LambdaInvoke(
-            self, "check_sre_trades_rollover",
-            lambda_function=lmd,
-            payload=sfn.TaskInput.from_object({
-                'action': 'check_sre_trades'
+                'action': 'place_and_track_sre_trades'
             })
         )
 
@@ -311,11 +304,10 @@ class StallionStack(Stack):
 
         choice = sfn.Choice(self, "rollover_holiday")
         success = sfn.Succeed(self, "rollover_finish")
-        wait = sfn.Wait(self, "rollover_wait_for_sre_trades", time=sfn.WaitTime.duration(Duration.minutes(2)))
         chain = is_holiday.next(
             choice.when(
                 sfn.Condition.boolean_equals("$.Payload.is_holiday", False), 
-                    ltp_save_job_rollover.next(parallel).next(place_trades).next(wait).next(check_trades).next(success)
+                    ltp_save_job_rollover.next(parallel).next(place_trades).next(success)
             ).otherwise(success)
         )
 
@@ -527,24 +519,16 @@ class StallionStack(Stack):
         holiday_choice = sfn.Choice(self, "holiday_choice_sre_trades")
         ltp_save = self.ltp_save_job(lmd, "ltp_save_sre_trades", eq=False, ohlc=False, fo=True)
         success = sfn.Succeed(self, "finish_sre_trades")
-        wait = sfn.Wait(self, "wait_for_sre_trades", time=sfn.WaitTime.duration(Duration.minutes(2)))
         place_trades = tasks.LambdaInvoke(
             self, "place_sre_trades",
             lambda_function=lmd,
             payload=sfn.TaskInput.from_object({
-                'action': 'place_sre_trades'
-            })
-        )
-        check_trades = tasks.LambdaInvoke(
-            self, "check_sre_trades",
-            lambda_function=lmd,
-            payload=sfn.TaskInput.from_object({
-                'action': 'check_sre_trades'
+                'action': 'place_and_track_sre_trades'
             })
         )
         chain = is_holiday.next(holiday_choice.when(
             sfn.Condition.boolean_equals("$.Payload.is_holiday", False),
-            ltp_save.next(place_trades).next(wait).next(check_trades).next(success)
+            ltp_save.next(place_trades).next(success)
         ).otherwise(success))
         sm = sfn.StateMachine(
             self, "sre_trades_sm",
@@ -1,19 +1,7 @@
 import datetime
 import importlib
 from typing import Optional
-from mangum import Mangum
 from tortoise import Tortoise
-from accounts.googlesheet import GoogleSheetEdit
-from accounts.execute import SRETradeExecutor
-from accounts.mail import PnlMailer, PositionsMailer, ShadowPositionsMailer, ShadowTradeBasketMailer, TradesMailer
-from accounts.pnl import PnlSave
-from accounts.killswitch import exit_all_trades, exit_trades_for_account
-from algos.basealgo import BaseAlgo
-from algos.componentanalysis import ComponentAnalysis
-from algos.tradecountstopper import TradeCountStopper
-from dataaggregator.truedata.datasaver import TrueData
-from database.models import Account
-from apiserver.app import make_app
 import settings
 import asyncio
 import logging
@@ -22,14 +10,41 @@ logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
 logging.getLogger().setLevel(logging.INFO)
 
 
+_db_inited = False
+
+
 class LambdaExecutor:
 
     def __init__(self, lambda_event: dict) -> None:
         self.lambda_event = lambda_event
 
+    @staticmethod
+    async def ping_db():
+        for name in settings.TORTOISE_ORM['connections']:
+            await Tortoise.get_connection(name).execute_query("SELECT 1")
+
     async def init(self):
+        ##
+        # Warm invocations run on the same event loop, so the connections
+        # opened by the first invocation are reused instead of reconnecting.
+        # Connections can go stale while Lambda has the container frozen, so
+        # they are checked first and opened again once if that fails.
+        ##
+        global _db_inited
+        if _db_inited:
+            try:
+                await self.ping_db()
+                return
+            except Exception as ex:
+                logging.error("Db connection lost, reconnecting", exc_info=ex)
+                _db_inited = False
+                try:
+                    await Tortoise.close_connections()
+                except Exception as ex:
+                    logging.error("Error in closing stale db connections", exc_info=ex)
         logging.info("Db connection init")
         await Tortoise.init(settings.TORTOISE_ORM)
+        _db_inited = True
 
     async def action_regular_or_rectification(self):
         now = datetime.datetime.utcnow()
@@ -48,26 +63,37 @@ class LambdaExecutor:
             is_holiday = False
         return { 'is_holiday': is_holiday }
 
-    async def action_truedatasave(self):
+    async def action_truedatasave(self, incremental=False):
+        from dataaggregator.truedata.datasaver import TrueData
+        from database.prevclose import refresh_prev_closes
         data_saver = TrueData()
         logging.info("truedata")
         await data_saver.login()
         logging.info("logged in")
-        await data_saver.save_historical_data_for_stocks()
-        await data_saver.save_historical_data_for_futures()
+        await data_saver.save_historical_data_for_stocks(incremental=incremental)
+        await data_saver.save_historical_data_for_futures(incremental=incremental)
+        await refresh_prev_closes()
 
     async def action_truedataltpsave(self, **kwargs):
+        from dataaggregator.truedata.datasaver import TrueData
         data_saver = TrueData()
         await data_saver.login()
         # await data_saver.save_historical_data_ltp()
         await data_saver.save_ltp_all(**kwargs)
 
-    async def action_run_algo(self, algo_name: str, mailer=True, send_no_trades=True, reversal_mail=False, partial_mail=False, **kwargs):
+    async def action_run_algo(self, algo_name: str, mailer=True, send_no_trades=True, reversal_mail=False, partial_mail=False, batch_writes=False, live_price_max_age=None, strategy_executor=None, **kwargs):
+        from accounts.execute import SRETradeExecutor
+        from accounts.mail import TradesMailer
+        from algos.basealgo import BaseAlgo
         module = importlib.import_module(f'algos.{algo_name.lower()}')
         algo_strat_class = getattr(module, algo_name)
         algo_strat: BaseAlgo = algo_strat_class()
+        algo_strat.batch_writes = batch_writes
+        algo_strat.live_price_max_age = live_price_max_age
+        algo_strat.strategy_executor = strategy_executor
         await algo_strat.init(**kwargs)
         await algo_strat.run()
+        await algo_strat.flush()
         if mailer:
             mailer = TradesMailer(algo_strat, send_no_trades, reverse=reversal_mail, partial=partial_mail)
             await mailer.run()
@@ -75,6 +101,8 @@ class LambdaExecutor:
         await sre_trade_executor.save_trades(algo_strat.trades)
 
     async def action_rollover(self, algo_name: str):
+        from accounts.mail import TradesMailer
+        from algos.basealgo import BaseAlgo
         module = importlib.import_module(f'algos.{algo_name.lower()}')
         algo_strat_class = getattr(module, algo_name)
         algo_strat: BaseAlgo = algo_strat_class()
@@ -84,23 +112,39 @@ class LambdaExecutor:
         await mailer.run()
 
     async def action_pnlsave(self):
+        from accounts.mail import PnlMailer
+        from accounts.pnl import PnlSave
         pnl_saver = PnlSave()
         await pnl_saver.run()
         pnl_mailer = PnlMailer()
         await pnl_mailer.run()
 
+    async def action_pnl_rollup(self, since: Optional[str] = None):
+        from accounts.pnlrollup import rollup_pnl
+        await rollup_pnl(datetime.date.fromisoformat(since) if since else None)
+
     async def action_send_positions(self):
+        from accounts.mail import PositionsMailer
+        from accounts.pnl import PnlSave
         pnl_saver = PnlSave()
         await pnl_saver.save_eod_price()
         positions_mailer = PositionsMailer()
         await positions_mailer.run()
 
+    async def action_ohlc_maintenance(self, partition=False):
+        from database.partitions import maintain_ohlc, partition_ohlc_table
+        if partition:
+            await partition_ohlc_table()
+        await maintain_ohlc()
+
     async def action_populate_instruments(self):
+        from dataaggregator.truedata.datasaver import TrueData
         data_saver = TrueData()
         await data_saver.login()
         await data_saver.populate_instruments()
 
     async def action_shadow_sheet(self, futures_price_only=False, append_mtms=False):
+        from accounts.googlesheet import GoogleSheetEdit
         gs = GoogleSheetEdit()
         await gs.init()
         if not futures_price_only:
@@ -110,25 +154,52 @@ class LambdaExecutor:
         await gs.update_futures_prices()
 
     async def action_exit_all_trades(self):
+        from accounts.killswitch import exit_all_trades
         await exit_all_trades()
 
     async def action_exit_trades_for_account(self, account_name):
+        from accounts.killswitch import exit_trades_for_account
+        from database.models import Account
         account = await Account.get(name=account_name)
         await exit_trades_for_account(account)
 
+    async def action_tick_ingestion(self, candles=False):
+        from dataaggregator.candles import CandleBuilder
+        from dataaggregator.sre.datasaver import SREMarketData
+        from database.models import Instrument, StockGroupMap
+        from tortoise.expressions import Subquery
+        market_data = SREMarketData()
+        await market_data.login()
+        instruments = await Instrument.filter(stock_id__in=Subquery(StockGroupMap.all().values('stock__id')))
+        instruments += await Instrument.filter(
+            future__stock_id__in=Subquery(StockGroupMap.all().values('stock__id')),
+            future__expiry__gte=datetime.date.today()
+        )
+        await market_data.run_tick_ingestion(instruments, candle_builder=CandleBuilder() if candles else None)
+
     async def action_place_sre_trades(self):
+        from accounts.execute import SRETradeExecutor
         sre_trade_executor = SRETradeExecutor()
         await sre_trade_executor.execute_trades()
 
+    async def action_place_and_track_sre_trades(self, timeout=120):
+        from accounts.execute import SRETradeExecutor
+        sre_trade_executor = SRETradeExecutor()
+        await sre_trade_executor.place_and_track_trades(timeout)
+
     async def action_check_sre_trades(self):
+        from accounts.execute import SRETradeExecutor
         sre_trade_executor = SRETradeExecutor()
         await sre_trade_executor.check_trades()
 
     async def action_mail_trade_baskets(self):
+        from accounts.mail import ShadowTradeBasketMailer
         mailer = ShadowTradeBasketMailer()
         await mailer.run()
 
     async def action_trade_counter_calculate(self):
+        from accounts.googlesheet import GoogleSheetEdit
+        from algos.tradecountstopper import TradeCountStopper
         algo = TradeCountStopper()
         await algo.init()
         await algo.run()
@@ -137,6 +208,8 @@ class LambdaExecutor:
         await gs.update_trade_counter_ratios()
 
     async def action_component_analysis(self):
+        from accounts.googlesheet import GoogleSheetEdit
+        from algos.componentanalysis import ComponentAnalysis
         algo = ComponentAnalysis()
         await algo.init()
         await algo.run()
@@ -145,7 +218,9 @@ class LambdaExecutor:
         await gs.component_analysis()
 
     async def run(self):
+        from accounts.symbols import get_instrument_cache
         await self.init()
+        get_instrument_cache().clear()
         action = self.lambda_event['action']
         kwargs = self.lambda_event.get('kwargs', {})
         logging.info(f"Action {action}, {kwargs}")
@@ -166,4 +241,13 @@ def lambda_handler(event, context):
     return result
 
 
-api_server_handler = Mangum(make_app())
\ No newline at end of file
+_api_server_handler = None
+
+
+def api_server_handler(event, context):
+    global _api_server_handler
+    if _api_server_handler is None:
+        from mangum import Mangum
+        from apiserver.app import make_app
+        _api_server_handler = Mangum(make_app())
+    return _api_server_handler(event, context)
\ No newline at end of file
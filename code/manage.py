@@ -1,15 +1,134 @@
 import argparse
+import asyncio
+import datetime
+import os
+import random
 import subprocess
+import sys
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
 import settings
 from tortoise import Tortoise, run_async
 
 
+def import_profile(module: str = "main", top: int = 30) -> Tuple[int, List[Tuple[int, int, str]]]:
+    ##
+    # Imports module in a fresh interpreter with -X importtime and returns the
+    # total import time with the slowest top level packages, all in
+    # microseconds, so cold start regressions show up in one table.
+    ##
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        self_total, cumulative_max = packages.get(package, (0, 0))
+        packages[package] = (self_total + int(self_us), max(cumulative_max, int(cumulative_us)))
+    total = sum(self_us for self_us, _ in packages.values())
+    rows = sorted(((self_us, cumulative_us, package) for package, (self_us, cumulative_us) in packages.items()), reverse=True)
+    return total, rows[:top]
+
+
+def fake_pnl_report(account_id: int, closed: int = 400, open_: int = 60) -> Dict:
+    from database.models import TradeSide
+    today = datetime.date.today()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    month_start = today.replace(day=1)
+    expiries = [(month_start + datetime.timedelta(days=31 * months)).replace(day=25) for months in range(3)]
+
+    def position(pnl_key: str) -> Dict:
+        side = random.choice(list(TradeSide))
+        price = Decimal(random.randint(10000, 500000)) / 100
+        values = dict(
+            future_stock_name=f"STOCK{random.randint(1, 200)}", option_stock_name=None, strike=None,
+            option_expiry=None, future_expiry=random.choice(expiries), qty=random.randint(1, 40) * 25,
+            buy_price=price if side == TradeSide.BUY else price * Decimal('1.01'),
+            sell_price=price if side == TradeSide.SELL else price * Decimal('1.01'),
+            side=side, charges=Decimal(random.randint(100, 10000)) / 100,
+            entry_time=now - datetime.timedelta(days=random.randint(1, 60)),
+        )
+        values[pnl_key] = Decimal(random.randint(-500000, 500000)) / 100
+        return values
+
+    closed_data = [dict(position('pnl'), exit_time=now) for _ in range(closed)]
+    open_data = [dict(position('mtm'), cmp=Decimal(1000)) for _ in range(open_)]
+    return dict(
+        account_id=account_id,
+        account_name=f"Account{account_id}",
+        today=today,
+        open=open_data,
+        closed=closed_data,
+        monthly_totals={
+            (month_start - datetime.timedelta(days=31 * months)).replace(day=1): {'pnl': Decimal(100000 * months), 'cost': Decimal(1000 * months)}
+            for months in range(6)
+        },
+        day_wise=[
+            {'day': day, 'sum_pnl': Decimal(1000 * day), 'sum_charges': Decimal(10 * day)}
+            for day in range(1, today.day + 1)
+        ],
+        investment=Decimal(10000000)
+    )
+
+
+def pnl_report_benchmark(accounts: int = 50, workers: Optional[int] = None) -> Tuple[float, float]:
+    ##
+    # Builds the same synthetic reports serially and through the worker pool
+    # and returns both wall times in seconds.
+    ##
+    from accounts.pnl import build_pnl_excels
+    reports = [fake_pnl_report(account_id) for account_id in range(1, accounts + 1)]
+
+    async def build(workers: int) -> float:
+        start = time.perf_counter()
+        async for _ in build_pnl_excels(reports, workers):
+            pass
+        return time.perf_counter() - start
+
+    return asyncio.run(build(1)), asyncio.run(build(workers or os.cpu_count() or 1))
+
+
+def smtp_benchmark(messages: int = 200, size: Optional[int] = None, latency: float = 0.01) -> Tuple[float, float]:
+    ##
+    # Sends the same messages to a LocalSMTPServer over one connection and
+    # through the pool and returns both wall times in seconds. `latency` is
+    # the simulated relay round trip per greeting and per message.
+    ##
+    from email.message import EmailMessage
+    from accounts.localsmtp import LocalSMTPServer
+    from accounts.mailtransport import SMTP_POOL_SIZE, MailTransport
+    msgs = []
+    for i in range(messages):
+        msg = EmailMessage()
+        msg['To'] = "test@test.com"
+        msg['From'] = "test@test.com"
+        msg['Subject'] = f"Benchmark {i}"
+        msg.set_content("benchmark")
+        msgs.append(msg)
+
+    async def send(size: int) -> float:
+        async with LocalSMTPServer(latency=latency) as server:
+            mail_transport = MailTransport(server.host, server.port, size=size)
+            start = time.perf_counter()
+            await mail_transport.send_messages(msgs)
+            elapsed = time.perf_counter() - start
+            await mail_transport.close()
+        return elapsed
+
+    return asyncio.run(send(1)), asyncio.run(send(size or SMTP_POOL_SIZE))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("ManageDeployment")
     parser.add_argument("-d", "--bundle-with-deps", action='store_true')
     parser.add_argument("-b", "--bundle", action='store_true')
     parser.add_argument("--tortoise-init", action='store_true')
     parser.add_argument("--aerich", nargs='+')
+    parser.add_argument("--import-profile", nargs='?', const="main")
+    parser.add_argument("--pnl-report-benchmark", nargs='?', type=int, const=50)
+    parser.add_argument("--smtp-benchmark", nargs='?', type=int, const=200)
     args = parser.parse_args()
     print(args)
     if args.bundle_with_deps or args.bundle:
@@ -34,4 +153,16 @@ if __name__ == "__main__":
         run_async(Tortoise.init(settings.TORTOISE_ORM))
     elif args.aerich:
         run_async(Tortoise.init(settings.TORTOISE_ORM))
-        subprocess.run(["aerich"] + args.aerich)
\ No newline at end of file
+        subprocess.run(["aerich"] + args.aerich)
+    elif args.import_profile:
+        total, rows = import_profile(args.import_profile)
+        print(f"{'self [us]':>12} {'cumulative [us]':>16}  package")
+        for self_us, cumulative_us, package in rows:
+            print(f"{self_us:>12} {cumulative_us:>16}  {package}")
+        print(f"Total import time for {args.import_profile}: {total / 1000:.1f} ms")
+    elif args.pnl_report_benchmark:
+        serial, pooled = pnl_report_benchmark(args.pnl_report_benchmark)
+        print(f"{args.pnl_report_benchmark} pnl reports: serial {serial:.2f} s, pooled {pooled:.2f} s, {serial / pooled:.1f}x")
+    elif args.smtp_benchmark:
+        single, pooled = smtp_benchmark(args.smtp_benchmark)
+        print(f"{args.smtp_benchmark} mails: one connection {single:.2f} s, pooled {pooled:.2f} s, {single / pooled:.1f}x")
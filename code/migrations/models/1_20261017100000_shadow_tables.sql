@@ -0,0 +1,28 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "shadowposition" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "side" VARCHAR(4) NOT NULL  /* BUY: buy\nSELL: sell */,
+    "qty" INT NOT NULL,
+    "price" REAL NOT NULL,
+    "entry_time" TIMESTAMP NOT NULL,
+    "entry_price" REAL,
+    "exit_time" TIMESTAMP,
+    "exit_price" REAL,
+    "old_price" REAL,
+    "mtm" REAL,
+    "days_high_mtm" REAL,
+    "instrument_id" INT NOT NULL REFERENCES "instrument" ("id") ON DELETE CASCADE,
+    "subscription_id" INT NOT NULL REFERENCES "subscription" ("id") ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "idx_shadowposit_subscri_41ed5d" ON "shadowposition" ("subscription_id", "exit_time");
+CREATE TABLE IF NOT EXISTS "mtmtick" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "timestamp" TIMESTAMP NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "long_mtm" REAL,
+    "short_mtm" REAL,
+    "subscription_id" INT NOT NULL REFERENCES "subscription" ("id") ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS "idx_mtmtick_subscri_650315" ON "mtmtick" ("subscription_id", "timestamp");
+-- downgrade --
+DROP TABLE IF EXISTS "mtmtick";
+DROP TABLE IF EXISTS "shadowposition";
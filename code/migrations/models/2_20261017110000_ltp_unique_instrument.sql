@@ -0,0 +1,5 @@
+-- upgrade --
+DELETE FROM "ltp" WHERE "id" NOT IN (SELECT MAX("id") FROM "ltp" GROUP BY "instrument_id");
+CREATE UNIQUE INDEX IF NOT EXISTS "uid_ltp_instrum_0bed88" ON "ltp" ("instrument_id");
+-- downgrade --
+DROP INDEX IF EXISTS "uid_ltp_instrum_0bed88";
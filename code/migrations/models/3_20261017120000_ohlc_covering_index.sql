@@ -0,0 +1,4 @@
+-- upgrade --
+CREATE INDEX IF NOT EXISTS "idx_ohlc_instrum_204799" ON "ohlc" ("instrument_id", "interval", "timestamp", "close");
+-- downgrade --
+DROP INDEX IF EXISTS "idx_ohlc_instrum_204799";
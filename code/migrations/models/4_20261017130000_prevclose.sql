@@ -0,0 +1,10 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "prevclose" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "date" DATE NOT NULL,
+    "close" REAL NOT NULL,
+    "instrument_id" INT NOT NULL REFERENCES "instrument" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_prevclose_instrum_633a6e" UNIQUE ("instrument_id", "date")
+);
+-- downgrade --
+DROP TABLE IF EXISTS "prevclose";
@@ -0,0 +1,9 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "signalcache" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "key" VARCHAR(254) NOT NULL UNIQUE,
+    "signals" JSON,
+    "expires" TIMESTAMP NOT NULL
+);
+-- downgrade --
+DROP TABLE IF EXISTS "signalcache";
@@ -0,0 +1,13 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "pnlrollup" (
+    "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "date" DATE NOT NULL,
+    "expiry_month" DATE NOT NULL,
+    "realised" VARCHAR(40) NOT NULL  DEFAULT 0,
+    "unrealised" VARCHAR(40) NOT NULL  DEFAULT 0,
+    "charges" VARCHAR(40) NOT NULL  DEFAULT 0,
+    "account_id" INT NOT NULL REFERENCES "account" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_pnlrollup_account_b243f9" UNIQUE ("account_id", "date", "expiry_month")
+);
+-- downgrade --
+DROP TABLE IF EXISTS "pnlrollup";
@@ -0,0 +1,5 @@
+-- upgrade --
+DELETE FROM "ohlc" WHERE "id" NOT IN (SELECT MAX("id") FROM "ohlc" GROUP BY "instrument_id", "timestamp", "interval");
+CREATE UNIQUE INDEX IF NOT EXISTS "uid_ohlc_instrum_e6520f" ON "ohlc" ("instrument_id", "timestamp", "interval");
+-- downgrade --
+DROP INDEX IF EXISTS "uid_ohlc_instrum_e6520f";
@@ -0,0 +1,3 @@
+import numpy as np
+def process(price_array, current_price):
+    return "BUY" if current_price > np.mean(price_array) else "SELL"
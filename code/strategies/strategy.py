@@ -1,9 +1,12 @@
-
-
-from typing import Literal
+from typing import List, Literal
 
 import numpy as np
 
 
 def process(price_array: np.ndarray, current_price: float) -> Literal["BUY", "SELL", "HOLD"]:
-    ...
\ No newline at end of file
+    ...
+
+
+def process_batch(price_matrix: np.ndarray, price_vector: np.ndarray) -> List[Literal["BUY", "SELL", "HOLD"]]:
+    # Optional. Rows of price_matrix are closes newest first, nan padded.
+    ...
@@ -1,13 +1,47 @@
+import aiohttp
+import asyncio
 import datetime
+import json
+from decimal import Decimal
+import os
+import pickle
+import sys
+import tempfile
+import time
+import types
 import unittest
+from email.message import EmailMessage
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+from aiosmtplib import SMTPConnectError
 from tortoise import Tortoise, run_async
 from tortoise.contrib import test
-from accounts.pnl import PnlSave
+from accounts.execute import SREExecute
+from accounts.localsmtp import LocalSMTPServer
+from accounts.mail import BaseMailer, PositionsMailer, TradesMailer
+from accounts.mailtransport import MailTransport, set_mail_transport
+from accounts.pnl import PnlSave, build_pnl_excel, build_pnl_excels
+from accounts.pnlrollup import rollup_pnl
 from accounts.seeddata import Seed
+from accounts.symbols import InstrumentCache, set_instrument_cache
+from algos.basealgo import BaseAlgo
+from algos.marketsnapshot import MarketSnapshot
+from algos.signalcache import DbSignalCache, set_signal_cache
+from algos.signals import generate_signals, get_price_matrix, process_stocks, run_strategy
+from algos.shadowanalysis import ShadowAnalysis
+from algos.shadowstore import load_shadow_state, save_shadow_state
 from algos.niftyfuturesalgo import NiftyFuturesAlgo
+from dataaggregator.candles import CandleBuilder, market_now
+from dataaggregator.sre.datasaver import SREMarketData
+from dataaggregator.tickstore import LocalTickStore, set_tick_store
 from dataaggregator.truedata.datasaver import TrueData
-from database.models import Account, Algo, Future, Instrument, Interval, Investment, Ltp, Ohlc, PnL, Position, SREAccount, Stock, StockGroup, StockGroupMap, Strategy, Subscription, Trade, TradeExit, TradeSide, User
+from database.models import Account, AccountEmail, Algo, ClientExcelAccount, ClientExcelType, Future, Instrument, Interval, Investment, Ltp, MtmTick, Ohlc, Option, OptionType, PnL, PnlRollup, Position, PrevClose, SREAccount, SREOrders, ShadowPositionRecord, SignalCache, Stock, StockGroup, StockGroupMap, Strategy, Subscription, SubscriptionData, Trade, TradeExit, TradeSide, TradesMail, User
+from database.partitions import maintain_ohlc
+from database.prevclose import _prev_closes, get_prev_close, get_prev_closes, load_prev_closes, refresh_prev_closes
+import main
 from main import lambda_handler
+from manage import import_profile, pnl_report_benchmark, smtp_benchmark
 
 
 class TruedataTest(test.TestCase):
@@ -55,6 +89,115 @@ class TruedataTest(test.TestCase):
         self.assertIsInstance(instrument, Instrument)
 
 
+class TruedataSaveTest(test.TestCase):
+
+    async def _setUp(self) -> None:
+        self.stocks = [await Stock.create(ticker=ticker, isin=ticker, name=ticker) for ticker in ('TCS', 'INFY')]
+        self.instruments = [await Instrument.create(stock=stock, future=None, option=None) for stock in self.stocks]
+        await Ltp.create(instrument=self.instruments[0], price=1)
+        self.data_saver = TrueData()
+
+        async def get_bhavcopy(segment):
+            return pd.DataFrame({
+                'symbol': ['INFY', 'TCS', 'WIPRO'],
+                'open': [10.0, 20.0, 30.0],
+                'high': [11.0, 21.0, 31.0],
+                'low': [9.0, 19.0, 29.0],
+                'close': [10.5, 20.5, 30.5],
+            })
+        self.data_saver.get_bhavcopy = get_bhavcopy
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_ltpsave_eq(self):
+        for upsert in (False, True, True):
+            await self.data_saver.save_ltp_all(fo=False, upsert=upsert)
+            prices = dict(await Ltp.all().values_list('instrument_id', 'price'))
+            self.assertEqual(prices, {self.instruments[0].id: 20.5, self.instruments[1].id: 10.5})
+            closes = await Ohlc.filter(instrument=self.instruments[0], interval=Interval.EOD).values_list('close', flat=True)
+            self.assertEqual(closes, [20.5])
+
+    async def test_historical_data_batches(self):
+        self.data_saver._access_token = 'token'
+        self.data_saver.history_batch_size = 1
+        requested = []
+
+        async def get_historical_bars(session, symbol, nbars=365):
+            requested.append(symbol)
+            return pd.DataFrame({
+                'timestamp': ['2023-09-01 00:00:00', '2023-09-04 00:00:00', '2023-09-04 00:00:00'],
+                'dopen': [1.0, 2.0, 3.0], 'dhigh': [1.0, 2.0, 3.0], 'dlow': [1.0, 2.0, 3.0], 'dclose': [1.0, 2.0, 3.0],
+            })
+        self.data_saver.get_historical_bars = get_historical_bars
+        removed = datetime.datetime(2023, 9, 2)
+        await Ohlc.create(instrument=self.instruments[0], timestamp=removed, interval=Interval.EOD, open=9, high=9, low=9, close=9)
+        for _ in range(2):
+            await self.data_saver.save_historical_data(self.instruments)
+        self.assertEqual(sorted(requested), ['INFY', 'INFY', 'TCS', 'TCS'])
+        closes = await Ohlc.filter(instrument=self.instruments[0], interval=Interval.EOD).order_by('timestamp').values_list('close', flat=True)
+        self.assertEqual(closes, [1.0, 3.0])
+
+    async def test_historical_data_incremental(self):
+        self.data_saver._access_token = 'token'
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        last_day = today - datetime.timedelta(days=7)
+        for instrument, close in zip(self.instruments, (4.0, 5.0)):
+            await Ohlc.create(instrument=instrument, timestamp=last_day, interval=Interval.EOD, open=close, high=close, low=close, close=close)
+        requested = []
+
+        async def get_historical_bars(session, symbol, nbars=365):
+            requested.append((symbol, nbars))
+            return pd.DataFrame({
+                'timestamp': [str(last_day), str(today)],
+                'dopen': [5.0, 6.0], 'dhigh': [5.0, 6.0], 'dlow': [5.0, 6.0], 'dclose': [5.0, 6.0],
+            })
+        self.data_saver.get_historical_bars = get_historical_bars
+        await self.data_saver.save_historical_data(self.instruments, incremental=True)
+        self.assertEqual(sorted(requested), [('INFY', 6), ('TCS', 6), ('TCS', 365)])
+        closes = await Ohlc.filter(instrument=self.instruments[0], interval=Interval.EOD).order_by('timestamp').values_list('close', flat=True)
+        self.assertEqual(closes, [5.0, 6.0])
+
+    async def test_populate_instruments(self):
+        lot_size = 100
+
+        async def get_all_symbols(segment):
+            if segment == 'eq':
+                rows = [
+                    [1, 'TCS', 'EQ', 'TCS', 'NSE', 1, 0, None, 'TCS', None],
+                    [2, 'INFY', 'EQ', 'INFY', 'NSE', 1, 0, None, 'INFY', None],
+                    [3, 'NIFTY 50', 'IN', 'NIFTY', 'NSE', 1, 0, None, 'NIFTY', None],
+                ]
+            else:
+                rows = [
+                    [4, 'TCS23SEPFUT', 'XX', None, 'NFO', lot_size, 0, '28-09-2023', None, None],
+                    [5, 'TCS230928100CE', 'CE', None, 'NFO', lot_size, 100, '28-09-2023', None, None],
+                    [6, 'TCS230928100PE', 'PE', None, 'NFO', lot_size, 100, '28-09-2023', None, None],
+                    [7, 'WIPRO23SEPFUT', 'XX', None, 'NFO', lot_size, 0, '28-09-2023', None, None],
+                ]
+            return pd.DataFrame(rows, columns=[
+                'truedata_id', 'symbol', 'type', 'isin', 'exchange', 'lot_size', 'strike', 'expiry', 'extra_1', 'extra_2'
+            ])
+
+        async def get_bhavcopy(segment):
+            return pd.DataFrame({'symbol': ['TCS23SEPFUT', 'TCS230928100CE', 'TCS230928100PE', 'WIPRO23SEPFUT']})
+        self.data_saver.get_all_symbols = get_all_symbols
+        self.data_saver.get_bhavcopy = get_bhavcopy
+        for lot_size in (100, 150):
+            await self.data_saver.populate_instruments()
+        self.assertEqual(await Stock.all().count(), 3)
+        self.assertTrue((await Stock.get(ticker='NIFTY 50')).is_index)
+        self.assertEqual(await Future.filter(lot_size=150).count(), 1)
+        self.assertEqual(await Option.filter(lot_size=150).count(), 2)
+        self.assertEqual(await Instrument.filter(stock_id__not_isnull=True).count(), 3)
+        self.assertEqual(await Instrument.filter(future_id__not_isnull=True).count(), 1)
+        self.assertEqual(await Instrument.filter(option_id__not_isnull=True).count(), 2)
+
+
 class AlgoTest(test.TestCase):
 
     async def _setUp(self):
@@ -138,6 +281,904 @@ class AlgoTest(test.TestCase):
         self.assertIsInstance(pnl, PnL)
 
 
+class BatchWriteTest(test.TestCase):
+
+    async def _setUp(self):
+        algo = await Algo.create(name="NiftyFuturesAlgo")
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        user = await User.create(email='test@test.com')
+        account = await Account.create(user=user, start_date=datetime.date.today())
+        self.subscription = await Subscription.create(account=account, algo=algo, start_date=datetime.date.today())
+        future = await Future.create(stock=stock, expiry=datetime.date.today() + datetime.timedelta(days=1), lot_size=10)
+        self.instrument = await Instrument.create(stock=None, future=future, option=None)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_flush(self):
+        algo = BaseAlgo()
+        await algo.entry(self.subscription, self.instrument, 10, TradeSide.BUY, 100)
+        await algo.flush()
+        stored = await Position.get(active=True)
+        algo = BaseAlgo()
+        algo.batch_writes = True
+        await algo.exit(stored, 110)
+        await algo.entry(self.subscription, self.instrument, 20, TradeSide.SELL, 110)
+        await algo.entry(self.subscription, self.instrument, 0, TradeSide.SELL, 110)
+        self.assertEqual(await Trade.all().count(), 1)
+        pending = algo.get_pending_positions(self.subscription.id, self.instrument.id)
+        self.assertEqual([position.qty for position in pending], [20])
+        await algo.flush()
+        self.assertEqual(len(algo.trades), 2)
+        self.assertEqual(await Trade.filter(id__in=[td.id for td in algo.trades]).count(), 2)
+        stored = await Position.get(id=stored.id)
+        self.assertFalse(stored.active)
+        self.assertEqual(stored.pnl, 100)
+        tde = await TradeExit.get(position=stored)
+        self.assertEqual(tde.exit_trade_id, algo.trades[0].id)
+        pos = await Position.get(active=True)
+        self.assertEqual(pos.sell_price, 110)
+        tde = await TradeExit.get(position=pos)
+        self.assertEqual(tde.entry_trade_id, algo.trades[1].id)
+        self.assertIsNone(tde.exit_trade_id)
+
+    async def test_flush_exit_pending(self):
+        algo = BaseAlgo()
+        algo.batch_writes = True
+        await algo.entry(self.subscription, self.instrument, 10, TradeSide.SELL, 100)
+        pending_position = algo._pending_entries[0][1]
+        await algo.exit(pending_position, 90)
+        await algo.flush()
+        pos = await Position.get()
+        self.assertFalse(pos.active)
+        self.assertEqual(pos.pnl, 100)
+        tde = await TradeExit.get(position=pos)
+        self.assertEqual((tde.entry_trade_id, tde.exit_trade_id), tuple(td.id for td in algo.trades))
+
+    async def test_exit_twice_before_flush(self):
+        algo = BaseAlgo()
+        await algo.entry(self.subscription, self.instrument, 10, TradeSide.BUY, 100)
+        algo = BaseAlgo()
+        algo.batch_writes = True
+        await algo.exit(await Position.get(active=True), 110)
+        self.assertIsNone(await algo.active_positions(subscription=self.subscription).get_or_none())
+        self.assertIsNone(await algo.exit(await Position.get(active=True), 120))
+        await algo.flush()
+        self.assertEqual(len(algo.trades), 1)
+        self.assertEqual(await Trade.all().count(), 2)
+        self.assertEqual(await TradeExit.filter(exit_trade_id__isnull=False).count(), 1)
+        self.assertEqual((await Position.get()).pnl, 100)
+
+
+class EodPriceTest(test.TestCase):
+
+    async def _setUp(self):
+        algo = await Algo.create(name="NiftyFuturesAlgo")
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        user = await User.create(email='test@test.com')
+        account = await Account.create(user=user, start_date=datetime.date.today())
+        subscription = await Subscription.create(account=account, algo=algo, start_date=datetime.date.today())
+        self.positions = []
+        for i, (side, price, ltp) in enumerate(((TradeSide.BUY, 1234.55, 1250.35), (TradeSide.SELL, 987.65, 975.123456), (TradeSide.BUY, 3.33, 3.37))):
+            future = await Future.create(stock=stock, expiry=datetime.date.today() + datetime.timedelta(days=i + 1), lot_size=25)
+            instrument = await Instrument.create(stock=None, future=future, option=None)
+            await Ltp.create(instrument=instrument, price=ltp)
+            self.positions.append(await Position.create(
+                subscription=subscription, instrument=instrument, qty=175 * (i + 1), side=side,
+                buy_price=price if side == TradeSide.BUY else None,
+                sell_price=price if side == TradeSide.SELL else None,
+                charges=0, pnl=0
+            ))
+        future = await Future.create(stock=stock, expiry=datetime.date.today() + datetime.timedelta(days=10), lot_size=25)
+        instrument = await Instrument.create(stock=None, future=future, option=None)
+        self.missing = await Position.create(subscription=subscription, instrument=instrument, qty=25, side=TradeSide.BUY, buy_price=10, charges=0, pnl=0)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_save_eod_price(self):
+        expected = []
+        for position in self.positions:
+            position = await Position.get(id=position.id)
+            ltp = await Ltp.get(instrument_id=position.instrument_id)
+            eod_price = Decimal(ltp.price)
+            if position.buy_price:
+                charges = BaseAlgo.charges_calculate(position.qty, position.buy_price, TradeSide.BUY) + BaseAlgo.charges_calculate(position.qty, eod_price, TradeSide.SELL)
+                pnl = (eod_price - position.buy_price) * position.qty
+            else:
+                charges = BaseAlgo.charges_calculate(position.qty, position.sell_price, TradeSide.SELL) + BaseAlgo.charges_calculate(position.qty, eod_price, TradeSide.BUY)
+                pnl = (position.sell_price - eod_price) * position.qty
+            position.eod_price, position.charges, position.pnl = eod_price, charges, pnl
+            await position.save()
+            expected.append(await Position.get(id=position.id).values_list('eod_price', 'charges', 'pnl'))
+        await Position.filter(id__in=[position.id for position in self.positions]).update(eod_price=None, charges=0, pnl=0)
+        await PnlSave().save_eod_price()
+        stored = [await Position.get(id=position.id).values_list('eod_price', 'charges', 'pnl') for position in self.positions]
+        self.assertEqual(stored, expected)
+        self.assertIsNone((await Position.get(id=self.missing.id)).eod_price)
+
+
+class PnlRollupTest(test.TestCase):
+
+    async def _setUp(self):
+        algo = await Algo.create(name="NiftyFuturesAlgo")
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        user = await User.create(email='test@test.com')
+        self.account = await Account.create(user=user, start_date=datetime.date.today())
+        self.subscription = await Subscription.create(account=self.account, algo=algo, start_date=datetime.date.today())
+        await Investment.create(account=self.account, amount=100000)
+        self.instruments = []
+        for days in (1, 40):
+            future = await Future.create(stock=stock, expiry=datetime.date.today() + datetime.timedelta(days=days), lot_size=10)
+            self.instruments.append(await Instrument.create(stock=None, future=future, option=None))
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def get_rollups(self):
+        return sorted(await PnlRollup.all().values_list('date', 'expiry_month', 'realised', 'unrealised', 'charges'))
+
+    async def test_rollup(self):
+        today = datetime.date.today()
+        near, far = self.instruments
+        algo = BaseAlgo()
+        await algo.entry(self.subscription, near, 10, TradeSide.BUY, 100)
+        await algo.entry(self.subscription, far, 20, TradeSide.SELL, 200)
+        await algo.entry(self.subscription, near, 30, TradeSide.BUY, 300)
+        positions = await Position.all().order_by('id')
+        await algo.exit(positions[0], 110)
+        self.assertEqual(await PnlRollup.all().count(), 0)
+        await algo.flush()
+        algo = BaseAlgo()
+        algo.batch_writes = True
+        await algo.exit(positions[1], 190)
+        await algo.flush()
+        near_month = (await near.future).expiry.replace(day=1)
+        far_month = (await far.future).expiry.replace(day=1)
+        charges = [(await Position.get(id=position.id)).charges for position in positions[:2]]
+        recorded = await self.get_rollups()
+        expected = sorted([(today, near_month, Decimal(100), Decimal(0), charges[0]), (today, far_month, Decimal(200), Decimal(0), charges[1])])
+        if near_month == far_month:
+            expected = [(today, near_month, Decimal(300), Decimal(0), charges[0] + charges[1])]
+        self.assertEqual(recorded, expected)
+
+        await Position.filter(id=positions[2].id).update(pnl=Decimal('-45.5'))
+        await PnlRollup.filter(date=today).update(realised=0)
+        await rollup_pnl()
+        rolled = await self.get_rollups()
+        self.assertEqual(sum(row[2] for row in rolled), 300)
+        self.assertEqual(sum(row[3] for row in rolled), Decimal('-45.5'))
+        self.assertEqual(sum(row[4] for row in rolled), sum(charges))
+
+        await PnlSave().save_pnl(self.account)
+        pnl = await PnL.get(account=self.account, date=today)
+        self.assertEqual((pnl.realised_pnl, pnl.unrealised_pnl), (300, Decimal('-45.5')))
+
+    async def test_rebuilds_empty_rollup(self):
+        today = datetime.date.today()
+        near, far = self.instruments
+        algo = BaseAlgo()
+        await algo.entry(self.subscription, near, 10, TradeSide.BUY, 100)
+        await algo.entry(self.subscription, far, 20, TradeSide.SELL, 200)
+        for position in await Position.all().order_by('id'):
+            await algo.exit(position, 110)
+        earlier = today - datetime.timedelta(days=45)
+        exit_trade_ids = await TradeExit.all().values_list('exit_trade_id', flat=True)
+        await Trade.filter(id=exit_trade_ids[0]).update(timestamp=datetime.datetime.combine(earlier, datetime.time(10)))
+        self.assertFalse(await PnlRollup.exists())
+        await PnlSave().save_pnl(self.account)
+        pnl = await PnL.get(account=self.account, date=today)
+        self.assertEqual(pnl.realised_pnl, 100 + 1800)
+        self.assertEqual(sorted(await PnlRollup.all().values_list('date', flat=True)), [earlier, today])
+        await algo.flush()
+        self.assertEqual(sum(await PnlRollup.all().values_list('realised', flat=True)), 1900)
+
+    async def test_pooled_reports(self):
+        algo = BaseAlgo()
+        for instrument in self.instruments:
+            await algo.entry(self.subscription, instrument, 10, TradeSide.BUY, 100)
+        await algo.exit(await Position.filter(instrument=self.instruments[0]).get(), 120)
+        await rollup_pnl()
+        report = await PnlSave.get_pnl_report(self.account)
+        self.assertEqual(pickle.loads(pickle.dumps(report)), report)
+        self.assertEqual((len(report['open']), len(report['closed'])), (1, 1))
+        built = [(report['account_id'], excel) async for report, excel in build_pnl_excels([report, dict(report, account_id=0)], workers=2)]
+        self.assertEqual(sorted(account_id for account_id, _ in built), [0, self.account.id])
+        serial = build_pnl_excel(report)
+        for _, excel in built:
+            self.assertEqual(excel[:4], serial[:4])
+            self.assertGreater(len(excel), 1000)
+
+
+class MailTransportTest(test.TestCase):
+
+    async def _setUp(self):
+        user = await User.create(email='test@test.com')
+        self.account = await Account.create(user=user, start_date=datetime.date.today(), name="Test")
+        await AccountEmail.create(account=self.account, email='cc@test.com')
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+        set_mail_transport(None)
+
+    async def test_send_mails(self):
+        async with LocalSMTPServer(max_messages=2) as server:
+            mail_transport = MailTransport(server.host, server.port, "user", "password", size=2)
+            set_mail_transport(mail_transport)
+            mailer = BaseMailer()
+            for i in range(7):
+                mailer.mails.append(await TradesMail.create(account=self.account, subject=f"Trades {i}", body="body", html="<p>body</p>"))
+            await mailer.send_mails()
+            self.assertEqual(len(server.messages), 7)
+            self.assertTrue(all(b"cc@test.com" in message for message in server.messages))
+            self.assertEqual(server.logins, server.connections)
+            self.assertGreaterEqual(server.connections, 4)
+            await mail_transport.close()
+
+    async def test_reuses_connections(self):
+        async with LocalSMTPServer() as server:
+            mail_transport = MailTransport(server.host, server.port, size=3)
+            set_mail_transport(mail_transport)
+            mailer = BaseMailer()
+            mailer.mails.append(await TradesMail.create(account=self.account, subject="Trades", body="body", html="<p>body</p>"))
+            for _ in range(5):
+                await mailer.send_mails()
+            self.assertEqual((len(server.messages), server.connections), (5, 1))
+            await mail_transport.close()
+
+    async def test_failed_send_closes_connection(self):
+        async with LocalSMTPServer() as server:
+            mail_transport = MailTransport(server.host, server.port)
+            msg = EmailMessage()
+            msg['From'] = "a@b.c"
+            msg['Subject'] = "No recipients"
+            with self.assertRaises(ValueError):
+                await mail_transport.send_message(msg)
+            self.assertEqual(mail_transport._idle, [])
+        with self.assertRaises(SMTPConnectError):
+            await MailTransport(server.host, server.port, retries=1).send_message(msg)
+
+
+class MailerPrefetchTest(test.TestCase):
+
+    async def _setUp(self):
+        algo = await Algo.create(name="BaseAlgo")
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        expiry = datetime.date(2026, 10, 29)
+        future = await Future.create(stock=stock, expiry=expiry, lot_size=25)
+        option = await Option.create(stock=stock, strike=4000, expiry=expiry, option_type=OptionType.CALL, lot_size=25)
+        self.instruments = [
+            await Instrument.create(stock=stock, future=None, option=None),
+            await Instrument.create(stock=None, future=future, option=None),
+            await Instrument.create(stock=None, future=None, option=option),
+        ]
+        self.subscriptions = []
+        for i in range(3):
+            user = await User.create(email=f'test{i}@test.com')
+            account = await Account.create(user=user, start_date=datetime.date.today(), name=f"Test{i}")
+            await AccountEmail.create(account=account, email=f'cc{i}@test.com')
+            self.subscriptions.append(await Subscription.create(account=account, algo=algo, start_date=datetime.date.today()))
+        await ClientExcelAccount.create(account_id=self.subscriptions[0].account_id, client_account_id="CL1", template_type=ClientExcelType.KOTAK2)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        set_instrument_cache(None)
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+        set_instrument_cache(None)
+        set_mail_transport(None)
+
+    async def test_symbol_cache(self):
+        cache = InstrumentCache(size=2)
+        symbols = await cache.get_symbols(instrument.id for instrument in self.instruments)
+        self.assertEqual(list(map(symbols.get, [instrument.id for instrument in self.instruments])), ["TCS", "TCS Oct FUT", "TCS 4000 2026-10-29 CE"])
+        self.assertEqual(len(cache._entries), 2)
+        await Stock.filter(id=self.instruments[0].stock_id).update(ticker="TCS2")
+        cached = await cache.get_symbols([self.instruments[2].id])
+        self.assertEqual(cached[self.instruments[2].id], "TCS 4000 2026-10-29 CE")
+        self.assertEqual((await cache.get_symbols([self.instruments[0].id]))[self.instruments[0].id], "TCS2")
+        self.assertNotIn(self.instruments[1].id, cache._entries)
+
+    async def test_symbol_cache_expires(self):
+        instrument = self.instruments[0]
+        cache = InstrumentCache()
+        await cache.get_symbols([instrument.id])
+        await Stock.filter(id=instrument.stock_id).update(ticker="TCS2")
+        self.assertEqual((await cache.get_symbols([instrument.id]))[instrument.id], "TCS")
+        cache.ttl = 0
+        self.assertEqual((await cache.get_symbols([instrument.id]))[instrument.id], "TCS2")
+
+    async def test_trades_mailer(self):
+        algo = BaseAlgo()
+        await algo.entry(self.subscriptions[0], self.instruments[1], 25, TradeSide.BUY, 100)
+        await algo.entry(self.subscriptions[0], self.instruments[2], 50, TradeSide.SELL, 10)
+        await algo.entry(self.subscriptions[1], self.instruments[0], 5, TradeSide.SELL, 200)
+        await algo.exit(await Position.get(subscription=self.subscriptions[1]), 190)
+        async with LocalSMTPServer() as server:
+            set_mail_transport(MailTransport(server.host, server.port))
+            mailer = TradesMailer(algo)
+            await mailer.run()
+            mails = {mail.account_id: mail for mail in await TradesMail.all()}
+            self.assertEqual(len(server.messages), 3)
+        first, second, third = (mails[sub.account_id] for sub in self.subscriptions)
+        self.assertIn("BUY 25 quantity of TCS Oct FUT", first.body)
+        self.assertIn("SELL 50 quantity of TCS 4000 2026-10-29 CE", first.body)
+        self.assertIn("FUTSTK,TCS,29OCT2026,", first.attachment.decode())
+        self.assertIn("OPTSTK,TCS,29OCT2026,4000,CE", first.attachment.decode())
+        self.assertIn("SELL 5 quantity of TCS", second.body)
+        self.assertIn("BUY 5 quantity of TCS", second.body)
+        self.assertIsNone(second.attachment)
+        self.assertEqual(first.subject, second.subject)
+        self.assertNotEqual(third.body, first.body)
+        self.assertIsNotNone(third.timestamp)
+
+    async def test_positions_mailer(self):
+        algo = BaseAlgo()
+        await algo.entry(self.subscriptions[0], self.instruments[1], 25, TradeSide.BUY, 100)
+        await algo.entry(self.subscriptions[2], self.instruments[2], 50, TradeSide.SELL, 10)
+        async with LocalSMTPServer() as server:
+            set_mail_transport(MailTransport(server.host, server.port))
+            await PositionsMailer().run()
+            self.assertEqual(len(server.messages), 3)
+        bodies = {mail.account_id: mail.body for mail in await TradesMail.all()}
+        self.assertIn("TCS Oct FUT of 25 quantity", bodies[self.subscriptions[0].account_id])
+        self.assertIn("TCS 4000 2026-10-29 CE of 50 quantity", bodies[self.subscriptions[2].account_id])
+        self.assertNotIn("quantity", bodies[self.subscriptions[1].account_id].split("positions:", 1)[1])
+
+
+class CandleBuilderTest(test.TestCase):
+
+    async def _setUp(self):
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        self.instrument = await Instrument.create(stock=stock, future=None, option=None)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_candles(self):
+        builder = CandleBuilder(higher_intervals=(Interval.MIN_5,))
+        start = datetime.datetime(2023, 9, 4, 9, 15)
+        for seconds, price in ((0, 100), (20, 103), (50, 99), (70, 101), (130, 102), (30, 150)):
+            builder.add_tick(self.instrument.id, price, start + datetime.timedelta(seconds=seconds))
+        await builder.flush(start + datetime.timedelta(minutes=2, seconds=30))
+        bars = await Ohlc.filter(interval=Interval.MIN_1).order_by('timestamp').values_list('open', 'high', 'low', 'close')
+        self.assertEqual(bars, [(100, 103, 99, 99), (101, 101, 101, 101)])
+        self.assertEqual(await Ohlc.filter(interval=Interval.MIN_5).count(), 0)
+        builder.add_tick(self.instrument.id, 104, start + datetime.timedelta(minutes=2, seconds=40))
+        await builder.flush(start + datetime.timedelta(minutes=5))
+        bars = await Ohlc.filter(interval=Interval.MIN_1).order_by('timestamp').values_list('close', flat=True)
+        self.assertEqual(bars, [99, 101, 104])
+        bars = await Ohlc.filter(interval=Interval.MIN_5).values_list('timestamp', 'open', 'high', 'low', 'close')
+        self.assertEqual([(timestamp.replace(tzinfo=None), *prices) for timestamp, *prices in bars], [(start, 100, 104, 99, 104)])
+
+    async def test_failed_flush_is_capped(self):
+        builder = CandleBuilder(higher_intervals=(), max_pending=2)
+        start = datetime.datetime(2023, 9, 4, 9, 15)
+        for minutes in range(4):
+            builder.add_tick(self.instrument.id, 100 + minutes, start + datetime.timedelta(minutes=minutes))
+        with patch('dataaggregator.candles.bulk_upsert', side_effect=ConnectionError("down")):
+            self.assertEqual(await builder.flush(start + datetime.timedelta(minutes=5)), [])
+        ohlcs = await builder.flush(start + datetime.timedelta(minutes=5))
+        self.assertEqual(len(ohlcs), 2)
+
+    def test_ticks_use_market_time(self):
+        builder = CandleBuilder()
+        builder.add_tick(self.instrument.id, 100)
+        candle = builder._open[(self.instrument.id, Interval.MIN_1)]
+        self.assertLess(abs((market_now() - candle.start).total_seconds()), 120)
+
+
+class OhlcMaintenanceTest(test.TestCase):
+
+    async def _setUp(self):
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        today = datetime.date.today()
+        expired = await Future.create(stock=stock, expiry=today - datetime.timedelta(days=60), lot_size=1)
+        current = await Future.create(stock=stock, expiry=today + datetime.timedelta(days=10), lot_size=1)
+        self.instruments = [
+            await Instrument.create(stock=stock),
+            await Instrument.create(future=expired),
+            await Instrument.create(future=current),
+        ]
+        for instrument in self.instruments:
+            await Ohlc.create(instrument=instrument, timestamp=datetime.datetime.now(), interval=Interval.EOD, open=1, high=1, low=1, close=1)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_maintain_ohlc(self):
+        await maintain_ohlc()
+        remaining = await Ohlc.all().order_by('instrument_id').values_list('instrument_id', flat=True)
+        self.assertEqual(remaining, [self.instruments[0].id, self.instruments[2].id])
+
+
+class MarketSnapshotTest(test.TestCase):
+
+    async def _setUp(self):
+        user = await User.create(email='test@test.com')
+        self.account = await Account.create(user=user, start_date=datetime.date.today())
+        await Investment.create(account=self.account, amount=10000)
+        await Investment.create(account=self.account, amount=20000)
+        self.stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        self.instruments = []
+        for days in (40, 10):
+            future = await Future.create(stock=self.stock, expiry=datetime.date.today() + datetime.timedelta(days=days), lot_size=10)
+            instrument = await Instrument.create(stock=None, future=future, option=None)
+            await Ltp.create(instrument=instrument, price=days)
+            for i in range(1, 4):
+                await Ohlc.create(
+                    instrument=instrument,
+                    timestamp=datetime.datetime.now() - datetime.timedelta(days=i),
+                    interval=Interval.EOD,
+                    open=i, high=i, low=i, close=(days * 100 + i)
+                )
+            self.instruments.append(instrument)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_init(self):
+        far, near = self.instruments
+        await refresh_prev_closes()
+        snapshot = MarketSnapshot()
+        await snapshot.init([self.stock], [far.id], [self.account.id])
+        self.assertEqual(snapshot.get_future_instrument(self.stock), near)
+        self.assertEqual(snapshot.get_instrument(far.id).future.stock, self.stock)
+        self.assertEqual(snapshot.get_price(far.id), 40)
+        self.assertEqual(snapshot.get_price(near.id), 10)
+        self.assertEqual(snapshot.get_old_price(far.id), 4001)
+        self.assertEqual(snapshot.get_old_price(near.id), 1001)
+        self.assertEqual(snapshot.get_investment(self.account.id), 30000)
+
+    async def test_prev_closes(self):
+        far, near = self.instruments
+        await refresh_prev_closes()
+        await Ohlc.create(
+            instrument=near, timestamp=datetime.datetime.combine(datetime.date.today(), datetime.time()),
+            interval=Interval.EOD, open=1, high=1, low=1, close=1000
+        )
+        await refresh_prev_closes(since=datetime.date.today())
+        prev_closes = await load_prev_closes()
+        self.assertEqual(prev_closes, {far.id: 4001, near.id: 1001})
+        prev_closes = await load_prev_closes(datetime.date.today() + datetime.timedelta(days=1))
+        self.assertEqual(prev_closes[near.id], 1000)
+
+    async def test_prev_closes_fallback(self):
+        far, near = self.instruments
+        _prev_closes.clear()
+        await Ohlc.filter(instrument=far).exclude(close=4001).delete()
+        await Ohlc.filter(instrument=far).update(timestamp=datetime.datetime.now() - datetime.timedelta(days=60))
+        self.assertEqual(await get_prev_close(near.id), 1001)
+        self.assertEqual(await PrevClose.filter(instrument=near).count(), 3)
+        self.assertFalse(await PrevClose.filter(instrument=far).exists())
+        self.assertEqual(await get_prev_closes([far.id, near.id]), {far.id: 4001, near.id: 1001})
+        await Ohlc.filter(instrument=far).delete()
+        self.assertEqual(await get_prev_closes([far.id, -1]), {far.id: 4001})
+        self.assertIsNone(await get_prev_close(far.id, datetime.date.today() - datetime.timedelta(days=90)))
+
+
+class SignalsTest(test.TestCase):
+
+    async def _setUp(self):
+        self.stocks = []
+        for ticker, bars in (('TCS', 5), ('ITC', 3)):
+            stock = await Stock.create(ticker=ticker, name=ticker, isin=ticker)
+            instrument = await Instrument.create(stock=stock, future=None, option=None)
+            await Ltp.create(instrument=instrument, price=bars * 10)
+            for i in range(1, bars + 1):
+                await Ohlc.create(
+                    instrument=instrument,
+                    timestamp=datetime.datetime.now() - datetime.timedelta(days=i),
+                    interval=Interval.EOD,
+                    open=i, high=i, low=i, close=i
+                )
+            self.stocks.append(stock)
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_price_matrix(self):
+        price_matrix, price_vector = await get_price_matrix(self.stocks, nbars=4)
+        np.testing.assert_array_equal(price_matrix[0], [1, 2, 3, 4])
+        np.testing.assert_array_equal(price_matrix[1], [1, 2, 3, np.nan])
+        np.testing.assert_array_equal(price_vector, [50, 30])
+
+    async def test_price_matrix_gap(self):
+        for ohlc in await Ohlc.filter(instrument__stock=self.stocks[1]):
+            ohlc.timestamp -= datetime.timedelta(days=800)
+            await ohlc.save()
+        price_matrix, _ = await get_price_matrix(self.stocks, nbars=3)
+        self.assertEqual(np.count_nonzero(~np.isnan(price_matrix[1])), 3)
+
+    async def test_process_stocks(self):
+        price_matrix, price_vector = await get_price_matrix(self.stocks)
+        strategy = types.SimpleNamespace(
+            process=lambda price_array, price: "BUY" if price_array.size > 3 else "SELL"
+        )
+        side_map = process_stocks(strategy, self.stocks, price_matrix, price_vector)
+        self.assertEqual(side_map, {self.stocks[0]: "BUY", self.stocks[1]: "SELL"})
+        strategy.process_batch = lambda price_matrix, price_vector: ["HOLD"] * len(price_vector)
+        side_map = process_stocks(strategy, self.stocks, price_matrix, price_vector)
+        self.assertEqual(side_map, {self.stocks[0]: "HOLD", self.stocks[1]: "HOLD"})
+        price_vector[1] = np.nan
+        side_map = process_stocks(strategy, self.stocks, price_matrix, price_vector)
+        self.assertEqual(side_map, {self.stocks[0]: "HOLD"})
+        strategy.process_batch = lambda price_matrix, price_vector: 1 / 0
+        self.assertEqual(process_stocks(strategy, self.stocks, price_matrix, price_vector), {})
+
+    async def test_run_strategy(self):
+        price_matrix, price_vector = await get_price_matrix(self.stocks)
+        strategy = types.ModuleType('strategies.teststrategy')
+        strategy.process = lambda price_array, price: "BUY" if price_array.size > 3 else "SELL"
+        sys.modules[strategy.__name__] = strategy
+        self.addCleanup(sys.modules.pop, strategy.__name__)
+        for mode in ("inline", "thread", "process"):
+            side_map = await run_strategy(strategy, self.stocks, price_matrix, price_vector, mode)
+            self.assertEqual(list(side_map.items()), [(self.stocks[0], "BUY"), (self.stocks[1], "SELL")])
+
+    async def test_signal_cache(self):
+        set_signal_cache(DbSignalCache())
+        self.addCleanup(set_signal_cache, None)
+        stock_group = await StockGroup.create(name='Nifty50')
+        calls = []
+        strategy = types.ModuleType('strategies.teststrategy')
+        strategy.process = lambda price_array, price: calls.append(price) or "BUY"
+        for _ in range(2):
+            side_map = await generate_signals(strategy, self.stocks, stock_group=stock_group)
+            self.assertEqual(side_map, {self.stocks[0]: "BUY", self.stocks[1]: "BUY"})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(await SignalCache.all().count(), 1)
+        ltp = await Ltp.get(instrument__stock=self.stocks[0])
+        ltp.price = 60
+        await ltp.save()
+        await generate_signals(strategy, self.stocks, stock_group=stock_group)
+        self.assertEqual(len(calls), 4)
+
+
+class ShadowStoreTest(test.TestCase):
+
+    async def _setUp(self):
+        user = await User.create(email='test@test.com')
+        account = await Account.create(user=user, start_date=datetime.date.today())
+        algo = await Algo.create(name='ShadowAnalysis')
+        self.subscription = await Subscription.create(account=account, algo=algo, start_date=datetime.date.today())
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        self.instruments = []
+        for days in (10, 40):
+            future = await Future.create(stock=stock, expiry=datetime.date.today() + datetime.timedelta(days=days), lot_size=10)
+            self.instruments.append(await Instrument.create(stock=None, future=future, option=None))
+        now = datetime.datetime.now()
+        self.positions = [
+            {'inst_id': self.instruments[0].id, 'price': 100.0, 'side': 'buy', 'qty': 10, 'entry_time': now.isoformat(), 'old_price': 100.0, 'mtm': 0.0},
+            {'inst_id': self.instruments[1].id, 'price': 50.0, 'side': 'sell', 'qty': 20, 'entry_time': now.isoformat(), 'old_price': 50.0, 'mtm': 0.0},
+        ]
+        self.sub_data = await SubscriptionData.create(subscription=self.subscription, data={
+            'positions': self.positions,
+            'long_mtm_tracking': [1.0, 2.0],
+            'short_mtm_tracking': [-1.0, -2.0],
+            'shadow_long_status': 'ENTERED',
+        })
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_save_load(self):
+        sub_data = await load_shadow_state(self.sub_data)
+        sub_data.data['long_mtm_tracking'].append(3.0)
+        sub_data.data['short_mtm_tracking'].append(-3.0)
+        await save_shadow_state(sub_data)
+        self.assertEqual(await ShadowPositionRecord.filter(subscription=self.subscription).count(), 2)
+        self.assertEqual(await MtmTick.filter(subscription=self.subscription).count(), 3)
+        stored = await SubscriptionData.get(id=sub_data.id)
+        self.assertEqual(stored.data, {'shadow_long_status': 'ENTERED'})
+        await load_shadow_state(stored)
+        self.assertEqual(stored.data['positions'], self.positions)
+        self.assertEqual(stored.data['long_mtm_tracking'], [1.0, 2.0, 3.0])
+        self.assertEqual(stored.data['short_mtm_tracking'], [-1.0, -2.0, -3.0])
+        exited = stored.data['positions'][0]
+        exited['exit_time'] = datetime.datetime.now().isoformat()
+        exited['exit_price'] = 110.0
+        stored.data['positions'] = [exited]
+        stored.data.pop('long_mtm_tracking')
+        stored.data.pop('short_mtm_tracking')
+        await save_shadow_state(stored)
+        self.assertEqual(await MtmTick.filter(subscription=self.subscription).count(), 0)
+        reloaded = await load_shadow_state(await SubscriptionData.get(id=sub_data.id))
+        self.assertEqual(reloaded.data['positions'], [exited])
+        self.assertNotIn('long_mtm_tracking', reloaded.data)
+
+
+class ShadowMtmTest(test.TestCase):
+
+    async def _setUp(self):
+        user = await User.create(email='test@test.com')
+        account = await Account.create(user=user, start_date=datetime.date.today())
+        algo = await Algo.create(name='ShadowAnalysis')
+        subscription = await Subscription.create(account=account, algo=algo, start_date=datetime.date.today())
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        self.instruments = []
+        for days, price in ((10, 110), (40, 45)):
+            future = await Future.create(stock=stock, expiry=datetime.date.today() + datetime.timedelta(days=days), lot_size=10)
+            instrument = await Instrument.create(stock=None, future=future, option=None)
+            await Ltp.create(instrument=instrument, price=price)
+            await Ohlc.create(
+                instrument=instrument, timestamp=datetime.datetime.now() - datetime.timedelta(days=1),
+                interval=Interval.EOD, open=1, high=1, low=1, close=price - 5
+            )
+            self.instruments.append(instrument)
+        now = datetime.datetime.now()
+        yesterday = now - datetime.timedelta(days=1)
+        self.sub_data = await SubscriptionData.create(subscription=subscription, data={'positions': [
+            {'inst_id': self.instruments[0].id, 'price': 100.0, 'side': 'buy', 'qty': 10, 'entry_time': yesterday.isoformat()},
+            {'inst_id': self.instruments[1].id, 'price': 50.0, 'side': 'sell', 'qty': 20, 'entry_time': now.isoformat()},
+            {'inst_id': self.instruments[1].id, 'price': 42.0, 'side': 'sell', 'qty': 5, 'entry_time': yesterday.isoformat(),
+             'exit_time': now.isoformat(), 'exit_price': 41.0},
+        ]})
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_update_shadow_mtm(self):
+        await refresh_prev_closes()
+        algo_strat = ShadowAnalysis()
+        book = await algo_strat.update_shadow_mtm(self.sub_data)
+        positions = self.sub_data.data['positions']
+        self.assertEqual([values['old_price'] for values in positions], [105.0, 50.0, 40.0])
+        self.assertEqual([values['mtm'] for values in positions], [50.0, 100.0, -5.0])
+        mtms = await algo_strat.get_shadow_mtms(self.sub_data, book)
+        self.assertEqual(mtms[:2], (50.0, 95.0))
+        self.assertEqual(mtms[6:8], (1, 1))
+        stored = await load_shadow_state(await SubscriptionData.get(id=self.sub_data.id))
+        self.assertEqual((await algo_strat.get_shadow_mtms(stored))[:2], (50.0, 95.0))
+        await Ltp.filter(instrument=self.instruments[1]).delete()
+        with self.assertRaises(KeyError):
+            await algo_strat.update_shadow_mtm(self.sub_data)
+
+
+class ShadowConcurrencyTest(test.TestCase):
+
+    async def _setUp(self):
+        user = await User.create(email='test@test.com')
+        account = await Account.create(user=user, start_date=datetime.date.today())
+        self.algo = await Algo.create(name='ShadowAnalysis')
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        future = await Future.create(stock=stock, expiry=datetime.date.today(), lot_size=10)
+        self.instrument = await Instrument.create(stock=None, future=future, option=None)
+        self.subscriptions = [
+            await Subscription.create(account=account, algo=self.algo, start_date=datetime.date.today())
+            for _ in range(4)
+        ]
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_run_concurrent(self):
+        algo_strat = ShadowAnalysis()
+        algo_strat.algo = self.algo
+        algo_strat.concurrent = True
+        algo_strat.get_pool_size = lambda: len(self.subscriptions)
+        failing = self.subscriptions[1]
+
+        async def run_subscription(sub):
+            for i in range(2):
+                await asyncio.sleep(0.01 * (self.subscriptions[-1].id - sub.id))
+                algo_strat.trades.append(Trade(subscription=sub, instrument=self.instrument, side=TradeSide.BUY, qty=i, price=1))
+                if sub == failing:
+                    raise ValueError
+        algo_strat.run_subscription = run_subscription
+        await algo_strat.run()
+        expected = [(sub.id, i) for sub in self.subscriptions for i in ((0,) if sub == failing else (0, 1))]
+        self.assertEqual([(trade.subscription_id, trade.qty) for trade in algo_strat.trades], expected)
+
+
+class SREMarketDataTest(test.TestCase):
+
+    async def _setUp(self):
+        stock = await Stock.create(ticker='NIFTY 50', name='NIFTY', isin='test', is_index=True)
+        future = await Future.create(stock=stock, expiry=datetime.date(2023, 9, 28), lot_size=50)
+        self.instrument = await Instrument.create(stock=None, future=future, option=None)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.market_api = SREMarketData()
+        self.market_api.instrument_master_path = os.path.join(self.cache_dir.name, 'master.pkl')
+        self.downloads = 0
+
+        async def download_instrument_master():
+            self.downloads += 1
+            return pd.DataFrame({
+                'Description': ['NIFTY-EQ', 'NIFTY23SEPFUT', 'NIFTY23SEPFUT'],
+                'ExchangeInstrumentID': [1, 2, 3],
+            })
+        self.market_api.download_instrument_master = download_instrument_master
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+        test.finalizer()
+
+    async def test_instrument_master(self):
+        await self.market_api.get_instrument_master()
+        await self.market_api.get_instrument_master()
+        self.assertEqual(self.downloads, 1)
+        self.assertEqual(await self.market_api._get_exchange_instrument_id(self.instrument), 2)
+        instrument = await Instrument.get(id=self.instrument.id)
+        self.assertEqual(await self.market_api._get_exchange_instrument_id(instrument), 2)
+        yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).timestamp()
+        os.utime(self.market_api.instrument_master_path, (yesterday, yesterday))
+        await self.market_api.get_instrument_master()
+        self.assertEqual(self.downloads, 2)
+
+    async def test_tick_ingestion(self):
+        await Ltp.create(instrument=self.instrument, price=90)
+        tick_store = LocalTickStore()
+
+        async def run_socketio():
+            pass
+        self.market_api.run_socketio = run_socketio
+        await self.market_api.run_tick_ingestion([self.instrument], tick_store=tick_store)
+        self.assertEqual(self.market_api._subscriptions, [{'exchangeSegment': 'NSEFO', 'exchangeInstrumentID': 2}])
+        await self.market_api._on_touchline(json.dumps({
+            'ExchangeSegment': 2, 'ExchangeInstrumentID': 2,
+            'Touchline': {'LastTradedPrice': 101.5, 'BidInfo': {'Price': 101.4}, 'AskInfo': {'Price': 101.6}}
+        }))
+        await self.market_api._on_ltp({'ExchangeSegment': 1, 'ExchangeInstrumentID': 2, 'LastTradedPrice': 1})
+        tick = await tick_store.get_tick(self.instrument.id)
+        self.assertEqual((tick['price'], tick['bid'], tick['ask']), (101.5, 101.4, 101.6))
+
+        set_tick_store(tick_store)
+        try:
+            algo_strat = ShadowAnalysis()
+            self.assertEqual(await algo_strat.get_current_price(self.instrument), 90)
+            algo_strat.live_price_max_age = 60
+            self.assertEqual(await algo_strat.get_current_price(self.instrument), 101.5)
+            await tick_store.set_tick(self.instrument.id, price=102, timestamp=time.time() - 120)
+            self.assertEqual(await algo_strat.get_current_price(self.instrument), 90)
+            await self.market_api._on_marketdepth({
+                'ExchangeSegment': 2, 'ExchangeInstrumentID': 2, 'Bids': [{'Price': 102.9}], 'Asks': [{'Price': 103.1}]
+            })
+            self.assertEqual((await tick_store.get_tick(self.instrument.id))['bid'], 102.9)
+            self.assertEqual(await algo_strat.get_current_price(self.instrument), 90)
+        finally:
+            set_tick_store(None)
+
+
+class SREExecuteTest(test.TestCase):
+
+    async def _setUp(self):
+        user = await User.create(email='test@test.com')
+        account = await Account.create(user=user, start_date=datetime.date.today())
+        algo = await Algo.create(name='NiftyFuturesAlgo')
+        subscription = await Subscription.create(account=account, algo=algo, start_date=datetime.date.today())
+        stock = await Stock.create(ticker='TCS', name='TCS', isin='test')
+        instrument = await Instrument.create(stock=stock, future=None, option=None)
+        await Ltp.create(instrument=instrument, price=100)
+        self.sre_account = await SREAccount.create(account=account)
+        self.sre_orders = []
+        for side in (TradeSide.BUY, TradeSide.SELL, TradeSide.BUY):
+            trade = await Trade.create(subscription=subscription, instrument=instrument, side=side, qty=1, price=0)
+            self.sre_orders.append(await SREOrders.create(sre_account=self.sre_account, trade=trade))
+
+    def setUp(self) -> None:
+        test.initializer(["database.models"], app_label="models")
+        run_async(self._setUp())
+
+    def tearDown(self) -> None:
+        test.finalizer()
+
+    async def test_place_pending_trades(self):
+        executor = SREExecute(self.sre_account)
+        executor._access_token = 'token'
+        executor.order_retry_delay = 0
+        already_placed = f"sre{self.sre_orders[0].id}"
+        flaky = f"sre{self.sre_orders[1].id}"
+        posted = []
+
+        async def get_placed_order_ids():
+            return {already_placed: 1000}
+
+        async def get_exchange_instrument_id(instrument):
+            return 11536
+
+        async def post_order(session, payload):
+            posted.append(payload['orderUniqueIdentifier'])
+            if payload['orderUniqueIdentifier'] == flaky and posted.count(flaky) == 1:
+                raise aiohttp.ServerDisconnectedError()
+            return {'result': {'AppOrderID': 2000 + len(posted)}}
+        executor.get_placed_order_ids = get_placed_order_ids
+        executor.market_api._get_exchange_instrument_id = get_exchange_instrument_id
+        executor._post_order = post_order
+        await executor.place_pending_trades()
+        self.assertNotIn(already_placed, posted)
+        self.assertEqual(posted.count(flaky), 2)
+        app_order_ids = await SREOrders.all().order_by('id').values_list('app_order_id', flat=True)
+        self.assertEqual(app_order_ids[0], 1000)
+        self.assertTrue(all(app_order_ids))
+        prices = await Trade.all().order_by('id').values_list('price', flat=True)
+        expected = [SREExecute._limit_price(100, side) for side in (TradeSide.SELL, TradeSide.BUY)]
+        self.assertEqual([float(price) for price in prices[1:]], [round(price, 2) for price in expected])
+
+    async def test_track_order_updates(self):
+        for app_order_id, sre_order in enumerate(self.sre_orders, start=1):
+            sre_order.app_order_id = app_order_id
+            await sre_order.save()
+        executor = SREExecute(self.sre_account)
+        executor._access_token = 'token'
+        executor.order_flush_interval = 0.01
+        order_book = [{'AppOrderID': 1, 'OrderStatus': 'Filled'}, {'AppOrderID': 2, 'OrderStatus': 'New'}]
+
+        async def get_order_details():
+            return {'result': order_book}
+
+        class FakeSocket:
+            connected = False
+            handlers = {}
+
+            def on(self, event, handler):
+                self.handlers[event] = handler
+
+            async def connect(self, url, socketio_path):
+                self.connected = True
+                for app_order_id in (2, 3, 3):
+                    await self.handlers['order'](json.dumps({'AppOrderID': app_order_id, 'OrderStatus': 'Filled'}))
+
+            async def disconnect(self):
+                self.connected = False
+        executor.get_order_details = get_order_details
+        executor.sio = FakeSocket()
+        sre_orders = await executor.track_order_updates(timeout=5)
+        self.assertEqual(sorted(sre_order.app_order_id for sre_order in sre_orders), [1, 2, 3])
+        statuses = await SREOrders.all().values_list('status', flat=True)
+        self.assertEqual(statuses, ['Filled'] * 3)
+        self.assertFalse(executor.sio.connected)
+
 
 class SeedTest(test.TestCase):
 
@@ -212,3 +1253,44 @@ class LambdaTest(test.TestCase):
         self.assertIsInstance(ltp.price, float)
         count = await Ohlc.filter(instrument__stock__ticker='ITC').count()
         self.assertEqual(count, 1)
+
+
+class LambdaInitTest(unittest.TestCase):
+
+    def test_reconnects_stale_db(self):
+        async def run():
+            main._db_inited = True
+            executor = main.LambdaExecutor({})
+            await executor.init()
+            self.assertTrue(main._db_inited)
+            await executor.ping_db()
+            await executor.init()
+            await Tortoise.close_connections()
+            main._db_inited = False
+
+        asyncio.run(run())
+
+
+class ImportProfileTest(unittest.TestCase):
+
+    def test_main_imports_lazily(self):
+        total, rows = import_profile("main", top=1000)
+        packages = {package for _, _, package in rows}
+        self.assertIn("main", packages)
+        self.assertFalse(packages & {"pandas", "numpy", "aiohttp", "aiogoogle", "jinja2", "aiosmtplib", "starlette", "mangum"})
+        self.assertGreater(total, 0)
+
+
+class PnlReportBenchmarkTest(unittest.TestCase):
+
+    def test_benchmark(self):
+        serial, pooled = pnl_report_benchmark(accounts=2, workers=2)
+        self.assertGreater(serial, 0)
+        self.assertGreater(pooled, 0)
+
+
+class SmtpBenchmarkTest(unittest.TestCase):
+
+    def test_benchmark(self):
+        single, pooled = smtp_benchmark(messages=20, size=4, latency=0.01)
+        self.assertGreater(single, pooled)